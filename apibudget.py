@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import logging
+import time
+import weakref
+from exception import ApiBudgetExhaustedException
+from metrics import metrics, current_task
+
+budget_waits_total = metrics.counter("digitalocean_budget_waits_total",
+                                     "DigitalOcean calls held back by the api budget", ("priority", "result"))
+budget_wait_seconds = metrics.histogram("digitalocean_budget_wait_seconds",
+                                        "Time DigitalOcean calls waited for api budget", ("priority",))
+
+
+class ApiPriority:
+    # lower is more important, a call inherits the priority of the task making it
+    TEARDOWN = 0
+    BOOT = 1
+    STATUS = 2
+    NAMES = {TEARDOWN: "teardown", BOOT: "boot", STATUS: "status"}
+
+    __task_priorities = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def of(task=None):
+        task = task if task is not None else current_task()
+        if task is None:
+            return ApiPriority.BOOT
+        return ApiPriority.__task_priorities.get(task, ApiPriority.BOOT)
+
+    @staticmethod
+    def share(task, from_task=None):
+        # work handed to another task keeps the priority of the task that started it
+        from_task = from_task if from_task is not None else current_task()
+        if from_task is not None and from_task in ApiPriority.__task_priorities:
+            ApiPriority.__task_priorities[task] = ApiPriority.__task_priorities[from_task]
+
+    @staticmethod
+    def prioritized(priority):
+        def decorator(coroutine_function):
+            @functools.wraps(coroutine_function)
+            async def prioritized_coroutine(*args, **kwargs):
+                task = current_task()
+                if task is None:
+                    return await coroutine_function(*args, **kwargs)
+                previous = ApiPriority.__task_priorities.get(task)
+                ApiPriority.__task_priorities[task] = priority
+                try:
+                    return await coroutine_function(*args, **kwargs)
+                finally:
+                    if previous is None:
+                        ApiPriority.__task_priorities.pop(task, None)
+                    else:
+                        ApiPriority.__task_priorities[task] = previous
+            return prioritized_coroutine
+        return decorator
+
+
+class ApiBudget:
+    # digitalocean reports the account's quota on every response, the share of it kept in reserve for
+    # more important calls is refused to less important ones: status first, then boots, teardown never
+    def __init__(self, boot_reserve=0.05, status_reserve=0.2, max_defer_sec=300, status_max_defer_sec=0,
+                 default_retry_sec=60):
+        self.limit = None
+        self.remaining = None
+        self.reset_time = None
+        self.__reserves = {ApiPriority.TEARDOWN: 0.0, ApiPriority.BOOT: boot_reserve,
+                           ApiPriority.STATUS: status_reserve}
+        self.__max_defer_sec = {ApiPriority.TEARDOWN: max_defer_sec, ApiPriority.BOOT: max_defer_sec,
+                                ApiPriority.STATUS: status_max_defer_sec}
+        self.__default_retry_sec = default_retry_sec
+
+    def update(self, status, headers, now=None):
+        now = now if now is not None else time.time()
+        limit = self.__header(headers, "RateLimit-Limit")
+        remaining = self.__header(headers, "RateLimit-Remaining")
+        reset_time = self.__header(headers, "RateLimit-Reset")
+        if limit is not None:
+            self.limit = limit
+        if reset_time is not None:
+            self.reset_time = reset_time
+        if remaining is not None:
+            self.remaining = remaining
+        if status == 429:
+            self.remaining = 0
+            retry_after_sec = self.__header(headers, "Retry-After")
+            if retry_after_sec is not None:
+                self.reset_time = now + retry_after_sec
+            elif self.reset_time is None or self.reset_time <= now:
+                self.reset_time = now + self.__default_retry_sec
+
+    @staticmethod
+    def __header(headers, name):
+        raw = headers.get(name) if headers is not None else None
+        if raw is None:
+            return None
+        try:
+            return float(raw)
+        except ValueError:
+            return None
+
+    def allows(self, priority, now=None):
+        now = now if now is not None else time.time()
+        if self.remaining is None or (self.reset_time is not None and now >= self.reset_time):
+            return True
+        reserve = self.__reserves[priority] * (self.limit or 0)
+        return self.remaining > max(0, reserve)
+
+    async def acquire(self, priority=None):
+        priority = priority if priority is not None else ApiPriority.of()
+        if not self.allows(priority):
+            await self.__defer(priority)
+        if self.remaining is not None:
+            # counted down before the response so concurrent calls see each other
+            self.remaining -= 1
+
+    async def __defer(self, priority):
+        name = ApiPriority.NAMES[priority]
+        start_time = time.time()
+        deadline = start_time + self.__max_defer_sec[priority]
+        while not self.allows(priority):
+            now = time.time()
+            wake_time = self.reset_time if self.reset_time is not None else now + 1
+            if wake_time > deadline:
+                budget_waits_total.inc(priority=name, result="refused")
+                raise ApiBudgetExhaustedException(
+                    "digitalocean api budget is low, {0} calls resume in {1:.0f}s".format(
+                        name, max(0, wake_time - now)))
+            logging.warning("deferring {0} call {1:.0f}s for digitalocean api budget ({2:.0f} left)".format(
+                name, wake_time - now, self.remaining))
+            await asyncio.sleep(min(max(0.05, wake_time - now), 5.0))
+        budget_waits_total.inc(priority=name, result="deferred")
+        budget_wait_seconds.observe(time.time() - start_time, priority=name)
@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+
+
+class AuthorizationCache:
+    def __init__(self, max_entries=4096, ttl_sec=3600):
+        self.__max_entries = max_entries
+        self.__ttl_sec = ttl_sec
+        # (server id, member id, channel id) -> (authorized, decided time), least recently used first
+        self.__decisions = OrderedDict()
+        # server id -> keys decided in it
+        self.__server_keys = {}
+
+    def __len__(self):
+        return len(self.__decisions)
+
+    def get(self, server_id, member_id, channel_id=None):
+        key = (server_id, member_id, channel_id)
+        decision = self.__decisions.get(key)
+        if decision is None:
+            return None
+        authorized, decided_time = decision
+        if self.__ttl_sec is not None and time.monotonic() - decided_time > self.__ttl_sec:
+            self.__remove(key)
+            return None
+        self.__decisions.move_to_end(key)
+        return authorized
+
+    def put(self, server_id, member_id, authorized, channel_id=None):
+        key = (server_id, member_id, channel_id)
+        self.__decisions[key] = (authorized, time.monotonic())
+        self.__decisions.move_to_end(key)
+        self.__server_keys.setdefault(server_id, set()).add(key)
+        while len(self.__decisions) > self.__max_entries:
+            oldest_key = next(iter(self.__decisions))
+            self.__remove(oldest_key)
+
+    def __remove(self, key):
+        self.__decisions.pop(key, None)
+        keys = self.__server_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                self.__server_keys.pop(key[0])
+
+    def invalidate_member(self, server_id, member_id):
+        for key in [k for k in self.__server_keys.get(server_id, ()) if k[1] == member_id]:
+            self.__remove(key)
+
+    def invalidate_server(self, server_id):
+        for key in self.__server_keys.pop(server_id, set()):
+            self.__decisions.pop(key, None)
+
+    def invalidate(self):
+        self.__decisions.clear()
+        self.__server_keys.clear()
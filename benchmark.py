@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from digitaloceanclient import DigitalOceanClient
+from dropletapi import DropletApi
+from dropletactivitymonitor import DropletActivityMonitor
+from fakedigitalocean import FakeDigitalOceanServer
+from apibudget import ApiBudget, budget_waits_total
+from metrics import metrics
+
+SNAPSHOT_NAME = "bench-snapshot"
+FIREWALL_NAME = "bench-firewall"
+SCENARIOS = ("boot", "status", "monitor")
+
+
+def percentile(samples, q):
+    if len(samples) == 0:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(name, samples, unit="s"):
+    print("  {0:<28} n={1:<5} min={2:.3f}{6} p50={3:.3f}{6} p95={4:.3f}{6} max={5:.3f}{6}".format(
+        name, len(samples), min(samples) if samples else float("nan"), percentile(samples, 0.5),
+        percentile(samples, 0.95), max(samples) if samples else float("nan"), unit))
+
+
+async def bench_boot(server, do_client, args, loop):
+    # parks every started monitor far in the future, only the boot path is measured here
+    monitor = DropletActivityMonitor(initial_monitor_delay_sec=3600, loop=loop)
+    tag_names = ["bench-boot-{}".format(i) for i in range(args.boots)]
+    requests_before = server.request_count()
+
+    async def boot(tag_name):
+        start_time = time.perf_counter()
+        await DropletApi.create_or_get_single_droplet_from_snapshot(do_client, tag_name, SNAPSHOT_NAME,
+                                                                    FIREWALL_NAME, None, monitor)
+        return time.perf_counter() - start_time
+
+    boot_samples = await asyncio.gather(*[boot(tag_name) for tag_name in tag_names])
+    boot_requests = server.request_count() - requests_before
+
+    async def teardown(tag_name):
+        start_time = time.perf_counter()
+        await DropletApi.destroy_tagged_droplets(do_client, tag_name, monitor)
+        return time.perf_counter() - start_time
+
+    requests_before = server.request_count()
+    teardown_samples = await asyncio.gather(*[teardown(tag_name) for tag_name in tag_names])
+    teardown_requests = server.request_count() - requests_before
+    await monitor.close()
+
+    print("boot path ({0} concurrent boots, simulated boot {1:.1f}s)".format(args.boots, server.boot_sec))
+    report("boot latency", boot_samples)
+    report("overhead over simulated boot", [s - server.boot_sec for s in boot_samples])
+    report("teardown latency", teardown_samples)
+    print("  api requests per boot        {:.1f}".format(boot_requests / float(args.boots)))
+    print("  api requests per teardown    {:.1f}".format(teardown_requests / float(args.boots)))
+
+
+async def bench_status(server, do_client, args, loop):
+    tag_names = ["bench-status-{}".format(i) for i in range(args.status_tags)]
+    for tag_name in tag_names:
+        server.add_droplet("{}-droplet".format(tag_name), tag_name)
+    requests_before = server.request_count()
+    samples = []
+    errors = 0
+    end_time = time.perf_counter() + args.duration
+
+    async def client_loop(client_index):
+        nonlocal errors
+        i = client_index
+        while time.perf_counter() < end_time:
+            start_time = time.perf_counter()
+            try:
+                await DropletApi.get_single_droplet_status(do_client, tag_names[i % len(tag_names)])
+                samples.append(time.perf_counter() - start_time)
+            except Exception:
+                errors += 1
+            i += 1
+            # a cache hit never yields, without this one client would have the loop to itself
+            await asyncio.sleep(0)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client_loop(i) for i in range(args.status_clients)])
+    elapsed_sec = time.perf_counter() - start_time
+    status_requests = server.request_count() - requests_before
+
+    print("status ({0} clients over {1} tags for {2:.0f}s)".format(args.status_clients, len(tag_names),
+                                                                   args.duration))
+    report("status latency", samples)
+    print("  throughput                   {:.1f} status/s".format(len(samples) / elapsed_sec))
+    print("  api requests per status      {:.3f}".format(status_requests / float(max(1, len(samples)))))
+    print("  errors                       {}".format(errors))
+
+
+async def bench_monitor(server, do_client, args, loop):
+    tag_name = "bench-monitor"
+    for i in range(args.monitored):
+        server.add_droplet("bench-monitor-{}".format(i), tag_name)
+    droplets = await do_client.get_all_droplets(tag_name=tag_name)
+
+    monitor = DropletActivityMonitor(timedelta(seconds=args.inactive_sec), args.poll_sec, 0,
+                                     max_concurrent_polls=args.max_concurrent_polls, loop=loop)
+    ended = []
+
+    async def inactive(last_active_utc, droplet):
+        ended.append(droplet.id)
+        return False
+
+    async def errored(error, droplet):
+        ended.append(droplet.id)
+
+    polls_before = server.request_count(route="last_active_time")
+    start_time = time.perf_counter()
+    for droplet in droplets:
+        monitor.start_monitoring(droplet, inactive, errored)
+    await asyncio.sleep(args.duration)
+    elapsed_sec = time.perf_counter() - start_time
+    polls = server.request_count(route="last_active_time") - polls_before
+    await monitor.close()
+
+    lag = metrics.get("monitor_poll_lag_seconds")
+    latency = metrics.get("monitor_poll_seconds")
+    print("monitor ({0} droplets, poll every {1:.1f}s for {2:.0f}s)".format(len(droplets), args.poll_sec,
+                                                                          args.duration))
+    print("  polls                        {0} ({1:.1f}/s, {2:.2f} per droplet)".format(
+        polls, polls / elapsed_sec, polls / float(max(1, len(droplets)))))
+    print("  poll lag                     p50={0:.3f}s p99={1:.3f}s".format(lag.quantile(0.5) or 0.0,
+                                                                          lag.quantile(0.99) or 0.0))
+    print("  poll latency                 p50={0:.3f}s p99={1:.3f}s".format(latency.quantile(0.5) or 0.0,
+                                                                          latency.quantile(0.99) or 0.0))
+    print("  monitoring ended             {}".format(len(ended)))
+
+
+async def run(args, loop):
+    server = FakeDigitalOceanServer(latency_sec=args.latency_ms / 1000.0, latency_jitter_sec=args.jitter_ms / 1000.0,
+                                    page_size=args.page_size, failure_rate=args.failure_rate,
+                                    boot_sec=args.boot_sec, poll_latency_sec=args.poll_latency_ms / 1000.0,
+                                    poll_failure_rate=args.poll_failure_rate, idle_sec=args.idle_sec,
+                                    rate_limit=args.rate_limit, seed=args.seed, loop=loop)
+    await server.start()
+    server.add_snapshot(SNAPSHOT_NAME)
+    server.add_firewall(FIREWALL_NAME)
+    server.add_ssh_key("bench-key")
+    api_budget = ApiBudget() if args.rate_limit is not None else None
+    do_client = DigitalOceanClient("bench-token", api_base_url=server.api_base_url, api_budget=api_budget, loop=loop)
+
+    DropletApi.track_single_droplets()
+    DropletApi.cache_resources(do_client, loop=loop)
+    DropletApi.cache_status(do_client, args.status_fresh_sec, args.status_max_stale_sec, loop=loop)
+    try:
+        if "boot" in args.scenarios:
+            await bench_boot(server, do_client, args, loop)
+        if "status" in args.scenarios:
+            await bench_status(server, do_client, args, loop)
+        if "monitor" in args.scenarios:
+            await bench_monitor(server, do_client, args, loop)
+    finally:
+        if args.rate_limit is not None:
+            print("rate limit ({} requests per minute)".format(args.rate_limit))
+            print("  rejected by the fake api     {}".format(server.request_count(route="rate_limited")))
+            for priority in ("teardown", "boot", "status"):
+                print("  {0:<28} deferred={1:.0f} refused={2:.0f}".format(
+                    priority, budget_waits_total.value(priority=priority, result="deferred"),
+                    budget_waits_total.value(priority=priority, result="refused")))
+        await do_client.close()
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DropletApi and DropletActivityMonitor against a local "
+                                                 "fake DigitalOcean api")
+    parser.add_argument("scenarios", nargs="*", help="any of boot, status, monitor (default all)")
+    parser.add_argument("--latency-ms", type=float, default=50, help="api latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="extra random api latency per request")
+    parser.add_argument("--page-size", type=int, default=25, help="largest page the fake api returns")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of api requests failing with 500")
+    parser.add_argument("--boot-sec", type=float, default=2.0, help="simulated droplet boot time")
+    parser.add_argument("--poll-latency-ms", type=float, default=10, help="droplet /last_active_time latency")
+    parser.add_argument("--poll-failure-rate", type=float, default=0.0, help="share of droplet polls failing")
+    parser.add_argument("--idle-sec", type=float, default=0.0, help="how long ago droplets report activity")
+    parser.add_argument("--rate-limit", type=int, default=None,
+                        help="api requests per minute before the fake api answers 429, budgeted by the client")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run the status and monitor runs")
+    parser.add_argument("--boots", type=int, default=10, help="concurrent boots, one tag each")
+    parser.add_argument("--status-clients", type=int, default=20)
+    parser.add_argument("--status-tags", type=int, default=5)
+    parser.add_argument("--status-fresh-sec", type=float, default=10)
+    parser.add_argument("--status-max-stale-sec", type=float, default=120)
+    parser.add_argument("--monitored", type=int, default=300, help="droplets watched by the monitor")
+    parser.add_argument("--poll-sec", type=float, default=1.0, help="monitor poll interval")
+    parser.add_argument("--inactive-sec", type=float, default=300, help="monitor inactivity threshold")
+    parser.add_argument("--max-concurrent-polls", type=int, default=10)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if len(unknown) > 0:
+        parser.error("unknown scenario(s) {0}, choose from {1}".format(", ".join(unknown), ", ".join(SCENARIOS)))
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args, loop))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from exception import DropletBootFailedException
+
+
+class BootTimeModel:
+    def __init__(self, default_boot_sec=60, max_samples=20):
+        self.__default_boot_sec = default_boot_sec
+        self.__max_samples = max_samples
+        self.__samples = {}
+        self.__state_store = None
+
+    def persist_to(self, state_store):
+        self.__state_store = state_store
+        for snapshot_name, region_name, boot_kind, boot_sec in state_store.load_boot_times(self.__max_samples):
+            self.__append(snapshot_name, region_name, boot_kind, boot_sec)
+
+    def __append(self, snapshot_name, region_name, boot_kind, boot_sec):
+        key = (snapshot_name, region_name, boot_kind)
+        if key not in self.__samples:
+            self.__samples[key] = deque(maxlen=self.__max_samples)
+        self.__samples[key].append(boot_sec)
+
+    def record(self, snapshot_name, region_name, boot_sec, boot_kind="create"):
+        self.__append(snapshot_name, region_name, boot_kind, boot_sec)
+        if self.__state_store is not None:
+            self.__state_store.save_boot_time(snapshot_name, region_name, boot_kind, boot_sec)
+
+    def samples(self, snapshot_name, region_name, boot_kind="create"):
+        return list(self.__samples.get((snapshot_name, region_name, boot_kind), ()))
+
+    def expected_window(self, snapshot_name, region_name, boot_kind="create"):
+        # (earliest, expected, latest) boot completion in seconds after create
+        samples = sorted(self.__samples.get((snapshot_name, region_name, boot_kind), ()))
+        if len(samples) == 0:
+            return None, self.__default_boot_sec, None
+        median = samples[len(samples) // 2]
+        return samples[0], median, samples[-1]
+
+
+class AdaptiveBootPoller:
+    def __init__(self, do_client, boot_time_model, min_quiet_sec=5, window_poll_sec=2, max_poll_sec=15,
+                 overdue_growth=1.5, error_backoff_base_sec=1, max_errors=5, max_wait_sec=600):
+        self.__do_client = do_client
+        self.__boot_time_model = boot_time_model
+        self.__min_quiet_sec = min_quiet_sec
+        self.__window_poll_sec = window_poll_sec
+        self.__max_poll_sec = max_poll_sec
+        self.__overdue_growth = overdue_growth
+        self.__error_backoff_base_sec = error_backoff_base_sec
+        self.__max_errors = max_errors
+        self.__max_wait_sec = max_wait_sec
+
+    async def __load_statuses(self, action_ids):
+        actions = await asyncio.gather(*[self.__do_client.get_action(action_id) for action_id in action_ids])
+        return [a.status for a in actions]
+
+    async def wait_for_boot(self, droplet_name, action_ids, snapshot_name, region_name, progress_callback=None,
+                            start_time=None, boot_kind="create"):
+        start_time = start_time if start_time is not None else time.perf_counter()
+        earliest_sec, expected_sec, latest_sec = self.__boot_time_model.expected_window(snapshot_name, region_name,
+                                                                                        boot_kind)
+
+        if progress_callback is not None:
+            await progress_callback("droplet {0} is booting, expected to be ready in about {1:.0f} seconds".format(
+                droplet_name, max(0.0, expected_sec - (time.perf_counter() - start_time))))
+
+        # stay quiet until the earliest moment the boot has ever finished
+        quiet_sec = self.__min_quiet_sec if earliest_sec is None else max(self.__min_quiet_sec, earliest_sec * 0.9)
+        poll_sec = self.__window_poll_sec
+        overdue_sec = latest_sec * 1.1 if latest_sec is not None else expected_sec
+        overdue_reported = False
+        errors = 0
+        polls = 0
+        await asyncio.sleep(max(0.0, quiet_sec - (time.perf_counter() - start_time)))
+
+        while True:
+            elapsed_sec = time.perf_counter() - start_time
+            if elapsed_sec > self.__max_wait_sec:
+                raise DropletBootFailedException("droplet {} did not finish turning on in time".format(droplet_name))
+
+            try:
+                polls += 1
+                statuses = await self.__load_statuses(action_ids)
+                errors = 0
+            except Exception as e:
+                errors += 1
+                if errors >= self.__max_errors:
+                    raise
+                delay_sec = self.__error_backoff_base_sec * (2 ** (errors - 1))
+                logging.warning("boot poll for droplet {0} failed ({1}), retrying in {2:.1f}s".format(
+                    droplet_name, e if len(e.args) == 0 else e.args[0], delay_sec))
+                await asyncio.sleep(random.uniform(0, delay_sec))
+                continue
+
+            if "errored" in statuses:
+                raise DropletBootFailedException("droplet {} failed to turn on".format(droplet_name))
+            if len(statuses) > 0 and all(status == "completed" for status in statuses):
+                boot_sec = time.perf_counter() - start_time
+                self.__boot_time_model.record(snapshot_name, region_name, boot_sec, boot_kind)
+                logging.info("droplet {0} booted in {1:.1f}s after {2} poll(s)".format(droplet_name, boot_sec, polls))
+                return boot_sec
+
+            elapsed_sec = time.perf_counter() - start_time
+            if elapsed_sec > overdue_sec:
+                # past anything seen before, back off instead of hammering the api
+                poll_sec = min(self.__max_poll_sec, poll_sec * self.__overdue_growth)
+                if not overdue_reported and progress_callback is not None:
+                    overdue_reported = True
+                    await progress_callback("droplet {} is taking longer than usual to turn on".format(droplet_name))
+            await asyncio.sleep(poll_sec)
@@ -0,0 +1,62 @@
+import asyncio
+from exception import CommandQueueFullException
+
+
+class Command:
+    def __init__(self, text, handler, command_class, authorized=False, max_concurrency=1, max_queued=0):
+        self.text = text
+        self.handler = handler
+        self.command_class = command_class
+        self.authorized = authorized
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.running = 0
+        self.queued = 0
+        self.__slots = None
+
+    async def run(self, message):
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.max_concurrency)
+        if self.running >= self.max_concurrency and self.queued >= self.max_queued:
+            raise CommandQueueFullException(
+                "I'm already busy with {0} '{1}' request(s), try again in a bit.".format(
+                    self.running + self.queued, self.text))
+
+        self.queued += 1
+        try:
+            await self.__slots.acquire()
+        finally:
+            self.queued -= 1
+        self.running += 1
+        try:
+            return await self.handler(message)
+        finally:
+            self.running -= 1
+            self.__slots.release()
+
+
+class CommandRouter:
+    def __init__(self, prefix="!"):
+        self.__prefix = prefix
+        # first word after the prefix -> commands starting with it, longest text first
+        self.__commands = {}
+
+    def add_command(self, text, handler, command_class, authorized=False, max_concurrency=1, max_queued=0):
+        command = Command(text, handler, command_class, authorized, max_concurrency, max_queued)
+        first_word = text[len(self.__prefix):].split(" ", 1)[0]
+        commands = self.__commands.setdefault(first_word, [])
+        commands.append(command)
+        commands.sort(key=lambda c: len(c.text), reverse=True)
+        return command
+
+    def commands(self):
+        return [command for commands in self.__commands.values() for command in commands]
+
+    def route(self, content):
+        if not content.startswith(self.__prefix):
+            return None
+        first_word = content[len(self.__prefix):].split(" ", 1)[0]
+        for command in self.__commands.get(first_word, ()):
+            if content.startswith(command.text):
+                return command
+        return None
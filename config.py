@@ -1,86 +1,356 @@
 import configparser
+import asyncio
+import os
 import time
 import datetime
+import logging
+import traceback
+from types import MappingProxyType
+from streamprofile import StreamProfile
+from placement import parse_region_rtt, parse_regions
+from exception import ConfigValidationException
+
+
+class ConfigSnapshot:
+    # command class -> scope -> (requests per minute, burst)
+    DEFAULT_COMMAND_RATE_LIMITS = {
+        "control": {"user": (3, 3), "channel": (6, 5)},
+        # turning a stream off gets its own buckets so turn on spam never holds up a teardown
+        "teardown": {"user": (3, 3), "channel": (6, 5)},
+        "query": {"user": (6, 3), "channel": (20, 10)},
+    }
+    # a config without these cannot turn anything on, like a file caught halfway through being saved
+    REQUIRED_OPTIONS = (("Droplet", "DefaultTagName"), ("Droplet", "DefaultSnapshotName"),
+                        ("ApiKey", "DigitalOceanApiKey"), ("ApiKey", "DiscordApiKey"))
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("config snapshots are immutable, {} cannot be set".format(name))
+
+    @staticmethod
+    def __number(parser, section, option, default, convert=float, minimum=None):
+        raw = parser.get(section, option, fallback=None)
+        if not raw:
+            return default
+        try:
+            value = convert(raw)
+        except ValueError:
+            raise ConfigValidationException("[{0}] {1}={2} is not a number".format(section, option, raw))
+        if minimum is not None and value < minimum:
+            raise ConfigValidationException("[{0}] {1}={2} must be at least {3}".format(section, option, raw, minimum))
+        return value
+
+    @staticmethod
+    def __region_rtt(parser, section):
+        raw = parser.get(section, "RegionRttMs", fallback=None)
+        try:
+            return parse_region_rtt(raw)
+        except ValueError:
+            raise ConfigValidationException("[{0}] RegionRttMs={1} is not a list of region:ms".format(section, raw))
+
+    @staticmethod
+    def from_parser(parser, require_options=True):
+        if require_options:
+            missing = ["[{0}] {1}".format(section, option) for section, option in ConfigSnapshot.REQUIRED_OPTIONS
+                       if not parser.get(section, option, fallback=None)]
+            if len(missing) > 0:
+                raise ConfigValidationException("{} must be set".format(", ".join(missing)))
+
+        number = ConfigSnapshot.__number
+        default_tag_name = parser.get("Droplet", "DefaultTagName", fallback=None)
+        default_snapshot_name = parser.get("Droplet", "DefaultSnapshotName", fallback=None)
+        default_firewall_name = parser.get("Droplet", "DefaultFirewallName", fallback=None)
+        stream_play_key = parser.get("StreamPlayKey", "PlayKey", fallback="{play key}")
+        default_stream_key = parser.get("StreamPlayKey", "DefaultStreamKey", fallback="{stream key}")
+
+        droplet_inactivity_delta_sec = number(parser, "Droplet", "DropletInactivityDelta", None, minimum=1)
+        warm_standby = parser.get("Droplet", "WarmStandby", fallback=None) or ""
+        preboot = parser.get("Preboot", "Enabled", fallback=None) or ""
+        resource_cache_ttl_sec = number(parser, "Cache", "ResourceCacheTtlSec", 300.0, minimum=0)
+        # refreshed ahead of expiry by default, so a turn on never waits on the listings
+        resource_cache_refresh_sec = number(parser, "Cache", "ResourceCacheRefreshSec",
+                                            max(1.0, resource_cache_ttl_sec * 0.8) if resource_cache_ttl_sec > 0
+                                            else None, minimum=1)
+
+        default_stream_profile = StreamProfile("default",
+                                               default_tag_name,
+                                               default_snapshot_name,
+                                               default_firewall_name or None,
+                                               default_stream_key or "{stream key}",
+                                               stream_play_key or "{play key}",
+                                               parser.get("Authorization", "AuthorizedRole", fallback=None) or None,
+                                               parser.get("Authorization", "AuthorizedPermission",
+                                                          fallback=None) or "manage_server",
+                                               parse_regions(parser.get("Droplet", "PreferredRegions",
+                                                                        fallback=None)),
+                                               ConfigSnapshot.__region_rtt(parser, "Droplet"))
+        stream_profiles = {}
+        for section_name in parser.sections():
+            if section_name.startswith("Profile."):
+                profile_name = section_name[len("Profile."):]
+                ConfigSnapshot.__region_rtt(parser, section_name)
+                stream_profiles[profile_name] = StreamProfile.from_section(
+                    profile_name, parser[section_name], default_stream_profile)
+
+        command_rate_limits = {}
+        for command_class, default_limits in ConfigSnapshot.DEFAULT_COMMAND_RATE_LIMITS.items():
+            scopes = {}
+            for scope, (default_per_min, default_burst) in default_limits.items():
+                prefix = "{}{}".format(command_class.capitalize(), scope.capitalize())
+                per_min = number(parser, "RateLimit", prefix + "PerMin", default_per_min, minimum=0)
+                burst = number(parser, "RateLimit", prefix + "Burst", default_burst, minimum=1)
+                scopes[scope] = (float(per_min) / 60.0, float(burst))
+            command_rate_limits[command_class] = MappingProxyType(scopes)
+
+        return ConfigSnapshot(
+            default_tag_name=default_tag_name,
+            default_snapshot_name=default_snapshot_name,
+            default_firewall_name=default_firewall_name,
+            digital_ocean_api_key=parser.get("ApiKey", "DigitalOceanApiKey", fallback=None),
+            discord_api_key=parser.get("ApiKey", "DiscordApiKey", fallback=None),
+            stream_play_key=stream_play_key,
+            default_stream_key=default_stream_key,
+            droplet_inactivity_delta=datetime.timedelta(seconds=droplet_inactivity_delta_sec)
+            if droplet_inactivity_delta_sec is not None else None,
+            droplet_inactivity_poll_sec=number(parser, "Droplet", "DropletInactivityPollDelaySec", None, minimum=1),
+            default_stream_profile=default_stream_profile,
+            stream_profiles=MappingProxyType(stream_profiles),
+            warm_standby=warm_standby.strip().lower() in ("1", "true", "yes", "on"),
+            standby_max_idle_sec=number(parser, "Droplet", "StandbyMaxIdleSec", 3600.0, minimum=0),
+            standby_pool_size=number(parser, "Droplet", "StandbyPoolSize", 1, convert=int, minimum=1),
+            state_store_path=parser.get("State", "StateStorePath", fallback=None) or "streambot.state.db",
+            command_rate_limits=MappingProxyType(command_rate_limits),
+            rate_limit_idle_eviction_sec=number(parser, "RateLimit", "IdleEvictionSec", 600.0, minimum=1),
+            resource_cache_ttl_sec=resource_cache_ttl_sec,
+            resource_cache_refresh_sec=resource_cache_refresh_sec,
+            status_cache_fresh_sec=number(parser, "Cache", "StatusCacheFreshSec", 10.0, minimum=0),
+            status_cache_max_stale_sec=number(parser, "Cache", "StatusCacheMaxStaleSec", 120.0, minimum=0),
+            metrics_host=parser.get("Metrics", "Host", fallback=None) or "127.0.0.1",
+            metrics_port=number(parser, "Metrics", "Port", None, convert=int, minimum=1),
+            stall_threshold_sec=number(parser, "Watchdog", "StallThresholdSec", 0.25, minimum=0.01),
+            placement_probe_host_format=parser.get("Placement", "ProbeHostFormat", fallback=None) or None,
+            placement_probe_port=number(parser, "Placement", "ProbePort", 80, convert=int, minimum=1),
+            shard_count=number(parser, "Sharding", "ShardCount", 1, convert=int, minimum=1),
+            coordinator_host=parser.get("Sharding", "CoordinatorHost", fallback=None) or "127.0.0.1",
+            coordinator_port=number(parser, "Sharding", "CoordinatorPort", 9110, convert=int, minimum=1),
+            preboot=preboot.strip().lower() in ("1", "true", "yes", "on"),
+            preboot_lead_time_sec=number(parser, "Preboot", "LeadTimeSec", 600.0, minimum=0),
+            preboot_claim_grace_sec=number(parser, "Preboot", "ClaimGraceSec", 1800.0, minimum=0),
+            preboot_history_weeks=number(parser, "Preboot", "HistoryWeeks", 4, convert=int, minimum=1),
+            preboot_min_weeks=number(parser, "Preboot", "MinWeeks", 2, convert=int, minimum=1),
+            preboot_window_sec=number(parser, "Preboot", "WindowSec", 1800.0, minimum=60),
+            api_boot_reserve=number(parser, "ApiBudget", "BootReserve", 0.05, minimum=0),
+            api_status_reserve=number(parser, "ApiBudget", "StatusReserve", 0.2, minimum=0),
+            api_max_defer_sec=number(parser, "ApiBudget", "MaxDeferSec", 300.0, minimum=0),
+            api_status_max_defer_sec=number(parser, "ApiBudget", "StatusMaxDeferSec", 0.0, minimum=0)
+        )
 
 
 class Config:
     def __init__(self, file_path=None, config_refresh_time_sec=None):
-        self.__parser = None
         self.__parser_file_path=file_path
         self.__config_refresh_time_threshold=config_refresh_time_sec
-        self.__config_refresh_base_time=None
-        self.__default_tag_name=None
-        self.__default_snapshot_name=None
-        self.__default_firewall_name=None
-        self.__digital_ocean_api_key=None
-        self.__discord_api_key=None
-        self.__stream_play_key=None
-        self.__default_stream_key=None
-        self.__droplet_inactivity_delta_sec=None
-        self.__droplet_inactivity_poll_sec=None
+        self.__config_refresh_base_time=time.perf_counter()
+        self.__file_signature=None
+        self.__subscribers=[]
+        self.__watch_task=None
 
         if file_path is not None:
-            self.__config_refresh_base_time=time.perf_counter()
-            self.__parser = configparser.ConfigParser()
-            self.__populate_from_parser()
-
-    def __populate_from_parser(self):
-        parser = self.__parser
-        file_path = self.__parser_file_path
-        parser.read(file_path)
-        self.__default_tag_name=parser.get("Droplet", "DefaultTagName", fallback=None)
-        self.__default_snapshot_name=parser.get("Droplet", "DefaultSnapshotName", fallback=None)
-        self.__default_firewall_name=parser.get("Droplet", "DefaultFirewallName", fallback=None)
-        self.__digital_ocean_api_key=parser.get("ApiKey", "DigitalOceanApiKey", fallback=None)
-        self.__discord_api_key=parser.get("ApiKey", "DiscordApiKey", fallback=None)
-        self.__stream_play_key=parser.get("StreamPlayKey", "PlayKey", fallback="{play key}")
-        self.__default_stream_key=parser.get("StreamPlayKey", "DefaultStreamKey", fallback="{stream key}")
-        self.__droplet_inactivity_delta_sec=parser.get("Droplet", "DropletInactivityDelta", fallback=None)
-        self.__droplet_inactivity_poll_sec=parser.get("Droplet", "DropletInactivityPollDelaySec", fallback=None)
+            self.__file_signature = self.__read_file_signature()
+            self.__snapshot = self.__parse_snapshot()
+        else:
+            self.__snapshot = ConfigSnapshot.from_parser(configparser.ConfigParser(), require_options=False)
+
+    def __read_file_signature(self):
+        try:
+            stat = os.stat(self.__parser_file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def __parse_snapshot(self):
+        parser = configparser.ConfigParser()
+        parser.read(self.__parser_file_path)
+        return ConfigSnapshot.from_parser(parser)
+
+    def subscribe(self, callback):
+        # callback(old snapshot, new snapshot) runs after every successful reload
+        self.__subscribers.append(callback)
+
+    def refresh(self):
+        if self.__parser_file_path is None:
+            return False
+        file_signature = self.__read_file_signature()
+        # a file that is gone for the moment, like one replaced by a rename, keeps the current snapshot
+        if file_signature is None or file_signature == self.__file_signature:
+            return False
+        self.__file_signature = file_signature
+
+        try:
+            snapshot = self.__parse_snapshot()
+        except (ConfigValidationException, configparser.Error) as e:
+            logging.error("config {0} was not reloaded: {1}".format(self.__parser_file_path,
+                                                                     e if len(e.args) == 0 else e.args[0]))
+            return False
+
+        old_snapshot = self.__snapshot
+        self.__snapshot = snapshot
+        logging.info("config {} reloaded".format(self.__parser_file_path))
+        for callback in list(self.__subscribers):
+            try:
+                callback(old_snapshot, snapshot)
+            except Exception as e:
+                tb = traceback.format_exc()
+                logging.error("config subscriber failed due to {0} \n at {1}".format(
+                    e if len(e.args) == 0 else e.args[0], tb))
+        return True
 
     def __check_for_config_refresh(self):
         if self.__config_refresh_time_threshold is not None and \
-                self.__parser is not None and \
-                self.__config_refresh_base_time - time.perf_counter() > self.__config_refresh_time_threshold:
+                time.perf_counter() - self.__config_refresh_base_time > self.__config_refresh_time_threshold:
             self.__config_refresh_base_time = time.perf_counter()
-            self.__populate_from_parser()
+            self.refresh()
 
-    def default_tag_name(self):
+    async def __watch_forever(self, interval_sec):
+        while True:
+            await asyncio.sleep(interval_sec)
+            self.refresh()
+
+    def start_watching(self, interval_sec=5, loop=None):
+        if self.__watch_task is None and self.__parser_file_path is not None:
+            self.__watch_task = asyncio.ensure_future(self.__watch_forever(interval_sec), loop=loop)
+
+    def stop_watching(self):
+        if self.__watch_task is not None:
+            self.__watch_task.cancel()
+            self.__watch_task = None
+
+    def snapshot(self):
         self.__check_for_config_refresh()
-        return self.__default_tag_name
+        return self.__snapshot
+
+    def default_tag_name(self):
+        return self.snapshot().default_tag_name
 
     def default_snapshot_name(self):
-        self.__check_for_config_refresh()
-        return self.__default_snapshot_name
+        return self.snapshot().default_snapshot_name
 
     def default_firewall_name(self):
-        self.__check_for_config_refresh()
-        return self.__default_firewall_name
+        return self.snapshot().default_firewall_name
 
     def digital_ocean_api_key(self):
-        self.__check_for_config_refresh()
-        return self.__digital_ocean_api_key
+        return self.snapshot().digital_ocean_api_key
 
     def discord_api_key(self):
-        self.__check_for_config_refresh()
-        return self.__discord_api_key
+        return self.snapshot().discord_api_key
 
     def stream_play_key(self):
-        self.__check_for_config_refresh()
-        return self.__stream_play_key
+        return self.snapshot().stream_play_key
 
     def default_stream_key(self):
-        self.__check_for_config_refresh()
-        return self.__default_stream_key
+        return self.snapshot().default_stream_key
 
     def droplet_inactivity_delta(self):
-        self.__check_for_config_refresh()
-        if self.__droplet_inactivity_delta_sec is None:
-            return self.__droplet_inactivity_delta_sec
-        return datetime.timedelta(seconds=float(self.__droplet_inactivity_delta_sec))
+        return self.snapshot().droplet_inactivity_delta
 
     def droplet_inactivity_poll_sec(self):
-        self.__check_for_config_refresh()
-        if self.__droplet_inactivity_poll_sec is None:
-            return self.__droplet_inactivity_poll_sec
-        return float(self.__droplet_inactivity_poll_sec)
+        return self.snapshot().droplet_inactivity_poll_sec
+
+    def warm_standby(self):
+        return self.snapshot().warm_standby
+
+    def standby_max_idle_sec(self):
+        return self.snapshot().standby_max_idle_sec
+
+    def standby_pool_size(self):
+        return self.snapshot().standby_pool_size
+
+    def state_store_path(self):
+        return self.snapshot().state_store_path
+
+    def command_rate_limits(self):
+        return self.snapshot().command_rate_limits
+
+    def rate_limit_idle_eviction_sec(self):
+        return self.snapshot().rate_limit_idle_eviction_sec
+
+    def resource_cache_ttl_sec(self):
+        return self.snapshot().resource_cache_ttl_sec
+
+    def resource_cache_refresh_sec(self):
+        return self.snapshot().resource_cache_refresh_sec
+
+    def status_cache_fresh_sec(self):
+        return self.snapshot().status_cache_fresh_sec
+
+    def status_cache_max_stale_sec(self):
+        return self.snapshot().status_cache_max_stale_sec
+
+    def metrics_host(self):
+        return self.snapshot().metrics_host
+
+    def metrics_port(self):
+        return self.snapshot().metrics_port
+
+    def stall_threshold_sec(self):
+        return self.snapshot().stall_threshold_sec
+
+    def placement_probe_host_format(self):
+        return self.snapshot().placement_probe_host_format
+
+    def placement_probe_port(self):
+        return self.snapshot().placement_probe_port
+
+    def shard_count(self):
+        return self.snapshot().shard_count
+
+    def coordinator_host(self):
+        return self.snapshot().coordinator_host
+
+    def coordinator_port(self):
+        return self.snapshot().coordinator_port
+
+    def preboot(self):
+        return self.snapshot().preboot
+
+    def preboot_lead_time_sec(self):
+        return self.snapshot().preboot_lead_time_sec
+
+    def preboot_claim_grace_sec(self):
+        return self.snapshot().preboot_claim_grace_sec
+
+    def preboot_history_weeks(self):
+        return self.snapshot().preboot_history_weeks
+
+    def preboot_min_weeks(self):
+        return self.snapshot().preboot_min_weeks
+
+    def preboot_window_sec(self):
+        return self.snapshot().preboot_window_sec
+
+    def api_boot_reserve(self):
+        return self.snapshot().api_boot_reserve
+
+    def api_status_reserve(self):
+        return self.snapshot().api_status_reserve
+
+    def api_max_defer_sec(self):
+        return self.snapshot().api_max_defer_sec
+
+    def api_status_max_defer_sec(self):
+        return self.snapshot().api_status_max_defer_sec
+
+    def default_stream_profile(self):
+        return self.snapshot().default_stream_profile
+
+    def stream_profile(self, server_id=None):
+        snapshot = self.snapshot()
+        if server_id is not None and str(server_id) in snapshot.stream_profiles:
+            return snapshot.stream_profiles[str(server_id)]
+        return snapshot.default_stream_profile
+
+    def stream_profiles(self):
+        return list(self.snapshot().stream_profiles.values())
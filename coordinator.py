@@ -0,0 +1,375 @@
+import asyncio
+import itertools
+import json
+import logging
+import traceback
+import exception
+from dropletapi import DropletApi
+from statestore import StateStore
+from placement import RegionPlacement, TcpConnectProbe
+from prebootscheduler import PrebootScheduler
+from apibudget import ApiBudget
+from dropletrecord import DropletRecord, ActionRecord
+from exception import StreamBotException, CoordinatorUnavailableException
+
+
+def api_budget(config):
+    return ApiBudget(config.api_boot_reserve(), config.api_status_reserve(), config.api_max_defer_sec(),
+                     config.api_status_max_defer_sec())
+
+
+def configure_droplet_api(config, do_client, inactivity_monitor, loop):
+    # the one process that owns droplet lifecycle sets DropletApi up, shards only talk to it
+    DropletApi.track_single_droplets()
+    DropletApi.cache_resources(do_client, config.resource_cache_ttl_sec(), config.resource_cache_refresh_sec(),
+                               loop=loop)
+    DropletApi.cache_status(do_client, config.status_cache_fresh_sec(), config.status_cache_max_stale_sec(),
+                            loop=loop)
+    if config.warm_standby():
+        DropletApi.keep_warm_standby(do_client, config.standby_max_idle_sec(), config.standby_pool_size(),
+                                     loop=loop)
+    probe = None
+    if config.placement_probe_host_format() is not None:
+        probe = TcpConnectProbe(config.placement_probe_host_format(), config.placement_probe_port())
+    DropletApi.place_droplets(RegionPlacement(probe))
+    if config.preboot():
+        DropletApi.schedule_preboots(preboot_scheduler(config, do_client, inactivity_monitor, loop))
+    state_store = StateStore(config.state_store_path())
+    DropletApi.persist_state(state_store)
+    inactivity_monitor.persist_to(state_store)
+    DropletApi.rehydrate(do_client, inactivity_monitor, loop=loop)
+
+
+def preboot_scheduler(config, do_client, inactivity_monitor, loop):
+    def profile_for(tag_name):
+        for profile in [config.default_stream_profile()] + config.stream_profiles():
+            if profile.tag_name == tag_name:
+                return profile
+        return None
+
+    async def preboot(tag_name):
+        profile = profile_for(tag_name)
+        if profile is None:
+            logging.warning("no stream profile uses tag {}, not prebooting".format(tag_name))
+            return
+        # left unmonitored, an idle preboot would be shut down for inactivity before its window even opens;
+        # the turn on that claims it starts the monitor
+        await DropletApi.create_or_get_single_droplet_from_snapshot(do_client, tag_name, profile.snapshot_name,
+                                                                    profile.firewall_name, None, None,
+                                                                    profile.preferred_regions, profile.region_rtt_ms)
+
+    async def teardown(tag_name):
+        await DropletApi.destroy_tagged_droplets(do_client, tag_name, inactivity_monitor)
+
+    return PrebootScheduler(preboot, teardown, config.preboot_lead_time_sec(), config.preboot_claim_grace_sec(),
+                            config.preboot_history_weeks(), config.preboot_min_weeks(), config.preboot_window_sec(),
+                            loop=loop)
+
+
+def start_droplet_api_background():
+    resource_cache = DropletApi.resource_cache()
+    if resource_cache is not None:
+        resource_cache.start_background_refresh()
+    standby_pool = DropletApi.standby_pool()
+    if standby_pool is not None:
+        standby_pool.start_reaping()
+    scheduler = DropletApi.preboot_scheduler()
+    if scheduler is not None:
+        scheduler.start()
+
+
+class LocalDropletService:
+    def __init__(self, do_client, inactivity_monitor):
+        self.__do_client = do_client
+        self.__inactivity_monitor = inactivity_monitor
+
+    async def turn_on(self, tag_name, snapshot_name, firewall_name, progress_callback=None, region_hints=None,
+                      region_rtt_ms=None, channel_id=None):
+        self.__record(tag_name, PrebootScheduler.TURN_ON)
+        return await DropletApi.create_or_get_single_droplet_from_snapshot(self.__do_client, tag_name, snapshot_name,
+                                                                           firewall_name, progress_callback,
+                                                                           self.__inactivity_monitor, region_hints,
+                                                                           region_rtt_ms)
+
+    async def turn_off(self, tag_name, progress_callback=None, channel_id=None):
+        self.__record(tag_name, PrebootScheduler.TURN_OFF)
+        return await DropletApi.destroy_tagged_droplets(self.__do_client, tag_name, self.__inactivity_monitor,
+                                                        progress_callback)
+
+    async def status(self, tag_name):
+        return await DropletApi.get_single_droplet_status(self.__do_client, tag_name)
+
+    @staticmethod
+    def __record(tag_name, event):
+        # only commands count as history, droplets the scheduler boots itself do not
+        scheduler = DropletApi.preboot_scheduler()
+        if scheduler is not None:
+            scheduler.record(tag_name, event)
+
+
+class CoordinatorServer:
+    # newline delimited json: {"id", "op", "args"} in, {"id", "progress"}, {"notice", "channel_id", "progress"}
+    # and {"id", "result"|"error"} out
+    def __init__(self, service, host="127.0.0.1", port=9110, loop=None):
+        self.__service = service
+        self.__host = host
+        self.__port = port
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__server = None
+        self.__connections = set()
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handle, self.__host, self.__port)
+        logging.info("coordinator listening on {0}:{1}".format(self.__host, self.__port))
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            self.__server = None
+
+    async def __handle(self, reader, writer):
+        connection = CoordinatorConnection(writer)
+        self.__connections.add(connection)
+        try:
+            while True:
+                line = await reader.readline()
+                if line == b"":
+                    break
+                request = json.loads(line.decode("utf-8"))
+                asyncio.ensure_future(self.__dispatch(connection, request), loop=self.__loop)
+        except (ConnectionError, ValueError) as e:
+            logging.warning("shard connection dropped: {}".format(e if len(e.args) == 0 else e.args[0]))
+        finally:
+            self.__connections.discard(connection)
+            connection.closed = True
+            writer.close()
+
+    async def __notify(self, connection, message):
+        # progress after the requesting shard went away, e.g. an inactivity shutdown, goes to every shard
+        # and the one that can see the channel posts it
+        if not connection.closed:
+            await connection.send(message)
+            return
+        # request ids are only unique per shard, so a broadcast carries none and is marked as a notice
+        notice = {"notice": True, "channel_id": message.get("channel_id"), "progress": message["progress"]}
+        for other in list(self.__connections):
+            await other.send(notice)
+
+    def __progress_callback(self, connection, request_id, channel_id):
+        async def progress_callback(text):
+            await self.__notify(connection, {"id": request_id, "channel_id": channel_id, "progress": text})
+
+        return progress_callback
+
+    async def __dispatch(self, connection, request):
+        request_id = request.get("id")
+        args = request.get("args", {})
+        try:
+            op = request.get("op")
+            if op == "turn_on":
+                droplet = await self.__service.turn_on(
+                    args["tag_name"], args["snapshot_name"], args.get("firewall_name"),
+                    self.__progress_callback(connection, request_id, args.get("channel_id")),
+                    args.get("region_hints"), args.get("region_rtt_ms"))
+                result = droplet.to_json()
+            elif op == "turn_off":
+                droplets = await self.__service.turn_off(
+                    args["tag_name"], self.__progress_callback(connection, request_id, args.get("channel_id")))
+                result = [d.to_json() for d in droplets]
+            elif op == "status":
+                droplet, statuses = await self.__service.status(args["tag_name"])
+                result = {"droplet": droplet.to_json(), "statuses": [s.to_json() for s in statuses]}
+            else:
+                raise StreamBotException("unknown coordinator operation {}".format(op))
+            await connection.send({"id": request_id, "result": result})
+        except Exception as e:
+            if not isinstance(e, StreamBotException):
+                tb = traceback.format_exc()
+                logging.error("coordinator request {0} failed due to {1} \n at {2}".format(
+                    request.get("op"), e if len(e.args) == 0 else e.args[0], tb))
+            await connection.send({"id": request_id, "error": {
+                "type": type(e).__name__, "message": str(e if len(e.args) == 0 else e.args[0])}})
+
+
+class CoordinatorConnection:
+    def __init__(self, writer):
+        self.closed = False
+        self.__writer = writer
+        self.__write_lock = asyncio.Lock()
+
+    async def send(self, message):
+        if self.closed:
+            return
+        try:
+            async with self.__write_lock:
+                self.__writer.write((json.dumps(message) + "\n").encode("utf-8"))
+                await self.__writer.drain()
+        except ConnectionError:
+            self.closed = True
+
+
+class CoordinatorClient:
+    def __init__(self, host="127.0.0.1", port=9110, notice_callback=None, loop=None):
+        self.__host = host
+        self.__port = port
+        # notice_callback(channel id, text) receives progress for requests this shard no longer waits on
+        self.__notice_callback = notice_callback
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__ids = itertools.count(1)
+        # request id -> (future, progress callback)
+        self.__pending = {}
+        self.__writer = None
+        self.__reader_task = None
+        self.__connect_lock = None
+
+    async def __connect(self):
+        if self.__connect_lock is None:
+            self.__connect_lock = asyncio.Lock()
+        async with self.__connect_lock:
+            if self.__writer is not None:
+                return self.__writer
+            try:
+                reader, writer = await asyncio.open_connection(self.__host, self.__port)
+            except OSError as e:
+                raise CoordinatorUnavailableException(
+                    "droplet coordinator is unavailable, try again in a bit ({})".format(
+                        e if len(e.args) == 0 else e.args[-1]))
+            self.__writer = writer
+            self.__reader_task = asyncio.ensure_future(self.__read_forever(reader), loop=self.__loop)
+            return writer
+
+    async def __read_forever(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if line == b"":
+                    break
+                await self.__on_message(json.loads(line.decode("utf-8")))
+        except (ConnectionError, ValueError) as e:
+            logging.warning("coordinator connection dropped: {}".format(e if len(e.args) == 0 else e.args[0]))
+        finally:
+            self.__disconnect()
+
+    def __disconnect(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        pending = self.__pending
+        self.__pending = {}
+        for future, progress_callback in pending.values():
+            if not future.done():
+                future.set_exception(CoordinatorUnavailableException(
+                    "lost the droplet coordinator mid request, check !stream status"))
+
+    async def __on_message(self, message):
+        pending = self.__pending.get(message.get("id")) if not message.get("notice") else None
+        if "progress" in message:
+            try:
+                if message.get("notice"):
+                    if self.__notice_callback is not None:
+                        await self.__notice_callback(message.get("channel_id"), message["progress"])
+                elif pending is not None and pending[1] is not None:
+                    await pending[1](message["progress"])
+                elif pending is None and self.__notice_callback is not None:
+                    await self.__notice_callback(message.get("channel_id"), message["progress"])
+            except Exception as e:
+                tb = traceback.format_exc()
+                logging.error("coordinator progress failed due to {0} \n at {1}".format(
+                    e if len(e.args) == 0 else e.args[0], tb))
+            return
+
+        if pending is None:
+            return
+        self.__pending.pop(message["id"], None)
+        future = pending[0]
+        if future.done():
+            return
+        if "error" in message:
+            # rebuilt as the same bot exception so commands report it like a local failure
+            exception_type = getattr(exception, message["error"]["type"], None)
+            if not (isinstance(exception_type, type) and issubclass(exception_type, StreamBotException)):
+                exception_type = StreamBotException
+            future.set_exception(exception_type(message["error"]["message"]))
+        else:
+            future.set_result(message["result"])
+
+    async def __call(self, op, args, progress_callback=None):
+        writer = await self.__connect()
+        request_id = next(self.__ids)
+        future = self.__loop.create_future()
+        self.__pending[request_id] = (future, progress_callback)
+        try:
+            writer.write((json.dumps({"id": request_id, "op": op, "args": args}) + "\n").encode("utf-8"))
+            await writer.drain()
+            return await future
+        finally:
+            self.__pending.pop(request_id, None)
+
+    async def turn_on(self, tag_name, snapshot_name, firewall_name, progress_callback=None, region_hints=None,
+                      region_rtt_ms=None, channel_id=None):
+        result = await self.__call("turn_on", {"tag_name": tag_name, "snapshot_name": snapshot_name,
+                                               "firewall_name": firewall_name, "region_hints": region_hints,
+                                               "region_rtt_ms": region_rtt_ms, "channel_id": channel_id},
+                                   progress_callback)
+        return DropletRecord(**result)
+
+    async def turn_off(self, tag_name, progress_callback=None, channel_id=None):
+        # the teardown is confirmed after the reply, a failed confirmation arrives as a notice for the channel
+        result = await self.__call("turn_off", {"tag_name": tag_name, "channel_id": channel_id}, progress_callback)
+        return [DropletRecord(**d) for d in result]
+
+    async def status(self, tag_name):
+        result = await self.__call("status", {"tag_name": tag_name})
+        return DropletRecord(**result["droplet"]), [ActionRecord(**s) for s in result["statuses"]]
+
+    async def close(self):
+        if self.__reader_task is not None:
+            self.__reader_task.cancel()
+            self.__reader_task = None
+        self.__disconnect()
+
+
+def run_coordinator(config_path="streambot.config"):
+    from config import Config
+    from digitaloceanclient import DigitalOceanClient
+    from dropletactivitymonitor import DropletActivityMonitor
+    from loopwatchdog import LoopWatchdog
+    from metrics import metrics, MetricsServer
+
+    loop = asyncio.get_event_loop()
+    config = Config(config_path)
+    do_client = DigitalOceanClient(config.digital_ocean_api_key(), api_budget=api_budget(config), loop=loop)
+    monitor = DropletActivityMonitor(config.droplet_inactivity_delta(), config.droplet_inactivity_poll_sec(),
+                                     loop=loop)
+    config.subscribe(lambda old_snapshot, new_snapshot: monitor.reconfigure(
+        new_snapshot.droplet_inactivity_delta, new_snapshot.droplet_inactivity_poll_sec))
+    configure_droplet_api(config, do_client, monitor, loop)
+
+    server = CoordinatorServer(LocalDropletService(do_client, monitor), config.coordinator_host(),
+                               config.coordinator_port(), loop=loop)
+    loop_watchdog = LoopWatchdog(loop=loop, stall_threshold_sec=config.stall_threshold_sec())
+    metrics_server = None
+    if config.metrics_port() is not None:
+        metrics_server = MetricsServer(metrics, config.metrics_host(), config.metrics_port(), loop=loop)
+    try:
+        loop.run_until_complete(server.start())
+        if metrics_server is not None:
+            loop.run_until_complete(metrics_server.start())
+        start_droplet_api_background()
+        config.start_watching(loop=loop)
+        loop_watchdog.start()
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop_watchdog.stop()
+        server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        loop.run_until_complete(do_client.close())
+        loop.run_until_complete(monitor.close())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run_coordinator()
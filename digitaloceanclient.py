@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+import re
+import time
+import aiohttp
+import async_timeout
+import digitalocean as digio
+from exception import DigitalOceanApiException, DigitalOceanNotFoundException, ApiBudgetExhaustedException
+from metrics import metrics
+from apibudget import ApiPriority
+from dropletrecord import DropletRecord, ActionRecord
+
+request_seconds = metrics.histogram("digitalocean_request_seconds", "DigitalOcean API request latency",
+                                    ("method", "endpoint", "status"))
+
+
+class DigitalOceanClient:
+    API_BASE_URL = "https://api.digitalocean.com/v2/"
+
+    def __init__(self, token, api_base_url=None, per_page=200, max_connections=10, keepalive_timeout_sec=30,
+                 request_timeout_sec=30, api_budget=None, loop=None):
+        self.token = token
+        self.__api_base_url = api_base_url if api_base_url is not None else DigitalOceanClient.API_BASE_URL
+        self.__per_page = per_page
+        self.__max_connections = max_connections
+        self.__keepalive_timeout_sec = keepalive_timeout_sec
+        self.__request_timeout_sec = request_timeout_sec
+        self.__api_budget = api_budget
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__session = None
+
+    def __get_session(self):
+        # one pooled keep-alive session shared by every call, created lazily on the owning loop
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(limit=self.__max_connections,
+                                             keepalive_timeout=self.__keepalive_timeout_sec,
+                                             loop=self.__loop)
+            self.__session = aiohttp.ClientSession(connector=connector, loop=self.__loop, headers={
+                "Authorization": "Bearer {}".format(self.token),
+                "Content-Type": "application/json"
+            })
+        return self.__session
+
+    async def close(self):
+        if self.__session is not None and not self.__session.closed:
+            closing = self.__session.close()
+            if asyncio.iscoroutine(closing) or isinstance(closing, asyncio.Future):
+                await closing
+        self.__session = None
+
+    async def __request(self, method, path, params=None, body=None):
+        url = path if path.startswith("http") else self.__api_base_url + path
+        data = json.dumps(body) if body is not None else None
+        session = self.__get_session()
+        trace = metrics.current_trace()
+        if trace is not None:
+            trace.api_calls += 1
+        priority = ApiPriority.of()
+        for attempt in range(2):
+            if self.__api_budget is not None:
+                await self.__api_budget.acquire(priority)
+            status = "error"
+            start_time = time.perf_counter()
+            try:
+                status, payload = await self.__send(session, method, url, params, data)
+            finally:
+                request_seconds.observe(time.perf_counter() - start_time, method=method,
+                                        endpoint=re.sub(r"/\d+", "/{id}", path.split("?")[0]), status=str(status))
+            # a 429 means the budget was spent elsewhere, boots and teardowns wait for the reset and go again
+            if status != 429 or self.__api_budget is None or priority == ApiPriority.STATUS:
+                break
+
+        if status == 429:
+            raise ApiBudgetExhaustedException("{} {} was rate limited by digitalocean".format(method, path))
+        if status == 404:
+            raise DigitalOceanNotFoundException("{} {} was not found".format(method, path), status=status,
+                                                payload=payload)
+        if status >= 400:
+            raise DigitalOceanApiException("{} {} failed with status {}: {}".format(method, path, status, payload),
+                                           status=status, payload=payload)
+        return payload
+
+    async def __send(self, session, method, url, params, data):
+        with async_timeout.timeout(self.__request_timeout_sec, loop=self.__loop):
+            async with session.request(method, url, params=params, data=data) as response:
+                if self.__api_budget is not None:
+                    self.__api_budget.update(response.status, response.headers)
+                if response.status >= 400:
+                    return response.status, await response.text()
+                if response.status == 204:
+                    return response.status, None
+                return response.status, await response.json()
+
+    async def __get_all_pages(self, path, key, params=None):
+        page_params = dict(params) if params is not None else {}
+        page_params["per_page"] = self.__per_page
+        page = 1
+        items = []
+        while True:
+            page_params["page"] = page
+            data = await self.__request("GET", path, params=page_params)
+            items.extend(data.get(key, []))
+            pages = data.get("links", {}).get("pages", {})
+            if "next" not in pages:
+                return items
+            page += 1
+
+    async def get_all_droplets(self, tag_name=None):
+        params = {"tag_name": tag_name} if tag_name is not None else None
+        droplets = await self.__get_all_pages("droplets", "droplets", params=params)
+        return [DropletRecord.from_api(d, tag_name) for d in droplets]
+
+    async def get_droplet(self, droplet_id):
+        data = await self.__request("GET", "droplets/{}".format(droplet_id))
+        return DropletRecord.from_api(data["droplet"])
+
+    async def create_droplet(self, name, region, image, size_slug, ssh_keys=None, tags=None):
+        body = {
+            "name": name,
+            "region": region,
+            "image": image,
+            "size": size_slug,
+            "ssh_keys": [k.id if hasattr(k, "id") else k for k in (ssh_keys or [])],
+            "tags": tags or []
+        }
+        data = await self.__request("POST", "droplets", body=body)
+        action_ids = [a["id"] for a in data.get("links", {}).get("actions", [])]
+        return DropletRecord.from_api(data["droplet"]), action_ids
+
+    async def destroy_droplet(self, droplet_id):
+        await self.__request("DELETE", "droplets/{}".format(droplet_id))
+
+    async def destroy_droplets_by_tag(self, tag_name):
+        # accepted at once, the droplets go away in the background
+        await self.__request("DELETE", "droplets", params={"tag_name": tag_name})
+
+    async def __droplet_action(self, droplet_id, action_type):
+        data = await self.__request("POST", "droplets/{}/actions".format(droplet_id), body={"type": action_type})
+        return ActionRecord.from_api(data["action"])
+
+    async def power_on_droplet(self, droplet_id):
+        return await self.__droplet_action(droplet_id, "power_on")
+
+    async def power_off_droplet(self, droplet_id):
+        return await self.__droplet_action(droplet_id, "power_off")
+
+    async def get_droplet_actions(self, droplet_id):
+        actions = await self.__get_all_pages("droplets/{}/actions".format(droplet_id), "actions")
+        return [ActionRecord.from_api(a) for a in actions]
+
+    async def get_action(self, action_id):
+        data = await self.__request("GET", "actions/{}".format(action_id))
+        return ActionRecord.from_api(data["action"])
+
+    async def get_all_snapshots(self):
+        snapshots = await self.__get_all_pages("snapshots", "snapshots", params={"resource_type": "droplet"})
+        return [digio.Snapshot(token=self.token, **s) for s in snapshots]
+
+    async def get_all_firewalls(self):
+        firewalls = await self.__get_all_pages("firewalls", "firewalls")
+        return [digio.Firewall(token=self.token, **f) for f in firewalls]
+
+    async def add_droplets_to_firewall(self, firewall_id, droplet_ids):
+        await self.__request("POST", "firewalls/{}/droplets".format(firewall_id), body={"droplet_ids": droplet_ids})
+
+    async def add_tags_to_firewall(self, firewall_id, tags):
+        await self.__request("POST", "firewalls/{}/tags".format(firewall_id), body={"tags": tags})
+
+    async def get_all_sshkeys(self):
+        keys = await self.__get_all_pages("account/keys", "ssh_keys")
+        return [digio.SSHKey(token=self.token, **k) for k in keys]
+
+    async def get_all_tags(self):
+        tags = await self.__get_all_pages("tags", "tags")
+        return [digio.Tag(token=self.token, **t) for t in tags]
+
+    async def get_tag(self, tag_name):
+        data = await self.__request("GET", "tags/{}".format(tag_name))
+        return digio.Tag(token=self.token, **data["tag"])
+
+    async def create_tag(self, tag_name):
+        data = await self.__request("POST", "tags", body={"name": tag_name})
+        logging.info("created tag {}".format(tag_name))
+        return digio.Tag(token=self.token, **data["tag"])
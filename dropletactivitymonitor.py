@@ -1,18 +1,38 @@
-import threading
 import asyncio
+import heapq
+import itertools
+import random
 import time
 from datetime import datetime, timedelta
-import requests
-from config import Config
-import digitalocean as digio
-from dropletapi import DropletApi
+import aiohttp
+import async_timeout
 import logging
 import traceback
-import concurrent.futures
-import backoff
+from exception import InactivityPollException
+from metrics import metrics
+
+polls_total = metrics.counter("monitor_polls_total", "Inactivity polls by result", ("result",))
+poll_seconds = metrics.histogram("monitor_poll_seconds", "Inactivity poll request latency")
+poll_lag_seconds = metrics.histogram("monitor_poll_lag_seconds", "Delay between a poll's deadline and its start")
+
+
+class MonitoredDroplet:
+    __slots__ = ("droplet", "callback", "callback_error", "deadline", "last_active_utc_raw", "failures", "finished")
+
+    def __init__(self, droplet, callback, callback_error, deadline, loop):
+        self.droplet = droplet
+        self.callback = callback
+        self.callback_error = callback_error
+        self.deadline = deadline
+        self.last_active_utc_raw = None
+        self.failures = 0
+        self.finished = loop.create_future()
+
 
 class DropletActivityMonitor:
-    def __init__(self, inactive_time_delta=timedelta(seconds=300), poll_delay_sec=60, initial_monitor_delay_sec=30, loop=None):
+    def __init__(self, inactive_time_delta=timedelta(seconds=300), poll_delay_sec=60, initial_monitor_delay_sec=30,
+                 max_concurrent_polls=10, max_poll_failures=5, request_timeout_sec=10, state_store=None,
+                 min_poll_delay_sec=5, deadline_slack_sec=1, loop=None):
         if inactive_time_delta is None:
             inactive_time_delta = timedelta(seconds=300)
         if poll_delay_sec is None:
@@ -23,68 +43,229 @@ class DropletActivityMonitor:
         self.__initial_monitor_delay_sec = initial_monitor_delay_sec
         self.__inactive_time_delta = inactive_time_delta
         self.__poll_delay_sec = poll_delay_sec
+        self.__max_concurrent_polls = max_concurrent_polls
+        self.__max_poll_failures = max_poll_failures
+        self.__request_timeout_sec = request_timeout_sec
+        self.__min_poll_delay_sec = min_poll_delay_sec
+        self.__deadline_slack_sec = deadline_slack_sec
+        self.__state_store = state_store
         self.__loop=loop if loop is not None else asyncio.get_event_loop()
+        # droplet id -> MonitoredDroplet, with a heap of (deadline, sequence, droplet id) ordering the polls
+        self.__monitored = {}
+        self.__deadlines = []
+        self.__sequence = itertools.count()
+        self.__wakeup = None
+        self.__poll_slots = None
+        self.__scheduler_task = None
+        self.__session = None
+
+    def reconfigure(self, inactive_time_delta=None, poll_delay_sec=None):
+        if inactive_time_delta is not None and inactive_time_delta != self.__inactive_time_delta:
+            self.__inactive_time_delta = inactive_time_delta
+            # deadlines derived from the old threshold move with it, earlier or later
+            for monitored in self.__monitored.values():
+                if monitored.deadline is not None and monitored.last_active_utc_raw is not None:
+                    monitored.deadline = self.__next_deadline(monitored.last_active_utc_raw)
+                    self.__push_deadline(monitored)
+        if poll_delay_sec is not None and poll_delay_sec != self.__poll_delay_sec:
+            self.__poll_delay_sec = poll_delay_sec
+            # polls scheduled under a longer interval are pulled in to the new one
+            latest_deadline = time.monotonic() + poll_delay_sec
+            for monitored in self.__monitored.values():
+                if monitored.deadline is not None and monitored.last_active_utc_raw is None and \
+                        monitored.deadline > latest_deadline:
+                    monitored.deadline = latest_deadline
+                    self.__push_deadline(monitored)
+        logging.info("monitor reconfigured: inactivity delta {0}, poll delay {1}s".format(
+            self.__inactive_time_delta, self.__poll_delay_sec))
 
-    def start_monitoring(self, droplet, callback, callback_error):
-        loop = self.__loop
-        task = loop.run_in_executor(None, self.__start_monitoring,
-                                    droplet, callback, callback_error, loop)
+    def monitored_droplet_ids(self):
+        return list(self.__monitored)
 
-        asyncio.ensure_future(task, loop=loop)
+    def is_monitoring(self, droplet_id):
+        return droplet_id in self.__monitored
 
-    def __start_monitoring(self, droplet, callback, callback_error, loop):
-        asyncio.set_event_loop(loop)
-        asyncio.run_coroutine_threadsafe(self.__start_monitoring_async(droplet, callback, callback_error), loop=loop)
+    def persist_to(self, state_store):
+        self.__state_store = state_store
+
+    def start_monitoring(self, droplet, callback, callback_error, initial_delay_sec=None):
+        return self.__schedule_monitoring(droplet, callback, callback_error, initial_delay_sec)
 
     async def start_monitoring_async(self, droplet, callback, callback_error):
-        await self.__start_monitoring_async(droplet, callback, callback_error)
+        await self.__schedule_monitoring(droplet, callback, callback_error)
 
     def start_monitoring_no_wait(self, droplet, callback, callback_error):
-        loop = self.__loop
-        coroutine = self.__start_monitoring_async(droplet, callback, callback_error)
+        self.__schedule_monitoring(droplet, callback, callback_error)
+
+    def stop_monitoring(self, droplet):
+        monitored = self.__monitored.pop(droplet.id, None)
+        if monitored is None:
+            return False
+        if not monitored.finished.done():
+            monitored.finished.set_result(False)
+        self.__forget_deadline(monitored)
+        logging.info("monitoring stopped for droplet {}".format(droplet.name))
+        return True
+
+    def __schedule_monitoring(self, droplet, callback, callback_error, initial_delay_sec=None):
+        # a droplet is only ever monitored once, restarting replaces the previous entry
+        self.stop_monitoring(droplet)
+        if initial_delay_sec is None:
+            initial_delay_sec = self.__initial_monitor_delay_sec
+        monitored = MonitoredDroplet(droplet, callback, callback_error, time.monotonic() + initial_delay_sec,
+                                     self.__loop)
+        self.__monitored[droplet.id] = monitored
+        self.__push_deadline(monitored)
+        self.__ensure_scheduler()
+        return monitored.finished
+
+    def __push_deadline(self, monitored):
+        heapq.heappush(self.__deadlines, (monitored.deadline, next(self.__sequence), monitored.droplet.id))
+        if self.__state_store is not None:
+            # stored as wall clock time so it survives a restart
+            self.__state_store.save_monitor_deadline(monitored.droplet.id,
+                                                     time.time() + monitored.deadline - time.monotonic())
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+
+    def __forget_deadline(self, monitored):
+        if self.__state_store is not None:
+            self.__state_store.remove_monitor(monitored.droplet.id)
+
+    def __ensure_scheduler(self):
+        if self.__scheduler_task is None or self.__scheduler_task.done():
+            self.__scheduler_task = asyncio.ensure_future(self.__run_scheduler(), loop=self.__loop)
 
-        asyncio.ensure_future(coroutine, loop=loop)
+    async def __run_scheduler(self):
+        self.__wakeup = asyncio.Event()
+        self.__poll_slots = asyncio.Semaphore(self.__max_concurrent_polls)
+        while True:
+            self.__wakeup.clear()
+            now = time.monotonic()
+            while len(self.__deadlines) > 0 and self.__deadlines[0][0] <= now:
+                deadline, sequence, droplet_id = heapq.heappop(self.__deadlines)
+                monitored = self.__monitored.get(droplet_id)
+                # entries that were stopped or rescheduled since are skipped
+                if monitored is None or monitored.deadline != deadline:
+                    continue
+                monitored.deadline = None
+                asyncio.ensure_future(self.__poll(monitored, deadline), loop=self.__loop)
+
+            timeout = self.__deadlines[0][0] - now if len(self.__deadlines) > 0 else None
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def __next_deadline(self, last_active_utc_raw):
+        # the droplet cannot go inactive before last active + delta, nothing is learned by polling sooner;
+        # a clock on the droplet running ahead cannot push the check past one full delta
+        delta_sec = self.__inactive_time_delta.total_seconds() + self.__deadline_slack_sec
+        now = time.monotonic()
+        until_inactive_sec = min(delta_sec, last_active_utc_raw + delta_sec - time.time())
+        return now + max(self.__min_poll_delay_sec, until_inactive_sec)
 
-    async def __start_monitoring_async(self, droplet, callback, callback_error):
-        await asyncio.sleep(self.__initial_monitor_delay_sec)
+    def __reschedule(self, monitored, delay_sec=None, deadline=None):
+        if self.__monitored.get(monitored.droplet.id) is not monitored:
+            return
+        monitored.deadline = deadline if deadline is not None else time.monotonic() + delay_sec
+        self.__push_deadline(monitored)
+
+    def __finish(self, monitored, result):
+        if self.__monitored.get(monitored.droplet.id) is monitored:
+            self.__monitored.pop(monitored.droplet.id)
+            self.__forget_deadline(monitored)
+        if not monitored.finished.done():
+            monitored.finished.set_result(result)
+
+    async def __poll(self, monitored, deadline):
+        droplet = monitored.droplet
         try:
-            await self.__monitoring_loop(droplet, callback)
+            async with self.__poll_slots:
+                poll_lag_seconds.observe(max(0.0, time.monotonic() - deadline))
+                with metrics.timer(poll_seconds):
+                    last_active_utc_raw = await self.get_last_active_time(droplet.ip_address)
         except Exception as e:
-            tb = traceback.format_exc()
-            logging.error("monitoring ended for droplet {0} due to {1} \n at {2}".format(droplet.name, e if len(e.args) == 0 else e.args[0], tb))
-            await callback_error(e, droplet)
-            pass
-
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-    async def __monitoring_loop(self, droplet, callback):
-        continue_loop = True
-        while True:
-            last_active_utc_raw = await self.get_last_active_time(droplet.ip_address)
+            polls_total.inc(result="error")
+            monitored.failures += 1
+            if monitored.failures < self.__max_poll_failures:
+                # jittered so droplets that failed together do not retry together
+                delay_sec = min(self.__poll_delay_sec, 2 ** monitored.failures)
+                delay_sec = random.uniform(delay_sec / 2.0, delay_sec)
+                logging.warning("poll for droplet {0} failed ({1}), retrying in {2:.1f}s".format(
+                    droplet.name, e if len(e.args) == 0 else e.args[0], delay_sec))
+                self.__reschedule(monitored, delay_sec)
+                return
+            await self.__end_with_error(monitored, e)
+            return
+
+        monitored.failures = 0
+        if self.__monitored.get(droplet.id) is not monitored:
+            return
+        if last_active_utc_raw is not None:
+            monitored.last_active_utc_raw = last_active_utc_raw
+        try:
+            continue_monitoring = True
+            inactive = False
             if last_active_utc_raw is not None:
                 last_active_utc_time = datetime.utcfromtimestamp(last_active_utc_raw)
                 now_utc = datetime.utcfromtimestamp(time.time())
                 delta_utc = now_utc - last_active_utc_time
                 logging.info("checking for inactivity at {0} : delta {1}".format(now_utc, delta_utc))
-                if delta_utc > self.__inactive_time_delta:
-                    continue_loop = await callback(last_active_utc_time, droplet)
+                inactive = delta_utc > self.__inactive_time_delta
+            polls_total.inc(result="inactive" if inactive else "active")
+            if inactive:
+                continue_monitoring = await monitored.callback(last_active_utc_time, droplet)
+        except Exception as e:
+            await self.__end_with_error(monitored, e)
+            return
 
-            if not continue_loop:
-                break
+        if not continue_monitoring:
+            self.__finish(monitored, True)
+        elif last_active_utc_raw is not None and not inactive:
+            self.__reschedule(monitored, deadline=self.__next_deadline(last_active_utc_raw))
+        else:
+            # nothing reported yet, or kept running past the threshold, check back on the regular interval
+            self.__reschedule(monitored, self.__poll_delay_sec)
 
-            await asyncio.sleep(self.__poll_delay_sec)
+    async def __end_with_error(self, monitored, e):
+        droplet = monitored.droplet
+        if self.__monitored.get(droplet.id) is not monitored:
+            return
+        self.__finish(monitored, False)
+        tb = traceback.format_exc()
+        logging.error("monitoring ended for droplet {0} due to {1} \n at {2}".format(droplet.name, e if len(e.args) == 0 else e.args[0], tb))
+        try:
+            await monitored.callback_error(e, droplet)
+        except Exception as callback_e:
+            logging.error("monitoring error callback failed for droplet {0}: {1}".format(
+                droplet.name, callback_e if len(callback_e.args) == 0 else callback_e.args[0]))
+
+    def __get_session(self):
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(limit=self.__max_concurrent_polls, loop=self.__loop)
+            self.__session = aiohttp.ClientSession(connector=connector, loop=self.__loop)
+        return self.__session
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=5)
     async def get_last_active_time(self, ip):
-        loop = self.__loop
         url = "http://{}/last_active_time".format(ip)
-        task = loop.run_in_executor(None, requests.get,
-                                    url)
-
-        r = await asyncio.ensure_future(task, loop=loop)
-        r.raise_for_status()
-        json_obj = r.json()
+        session = self.__get_session()
+        with async_timeout.timeout(self.__request_timeout_sec, loop=self.__loop):
+            async with session.get(url) as r:
+                if r.status != 200:
+                    raise InactivityPollException("{} returned status {}".format(url, r.status))
+                json_obj = await r.json()
         str_time = json_obj["last_active_time"]
         if str_time is not None:
             return float(str_time)
         return str_time
 
+    async def close(self):
+        if self.__scheduler_task is not None:
+            self.__scheduler_task.cancel()
+            self.__scheduler_task = None
+        if self.__session is not None and not self.__session.closed:
+            closing = self.__session.close()
+            if asyncio.iscoroutine(closing) or isinstance(closing, asyncio.Future):
+                await closing
+        self.__session = None
@@ -1,32 +1,246 @@
-import digitalocean as digio
-from digitalocean.baseapi import NotFoundError
-import threading
 from config import Config
-from exception import LockedDropletException, MissingFirewallException, MissingSnapshotException, \
-    MissingDropletException, DropletBootFailedException
+from digitaloceanclient import DigitalOceanClient
+from resourcecache import DropletResourceCache
+from statuscache import StatusCache
+from sharedboot import SharedBoot
+from bootpoller import AdaptiveBootPoller, BootTimeModel
+from standbypool import StandbyPool
+from statestore import StateStore
+from prebootscheduler import PrebootScheduler
+from metrics import metrics
+from apibudget import ApiPriority
+from exception import MissingFirewallException, MissingSnapshotException, \
+    MissingDropletException, DigitalOceanNotFoundException, DigitalOceanApiException, ApiBudgetExhaustedException, \
+    DropletBootFailedException
 import asyncio
 import logging
+import time
+import traceback
+
+operation_seconds = metrics.histogram("dropletapi_operation_seconds", "DropletApi operation latency", ("operation",))
+boot_phase_seconds = metrics.histogram("dropletapi_boot_phase_seconds", "Droplet boot phase latency", ("phase",))
 
 
 class DropletApi:
-    __droplet_sem = threading.Semaphore()
+    __pending_boots = {}
+    __tag_locks = {}
     __existing_droplets = None
+    __resource_cache = None
+    __status_cache = None
+    __boot_time_model = BootTimeModel()
+    __standby_pool = None
+    __state_store = None
+    __placement = None
+    __preboot_scheduler = None
+    # tag -> ids of droplets deleted by tag that digitalocean has not removed yet
+    __tearing_down = {}
 
     @staticmethod
     def track_single_droplets():
         DropletApi.__existing_droplets = {}
 
     @staticmethod
-    def check_existing_droplet(manager, tag_name):
-        droplets = manager.get_all_droplets(tag_name=tag_name)
+    def cache_resources(do_client, ttl_sec=300, refresh_interval_sec=None, loop=None):
+        DropletApi.__resource_cache = DropletResourceCache(do_client, ttl_sec=ttl_sec,
+                                                           refresh_interval_sec=refresh_interval_sec, loop=loop)
+        return DropletApi.__resource_cache
+
+    @staticmethod
+    def __invalidate_resources(*resource_names):
+        # a listing that no longer matches the account is dropped so the next lookup lists afresh
+        if DropletApi.__resource_cache is not None:
+            for resource_name in resource_names:
+                getattr(DropletApi.__resource_cache, resource_name).invalidate()
+
+    @staticmethod
+    def __rejected_resources(e):
+        # digitalocean refuses a create naming a deleted or replaced image or key with a 422 that names the field
+        if e.status != 422:
+            return ()
+        message = str(e.payload or "").lower()
+        return tuple(resource_name for resource_name, words in (("snapshots", ("image", "snapshot")),
+                                                                 ("ssh_keys", ("ssh",)))
+                     if any(word in message for word in words))
+
+    @staticmethod
+    def resource_cache():
+        return DropletApi.__resource_cache
+
+    @staticmethod
+    def boot_time_model():
+        return DropletApi.__boot_time_model
+
+    @staticmethod
+    def keep_warm_standby(do_client, max_idle_sec=3600, pool_size=1, loop=None):
+        DropletApi.__standby_pool = StandbyPool(do_client, max_idle_sec=max_idle_sec, pool_size=pool_size, loop=loop)
+        if DropletApi.__state_store is not None:
+            DropletApi.__standby_pool.persist_to(DropletApi.__state_store)
+        return DropletApi.__standby_pool
+
+    @staticmethod
+    def standby_pool():
+        return DropletApi.__standby_pool
+
+    @staticmethod
+    def place_droplets(placement):
+        DropletApi.__placement = placement
+        return placement
+
+    @staticmethod
+    def placement():
+        return DropletApi.__placement
+
+    @staticmethod
+    def schedule_preboots(preboot_scheduler):
+        DropletApi.__preboot_scheduler = preboot_scheduler
+        if DropletApi.__state_store is not None:
+            preboot_scheduler.persist_to(DropletApi.__state_store)
+        return preboot_scheduler
+
+    @staticmethod
+    def preboot_scheduler():
+        return DropletApi.__preboot_scheduler
+
+    @staticmethod
+    def persist_state(state_store):
+        DropletApi.__state_store = state_store
+        DropletApi.__boot_time_model.persist_to(state_store)
+        if DropletApi.__standby_pool is not None:
+            DropletApi.__standby_pool.persist_to(state_store)
+        if DropletApi.__preboot_scheduler is not None:
+            DropletApi.__preboot_scheduler.persist_to(state_store)
+
+    @staticmethod
+    def rehydrate(do_client, inactivity_monitor=None, loop=None):
+        # rebuild the registry, standby pool and monitors from the store instead of scanning the account
+        state_store = DropletApi.__state_store
+        if state_store is None:
+            return 0
+
+        monitor_deadlines = state_store.load_monitor_deadlines()
+        now = time.time()
+        resumed_boots = []
+        stored_droplets = state_store.load_droplets()
+        for stored in stored_droplets:
+            if stored.state == StateStore.STANDBY:
+                if DropletApi.__standby_pool is not None and stored.id is not None:
+                    DropletApi.__standby_pool.adopt(stored.id, stored.name, stored.updated_time, stored.tag_name)
+                continue
+
+            if stored.state == StateStore.BOOTING and stored.id is None:
+                # the bot stopped before the create answered, tracking the name would make every turn on wait
+                # for a droplet that may never have existed, so the tag is looked up afresh instead
+                DropletApi.__forget_droplet_state(stored.name)
+                continue
+
+            DropletApi.__track_droplet(stored.tag_name, stored.name)
+            if stored.state == StateStore.ACTIVE and stored.ip_address is not None and inactivity_monitor is not None:
+                initial_delay_sec = max(0.0, monitor_deadlines[stored.id] - now) \
+                    if stored.id in monitor_deadlines else None
+                DropletApi.__start_inactivity_monitor(do_client, stored.record(), None, inactivity_monitor,
+                                                      initial_delay_sec)
+            elif stored.state == StateStore.BOOTING and stored.id is not None:
+                resumed_boots.append(stored)
+
+        if len(resumed_boots) > 0:
+            asyncio.ensure_future(DropletApi.__resume_boots(do_client, resumed_boots, inactivity_monitor), loop=loop)
+
+        logging.info("rehydrated {0} droplet(s), resuming {1} boot(s)".format(len(stored_droplets),
+                                                                              len(resumed_boots)))
+        return len(stored_droplets)
+
+    @staticmethod
+    async def __resume_boots(do_client, stored_droplets, inactivity_monitor, max_attempts=60, attempt_delay_sec=10):
+        for stored in stored_droplets:
+            try:
+                for attempt in range(max_attempts):
+                    droplet = await do_client.get_droplet(stored.id)
+                    if droplet.status == "active" and droplet.ip_address is not None:
+                        DropletApi.__save_droplet_state(stored.tag_name, droplet, StateStore.ACTIVE)
+                        DropletApi.__start_inactivity_monitor(do_client, droplet, None, inactivity_monitor)
+                        break
+                    await asyncio.sleep(attempt_delay_sec)
+            except DigitalOceanNotFoundException:
+                DropletApi.__untrack_droplet(stored.name)
+                DropletApi.__forget_droplet_state(stored.name)
+            except Exception as e:
+                logging.error("could not resume boot of droplet {0}: {1}".format(
+                    stored.name, e if len(e.args) == 0 else e.args[0]))
+
+    @staticmethod
+    def __save_droplet_state(tag_name, droplet, state):
+        if DropletApi.__state_store is not None:
+            DropletApi.__state_store.save_droplet(droplet.name, tag_name, state, droplet_id=droplet.id,
+                                                  ip_address=droplet.ip_address,
+                                                  region=droplet.region)
+
+    @staticmethod
+    def __forget_droplet_state(droplet_name):
+        if DropletApi.__state_store is not None:
+            DropletApi.__state_store.remove_droplet(droplet_name)
+
+    @staticmethod
+    def cache_status(do_client, fresh_sec=10, max_stale_sec=120, loop=None):
+        async def __fetch_status(tag_name):
+            return await DropletApi.check_single_droplet_status(do_client, tag_name)
+
+        DropletApi.__status_cache = StatusCache(__fetch_status, fresh_sec=fresh_sec, max_stale_sec=max_stale_sec,
+                                                cached_exceptions=(MissingDropletException,),
+                                                fallback_exceptions=(ApiBudgetExhaustedException,), loop=loop)
+        return DropletApi.__status_cache
+
+    @staticmethod
+    def __invalidate_status(tag_name=None):
+        if DropletApi.__status_cache is not None:
+            DropletApi.__status_cache.invalidate(tag_name)
+
+    @staticmethod
+    def __tag_lock(tag_name):
+        # one lock per stream profile tag, so one guild booting never holds up another
+        if tag_name not in DropletApi.__tag_locks:
+            DropletApi.__tag_locks[tag_name] = asyncio.Lock()
+        return DropletApi.__tag_locks[tag_name]
+
+    @staticmethod
+    def __is_tracked(tag_name, droplet_name):
+        return DropletApi.__existing_droplets is not None and \
+            droplet_name in DropletApi.__existing_droplets.get(tag_name, {})
+
+    @staticmethod
+    def __track_droplet(tag_name, droplet_name):
+        if DropletApi.__existing_droplets is not None:
+            DropletApi.__existing_droplets.setdefault(tag_name, {})[droplet_name] = droplet_name
+
+    @staticmethod
+    def __untrack_droplet(droplet_name):
+        if DropletApi.__existing_droplets is not None:
+            for tag_droplets in DropletApi.__existing_droplets.values():
+                tag_droplets.pop(droplet_name, None)
+
+    @staticmethod
+    def tracked_droplets(tag_name):
+        if DropletApi.__existing_droplets is None:
+            return []
+        return list(DropletApi.__existing_droplets.get(tag_name, {}))
+
+    @staticmethod
+    @metrics.timed(operation_seconds, operation="check_existing_droplet")
+    async def check_existing_droplet(do_client, tag_name):
+        # powered off droplets are warm standbys, not running streams
+        droplets = await do_client.get_all_droplets(tag_name=tag_name)
+        droplets = [d for d in DropletApi.__live_droplets(tag_name, droplets) if not DropletApi.__is_standby(d)]
         if len(droplets) is 0:
             return None
 
         return droplets[0]
 
     @staticmethod
-    def get_droplet_snapshot(manager, snapshot_name):
-        snapshots = manager.get_all_snapshots()
+    @metrics.timed(operation_seconds, operation="get_droplet_snapshot")
+    async def get_droplet_snapshot(do_client, snapshot_name):
+        if DropletApi.__resource_cache is not None:
+            return await DropletApi.__resource_cache.snapshots.get(snapshot_name)
+
+        snapshots = await do_client.get_all_snapshots()
         snapshot = [s for s in snapshots if s.name == snapshot_name]
         if len(snapshot) is 0:
             return None
@@ -34,8 +248,12 @@ class DropletApi:
         return snapshot[0]
 
     @staticmethod
-    def get_droplet_firewall(manager, firewall_name):
-        firewalls = manager.get_all_firewalls()
+    @metrics.timed(operation_seconds, operation="get_droplet_firewall")
+    async def get_droplet_firewall(do_client, firewall_name):
+        if DropletApi.__resource_cache is not None:
+            return await DropletApi.__resource_cache.firewalls.get(firewall_name)
+
+        firewalls = await do_client.get_all_firewalls()
         firewall = [f for f in firewalls if f.name == firewall_name]
         if len(firewall) is 0:
             return None
@@ -43,138 +261,474 @@ class DropletApi:
         return firewall[0]
 
     @staticmethod
-    def destroy_tagged_droplets(manager, tag_name):
-        droplets = manager.get_all_droplets(tag_name=tag_name)
+    @metrics.timed(operation_seconds, operation="destroy_tagged_droplets")
+    @ApiPriority.prioritized(ApiPriority.TEARDOWN)
+    async def destroy_tagged_droplets(do_client, tag_name, inactivity_monitor=None, progress_callback=None):
+        async with DropletApi.__tag_lock(tag_name):
+            droplets = DropletApi.__live_droplets(tag_name, await do_client.get_all_droplets(tag_name=tag_name))
+            if DropletApi.__standby_pool is not None:
+                # parked droplets share the tag, so a delete by tag would take the standby pool with it
+                droplets = [d for d in droplets if not DropletApi.__standby_pool.contains(d.id)]
+                for droplet in droplets:
+                    if inactivity_monitor is not None:
+                        inactivity_monitor.stop_monitoring(droplet)
+                    await DropletApi.__retire_droplet(do_client, droplet)
+                DropletApi.__invalidate_status(tag_name)
+                return droplets
+
+            if len(droplets) == 0:
+                return droplets
+
+            # one delete for the whole tag; the registry, the store and the monitors are only cleared once it is
+            # accepted, all without yielding so nothing observes a half torn down stream, and a refused delete
+            # leaves the droplets monitored and tracked
+            await do_client.destroy_droplets_by_tag(tag_name)
+            droplet_ids = set(d.id for d in droplets)
+            DropletApi.__tearing_down.setdefault(tag_name, set()).update(droplet_ids)
+            for droplet in droplets:
+                if inactivity_monitor is not None:
+                    inactivity_monitor.stop_monitoring(droplet)
+                DropletApi.__untrack_droplet(droplet.name)
+                DropletApi.__forget_droplet_state(droplet.name)
+            DropletApi.__invalidate_status(tag_name)
+
+            confirmation = asyncio.ensure_future(DropletApi.__confirm_teardown(do_client, tag_name, droplets,
+                                                                               progress_callback))
+            metrics.share_trace(confirmation)
+            ApiPriority.share(confirmation)
+            return droplets
 
-        for droplet in droplets:
-            droplet.destroy()
-            if DropletApi.__existing_droplets is not None and droplet.name in DropletApi.__existing_droplets:
-                DropletApi.__existing_droplets.pop(droplet.name)
+    @staticmethod
+    async def __confirm_teardown(do_client, tag_name, droplets, progress_callback, max_attempts=12,
+                                 attempt_delay_sec=5):
+        droplet_ids = set(d.id for d in droplets)
+        remaining = droplets
+        try:
+            for attempt in range(max_attempts):
+                await asyncio.sleep(attempt_delay_sec)
+                try:
+                    remaining = [d for d in await do_client.get_all_droplets(tag_name=tag_name)
+                                 if d.id in droplet_ids]
+                except Exception as e:
+                    logging.warning("could not confirm teardown of {0}: {1}".format(
+                        tag_name, e if len(e.args) == 0 else e.args[0]))
+                    continue
+                if len(remaining) == 0:
+                    logging.info("confirmed teardown of {0} droplet(s) tagged {1}".format(len(droplets), tag_name))
+                    return
+
+            names = ", ".join(d.name for d in remaining)
+            logging.error("droplet(s) {0} tagged {1} are still up after the delete".format(names, tag_name))
+            if progress_callback is not None:
+                await progress_callback("droplet(s) {} may still be running, turn the stream off again or "
+                                        "remove them by hand".format(names))
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.error("teardown confirmation of {0} failed due to {1} \n at {2}".format(
+                tag_name, e if len(e.args) == 0 else e.args[0], tb))
+        finally:
+            DropletApi.__finish_teardown(tag_name, droplet_ids)
+            DropletApi.__invalidate_status(tag_name)
 
-        return droplets
+    @staticmethod
+    def __finish_teardown(tag_name, droplet_ids):
+        tearing_down = DropletApi.__tearing_down.get(tag_name)
+        if tearing_down is not None:
+            tearing_down.difference_update(droplet_ids)
+            if len(tearing_down) == 0:
+                DropletApi.__tearing_down.pop(tag_name)
 
     @staticmethod
-    def create_or_get_tag(manager, tag_name):
-        tag = digio.Tag(token=manager.token, name=tag_name)
+    def __live_droplets(tag_name, droplets):
+        # droplets deleted by tag keep showing up in listings until digitalocean gets to them
+        tearing_down = DropletApi.__tearing_down.get(tag_name)
+        if tearing_down is None:
+            return droplets
+        return [d for d in droplets if d.id not in tearing_down]
+
+    @staticmethod
+    def __is_standby(droplet):
+        # parked droplets report active for a while after the power off, they are standbys all the same
+        return droplet.status == "off" or \
+            (DropletApi.__standby_pool is not None and DropletApi.__standby_pool.contains(droplet.id))
+
+    @staticmethod
+    async def __retire_droplet(do_client, droplet):
+        if DropletApi.__standby_pool is not None:
+            await DropletApi.__standby_pool.park(droplet)
+            if DropletApi.__state_store is not None:
+                DropletApi.__state_store.set_droplet_state(droplet.name, StateStore.STANDBY)
+        else:
+            await DropletApi.__destroy_droplet(do_client, droplet)
+            DropletApi.__forget_droplet_state(droplet.name)
+        DropletApi.__untrack_droplet(droplet.name)
+
+    @staticmethod
+    async def __destroy_droplet(do_client, droplet):
+        # a droplet removed outside the bot is already where the destroy would leave it
         try:
-            tag.load()
-        except NotFoundError:
-            tag.create()
+            await do_client.destroy_droplet(droplet.id)
+        except DigitalOceanNotFoundException:
+            logging.info("droplet {} was already gone".format(droplet.name))
+
+    @staticmethod
+    @metrics.timed(operation_seconds, operation="get_ssh_keys")
+    async def get_ssh_keys(do_client):
+        if DropletApi.__resource_cache is not None:
+            return await DropletApi.__resource_cache.ssh_keys.get_all()
+
+        return await do_client.get_all_sshkeys()
+
+    @staticmethod
+    async def create_or_get_tag(do_client, tag_name):
+        try:
+            tag = await do_client.get_tag(tag_name)
+        except DigitalOceanNotFoundException:
+            tag = await do_client.create_tag(tag_name)
 
-        print(manager.get_all_tags())
-        print(tag.name)
         return tag
 
     @staticmethod
-    def check_single_droplet_status(manager, tag_name):
-        droplet = DropletApi.check_existing_droplet(manager, tag_name)
+    @metrics.timed(operation_seconds, operation="check_single_droplet_status")
+    @ApiPriority.prioritized(ApiPriority.STATUS)
+    async def check_single_droplet_status(do_client, tag_name):
+        droplet = await DropletApi.check_existing_droplet(do_client, tag_name)
         if droplet is None:
             raise MissingDropletException("there are no droplets tagged with {}".format(tag_name))
 
-        actions = droplet.get_actions()
-        for action in actions:
-            action.load()
+        actions = await do_client.get_droplet_actions(droplet.id)
 
         return droplet, actions
 
     @staticmethod
-    async def __poll_existing_droplet_or_timeout(manager, tag_name, max_attempts=10, attempt_delay_sec=1):
+    @metrics.timed(operation_seconds, operation="get_single_droplet_status")
+    @ApiPriority.prioritized(ApiPriority.STATUS)
+    async def get_single_droplet_status(do_client, tag_name):
+        if DropletApi.__status_cache is not None:
+            return await DropletApi.__status_cache.get(tag_name)
+
+        return await DropletApi.check_single_droplet_status(do_client, tag_name)
+
+    @staticmethod
+    async def __poll_existing_droplet_or_timeout(do_client, tag_name, max_attempts=10, attempt_delay_sec=1):
         attempts = 0
         while attempts < max_attempts:
             await asyncio.sleep(attempt_delay_sec)
-            droplet = DropletApi.check_existing_droplet(manager, tag_name)
+            droplet = await DropletApi.check_existing_droplet(do_client, tag_name)
             if droplet is not None:
                 return droplet
             attempts += 1
         return None
 
     @staticmethod
-    async def create_or_get_single_droplet_from_snapshot(manager, tag_name, snapshot_name, firewall_name=None,
-                                                         progress_callback=None, inactivity_monitor=None):
-        droplet_name = "{}-{}".format(snapshot_name, tag_name)
+    @metrics.timed(operation_seconds, operation="create_or_get_single_droplet_from_snapshot")
+    @ApiPriority.prioritized(ApiPriority.BOOT)
+    async def create_or_get_single_droplet_from_snapshot(do_client, tag_name, snapshot_name, firewall_name=None,
+                                                         progress_callback=None, inactivity_monitor=None,
+                                                         region_hints=None, region_rtt_ms=None):
+        # concurrent requests for a tag attach to the boot already in flight instead of starting another;
+        # checking and registering happen without an await, the boot itself runs under the tag's lock
+        shared_boot = DropletApi.__pending_boots.get(tag_name)
+        if shared_boot is None or shared_boot.done():
+            shared_boot = SharedBoot("{}-{}".format(snapshot_name, tag_name))
+            DropletApi.__pending_boots[tag_name] = shared_boot
+            boot = shared_boot.start(DropletApi.__create_or_get_single_droplet_from_snapshot(
+                do_client, tag_name, snapshot_name, firewall_name, shared_boot.progress_callback, inactivity_monitor,
+                region_hints, region_rtt_ms))
+            boot.add_done_callback(lambda f: DropletApi.__finish_pending_boot(tag_name, shared_boot))
+            metrics.share_trace(boot)
+            ApiPriority.share(boot)
+
+        droplet = await shared_boot.attach(progress_callback)
+        # droplets booted without a monitor, like preboots, are only watched once somebody claims them
+        if inactivity_monitor is not None and droplet.ip_address is not None and \
+                not inactivity_monitor.is_monitoring(droplet.id):
+            DropletApi.__start_inactivity_monitor(do_client, droplet, progress_callback, inactivity_monitor)
+        return droplet
+
+    @staticmethod
+    def __finish_pending_boot(tag_name, shared_boot):
+        if DropletApi.__pending_boots.get(tag_name) is shared_boot:
+            DropletApi.__pending_boots.pop(tag_name)
+
+    @staticmethod
+    async def __create_or_get_single_droplet_from_snapshot(do_client, tag_name, snapshot_name, firewall_name,
+                                                           progress_callback, inactivity_monitor, region_hints,
+                                                           region_rtt_ms):
+        # the lock covers the lookups and the create or power on, not the wait for the boot, so a teardown sent
+        # meanwhile goes through at once instead of queueing behind a boot of up to ten minutes
+        async with DropletApi.__tag_lock(tag_name):
+            droplet, boot_wait = await DropletApi.__create_or_get_single_droplet_locked(
+                do_client, tag_name, snapshot_name, firewall_name, progress_callback, inactivity_monitor,
+                region_hints, region_rtt_ms)
+        if boot_wait is None:
+            return droplet
+        return await boot_wait
 
-        if not DropletApi.__droplet_sem.acquire(blocking=False):
-            raise LockedDropletException("droplet {} is already being created.".format(droplet_name))
+    @staticmethod
+    async def __run_stage(stage, timings, coroutine):
+        timer = metrics.timer(boot_phase_seconds, phase=stage)
         try:
-            droplet = DropletApi.check_existing_droplet(manager, tag_name)
-            if droplet is not None:
-                return droplet
+            with timer:
+                return await coroutine
+        finally:
+            timings[stage] = timer.elapsed_sec
 
-            if DropletApi.__existing_droplets is not None and droplet_name in DropletApi.__existing_droplets:
-                droplet = await DropletApi.__poll_existing_droplet_or_timeout(manager, tag_name)
-                if droplet is not None:
-                    return droplet
-                raise MissingDropletException("droplet {} could not be located".format(droplet_name))
+    @staticmethod
+    async def __tag_firewall(do_client, firewall_name, tag_name, droplet_lookup):
+        # droplets join the firewall through their tag the moment they are created, no attach call per droplet
+        firewall = await DropletApi.get_droplet_firewall(do_client, firewall_name)
+        if firewall is None or tag_name in (getattr(firewall, "tags", None) or []):
+            return firewall
+        if not await DropletApi.__needs_create(tag_name, droplet_lookup):
+            return firewall
+
+        await DropletApi.create_or_get_tag(do_client, tag_name)
+        await do_client.add_tags_to_firewall(firewall.id, [tag_name])
+        firewall.tags = list(getattr(firewall, "tags", None) or []) + [tag_name]
+        logging.info("firewall {0} now covers tag {1}".format(firewall_name, tag_name))
+        return firewall
 
-            snapshot = DropletApi.get_droplet_snapshot(manager, snapshot_name)
-            if snapshot is None:
-                raise MissingSnapshotException("snapshot {} is missing".format(snapshot_name))
+    @staticmethod
+    async def __lookup_snapshot(do_client, snapshot_name, tag_name, droplet_lookup, timings):
+        # round trips to the snapshot's regions are probed as soon as they are known and a create is certain
+        snapshot = await DropletApi.get_droplet_snapshot(do_client, snapshot_name)
+        if snapshot is not None and DropletApi.__placement is not None and \
+                await DropletApi.__needs_create(tag_name, droplet_lookup):
+            await DropletApi.__run_stage("region_probe", timings,
+                                         DropletApi.__placement.measure(tag_name, snapshot.regions))
+        return snapshot
 
-            ssh_keys = manager.get_all_sshkeys()
+    @staticmethod
+    async def __needs_create(tag_name, droplet_lookup):
+        # the create-only stages wait for the droplet lookup, a stream already running needs neither of them
+        try:
+            droplets = await asyncio.shield(droplet_lookup)
+        except Exception:
+            return False
+        return all(DropletApi.__is_standby(d) for d in DropletApi.__live_droplets(tag_name, droplets))
 
-            region_name = snapshot.regions[0]
+    @staticmethod
+    def __rank_regions(tag_name, snapshot, region_hints, region_rtt_ms):
+        if DropletApi.__placement is None:
+            return list(snapshot.regions)
+        return DropletApi.__placement.rank(tag_name, snapshot.regions, region_hints, region_rtt_ms)
 
-            droplet = digio.Droplet(
-                token=manager.token,
-                name=droplet_name,
-                region=region_name,
-                image=snapshot.id,
-                ssh_keys=ssh_keys,
-                size_slug='2gb',
-                tags=[tag_name]
-            )
+    @staticmethod
+    async def __create_in_best_region(do_client, droplet_name, tag_name, snapshot, ssh_keys, regions,
+                                      progress_callback):
+        # a region that cannot take the droplet right now falls through to the next best one
+        for attempt, region_name in enumerate(regions):
+            try:
+                droplet, action_ids = await do_client.create_droplet(name=droplet_name,
+                                                                     region=region_name,
+                                                                     image=snapshot.id,
+                                                                     ssh_keys=ssh_keys,
+                                                                     size_slug='2gb',
+                                                                     tags=[tag_name])
+                return droplet, action_ids, region_name
+            except DigitalOceanApiException as e:
+                DropletApi.__invalidate_resources(*DropletApi.__rejected_resources(e))
+                # anything but the region being unavailable would fail the same way everywhere else
+                if not DropletApi.__region_unavailable(e):
+                    raise
+                if DropletApi.__placement is not None:
+                    DropletApi.__placement.record_failure(region_name)
+                if attempt == len(regions) - 1:
+                    raise
+                logging.warning("creating droplet {0} in {1} failed ({2}), trying {3}".format(
+                    droplet_name, region_name, e if len(e.args) == 0 else e.args[0], regions[attempt + 1]))
+                if progress_callback is not None:
+                    await progress_callback("region {0} is unavailable, trying {1}".format(
+                        region_name, regions[attempt + 1]))
 
-            if progress_callback is not None:
-                await progress_callback("preparing to turn on droplet {}".format(droplet_name))
+    @staticmethod
+    def __region_unavailable(e):
+        # digitalocean answers a region out of capacity with a 422 naming the region or size, or fails with a 5xx
+        if e.status is not None and e.status >= 500:
+            return True
+        message = str(e.payload or "").lower()
+        return e.status == 422 and "available" in message and ("region" in message or "size" in message)
 
-            if DropletApi.__existing_droplets is not None and droplet.name not in DropletApi.__existing_droplets:
-                DropletApi.__existing_droplets[droplet.name] = droplet.name
+    @staticmethod
+    def __stage_result(result):
+        if isinstance(result, BaseException):
+            raise result
+        return result
 
-            droplet.create()
+    @staticmethod
+    async def __create_or_get_single_droplet_locked(do_client, tag_name, snapshot_name, firewall_name,
+                                                    progress_callback, inactivity_monitor, region_hints=None,
+                                                    region_rtt_ms=None):
+        droplet_name = "{}-{}".format(snapshot_name, tag_name)
+        timings = {}
+        run_stage = DropletApi.__run_stage
+
+        # every lookup the create depends on runs at once, a failure only matters if its result is needed;
+        # the region probe and the firewall tagging hold off until the droplet lookup shows nothing is running
+        droplet_lookup = asyncio.ensure_future(run_stage("droplet_lookup", timings,
+                                                         do_client.get_all_droplets(tag_name=tag_name)))
+        lookups = [droplet_lookup,
+                   run_stage("snapshot_lookup", timings,
+                             DropletApi.__lookup_snapshot(do_client, snapshot_name, tag_name, droplet_lookup, timings)),
+                   run_stage("ssh_key_lookup", timings, DropletApi.get_ssh_keys(do_client))]
+        if firewall_name is not None:
+            lookups.append(run_stage("firewall_tag", timings,
+                                     DropletApi.__tag_firewall(do_client, firewall_name, tag_name, droplet_lookup)))
+        results = await run_stage("lookups", timings, asyncio.gather(*lookups, return_exceptions=True))
+
+        droplets = DropletApi.__live_droplets(tag_name, DropletApi.__stage_result(results[0]))
+        running_droplets = [d for d in droplets if not DropletApi.__is_standby(d)]
+        if len(running_droplets) > 0:
+            return running_droplets[0], None
+
+        if DropletApi.__is_tracked(tag_name, droplet_name):
+            droplet = await DropletApi.__poll_existing_droplet_or_timeout(do_client, tag_name)
+            if droplet is not None:
+                return droplet, None
+            raise MissingDropletException("droplet {} could not be located".format(droplet_name))
 
-            # tag = create_or_get_tag(tag_name)
-            # if tag is None:
-            #     return None #exception
+        if firewall_name is not None and DropletApi.__stage_result(results[3]) is None:
+            DropletApi.__invalidate_resources("firewalls")
+            raise MissingFirewallException("firewall {} is missing".format(firewall_name))
 
-            # tag.add_droplets([droplet.id])
+        # the ones already off first, a droplet parked moments ago may still be shutting down
+        standby_droplets = sorted((d for d in droplets if DropletApi.__is_standby(d)), key=lambda d: d.status != "off")
+        if len(standby_droplets) > 0:
+            return await DropletApi.__power_on_standby_droplet(do_client, standby_droplets[0], tag_name, snapshot_name,
+                                                               progress_callback, inactivity_monitor)
 
-            if firewall_name is not None:
-                firewall = DropletApi.get_droplet_firewall(manager, firewall_name)
-                if firewall is None:
-                    raise MissingFirewallException("firewall {} is missing".format(firewall_name))
-                firewall.add_droplets([droplet.id])
+        snapshot = DropletApi.__stage_result(results[1])
+        if snapshot is None:
+            DropletApi.__invalidate_resources("snapshots")
+            raise MissingSnapshotException("snapshot {} is missing".format(snapshot_name))
+        ssh_keys = DropletApi.__stage_result(results[2])
 
-            actions = droplet.get_actions()
-            complete = False
-            final_status = "no-status"
-            while not complete:
-                for action in actions:
-                    action.load()
-                    # Once it shows complete, droplet is up and running
-                    if action.status is not 'in-progress':
-                        complete = True
-                        final_status = action.status
-                await asyncio.sleep(1)
+        regions = DropletApi.__rank_regions(tag_name, snapshot, region_hints, region_rtt_ms)
 
-            if final_status is "errored":
-                raise DropletBootFailedException("droplet {} failed to turn on".format(droplet_name))
+        if progress_callback is not None:
+            await progress_callback("preparing to turn on droplet {}".format(droplet_name))
 
-            droplet.load()
+        DropletApi.__track_droplet(tag_name, droplet_name)
+        if DropletApi.__state_store is not None:
+            DropletApi.__state_store.save_droplet(droplet_name, tag_name, StateStore.BOOTING)
 
-            if inactivity_monitor is not None:
-                inactivity_monitor.start_monitoring(droplet,
-                                                    DropletApi.destroy_droplet_callback(progress_callback),
-                                                    DropletApi.destroy_droplet_callback_errored(progress_callback))
+        create_time = time.perf_counter()
+        try:
+            droplet, action_ids, region_name = await run_stage("create", timings, DropletApi.__create_in_best_region(
+                do_client, droplet_name, tag_name, snapshot, ssh_keys, regions, progress_callback))
+        except Exception:
+            DropletApi.__untrack_droplet(droplet_name)
+            DropletApi.__forget_droplet_state(droplet_name)
+            raise
+        DropletApi.__save_droplet_state(tag_name, droplet, StateStore.BOOTING)
+        DropletApi.__invalidate_status(tag_name)
+
+        return droplet, DropletApi.__wait_for_created_droplet(do_client, droplet, action_ids, tag_name, snapshot_name,
+                                                              region_name, progress_callback, inactivity_monitor,
+                                                              create_time, timings)
 
-            return droplet
+    @staticmethod
+    async def __wait_for_created_droplet(do_client, droplet, action_ids, tag_name, snapshot_name, region_name,
+                                         progress_callback, inactivity_monitor, create_time, timings):
+        try:
+            boot_poller = AdaptiveBootPoller(do_client, DropletApi.__boot_time_model)
+            await DropletApi.__run_stage("active", timings, boot_poller.wait_for_boot(
+                droplet.name, action_ids, snapshot_name, region_name, progress_callback, start_time=create_time))
+
+            return await DropletApi.__finish_boot(do_client, droplet, tag_name, progress_callback,
+                                                  inactivity_monitor)
+        finally:
+            logging.info("boot pipeline for {0}: {1}".format(droplet.name, ", ".join(
+                "{0} {1:.2f}s".format(stage, sec) for stage, sec in timings.items() if sec is not None)))
+
+    @staticmethod
+    async def __power_on_standby_droplet(do_client, droplet, tag_name, snapshot_name, progress_callback,
+                                         inactivity_monitor):
+        if DropletApi.__standby_pool is not None:
+            DropletApi.__standby_pool.claim(droplet.id)
+
+        if progress_callback is not None:
+            await progress_callback("powering on standby droplet {}".format(droplet.name))
+
+        DropletApi.__track_droplet(tag_name, droplet.name)
+        DropletApi.__save_droplet_state(tag_name, droplet, StateStore.BOOTING)
+        if droplet.status != "off":
+            await DropletApi.__wait_for_power_off(do_client, droplet)
+
+        power_on_time = time.perf_counter()
+        try:
+            action = await do_client.power_on_droplet(droplet.id)
+        except Exception:
+            boot_phase_seconds.observe(time.perf_counter() - power_on_time, phase="power_on")
+            raise
+        DropletApi.__invalidate_status(tag_name)
+
+        return droplet, DropletApi.__wait_for_powered_on_droplet(do_client, droplet, action, tag_name, snapshot_name,
+                                                                 progress_callback, inactivity_monitor, power_on_time)
+
+    @staticmethod
+    async def __wait_for_powered_on_droplet(do_client, droplet, action, tag_name, snapshot_name, progress_callback,
+                                            inactivity_monitor, power_on_time):
+        try:
+            boot_poller = AdaptiveBootPoller(do_client, DropletApi.__boot_time_model)
+            await boot_poller.wait_for_boot(droplet.name, [action.id], snapshot_name,
+                                            droplet.region, progress_callback,
+                                            start_time=power_on_time, boot_kind="power_on")
 
+            return await DropletApi.__finish_boot(do_client, droplet, tag_name, progress_callback,
+                                                  inactivity_monitor)
         finally:
-            DropletApi.__droplet_sem.release()
+            boot_phase_seconds.observe(time.perf_counter() - power_on_time, phase="power_on")
+
+    @staticmethod
+    async def __wait_for_power_off(do_client, droplet, max_attempts=60, attempt_delay_sec=1):
+        # a power on is refused until the shutdown the droplet was parked with has finished
+        for attempt in range(max_attempts):
+            await asyncio.sleep(attempt_delay_sec)
+            if (await do_client.get_droplet(droplet.id)).status == "off":
+                return
+        raise DropletBootFailedException("standby droplet {} did not finish powering off".format(droplet.name))
+
+    @staticmethod
+    async def __finish_boot(do_client, booted_droplet, tag_name, progress_callback, inactivity_monitor):
+        # a teardown can run while the boot is waited out, its droplet is not handed out afterwards
+        if DropletApi.__turned_off_while_booting(tag_name, booted_droplet):
+            raise DropletBootFailedException("droplet {} was turned off while it was turning on".format(
+                booted_droplet.name))
+
+        droplet = await do_client.get_droplet(booted_droplet.id)
+        DropletApi.__save_droplet_state(tag_name, droplet, StateStore.ACTIVE)
+        DropletApi.__invalidate_status(tag_name)
+
+        DropletApi.__start_inactivity_monitor(do_client, droplet, progress_callback, inactivity_monitor)
 
+        return droplet
 
     @staticmethod
-    def destroy_droplet_callback(progress_callback = None):
+    def __turned_off_while_booting(tag_name, droplet):
+        tearing_down = DropletApi.__tearing_down.get(tag_name)
+        return not DropletApi.__is_tracked(tag_name, droplet.name) or \
+            (tearing_down is not None and droplet.id in tearing_down) or \
+            (DropletApi.__standby_pool is not None and DropletApi.__standby_pool.contains(droplet.id))
+
+    @staticmethod
+    def __start_inactivity_monitor(do_client, droplet, progress_callback, inactivity_monitor, initial_delay_sec=None):
+        if inactivity_monitor is not None:
+            inactivity_monitor.start_monitoring(droplet,
+                                                DropletApi.destroy_droplet_callback(do_client, progress_callback),
+                                                DropletApi.destroy_droplet_callback_errored(do_client,
+                                                                                            progress_callback),
+                                                initial_delay_sec=initial_delay_sec)
+
+
+    @staticmethod
+    def destroy_droplet_callback(do_client, progress_callback = None):
+        @ApiPriority.prioritized(ApiPriority.TEARDOWN)
         async def __destroy_droplet_curried(last_active_utc, droplet):
+            if DropletApi.__standby_pool is not None and DropletApi.__standby_pool.contains(droplet.id):
+                return False
+
             logging.info("droplet {0} turned off due to inactivity (last active at {1} utc)".format(
                         droplet.name, str(last_active_utc)))
             if progress_callback is not None:
@@ -182,9 +736,10 @@ class DropletApi:
                     "droplet {0} turned off due to inactivity (last active at {1} utc)".format(
                         droplet.name, str(last_active_utc)))
 
-            droplet.destroy()
-            if DropletApi.__existing_droplets is not None and droplet.name in DropletApi.__existing_droplets:
-                DropletApi.__existing_droplets.pop(droplet.name)
+            if DropletApi.__preboot_scheduler is not None and droplet.tag_name is not None:
+                DropletApi.__preboot_scheduler.record(droplet.tag_name, PrebootScheduler.INACTIVE_SHUTDOWN)
+            await DropletApi.__retire_droplet(do_client, droplet)
+            DropletApi.__invalidate_status()
 
             return False
 
@@ -192,8 +747,13 @@ class DropletApi:
 
 
     @staticmethod
-    def destroy_droplet_callback_errored(progress_callback = None):
+    def destroy_droplet_callback_errored(do_client, progress_callback = None):
+        @ApiPriority.prioritized(ApiPriority.TEARDOWN)
         async def __destroy_droplet_errored_curried(error, droplet):
+            if DropletApi.__standby_pool is not None and DropletApi.__standby_pool.contains(droplet.id):
+                # parked droplets stop answering the monitor, that is expected
+                return False
+
             logging.error("droplet {0} turned off due to inactivity monitor error: {1}".format(
                         droplet.name, error if len(error.args) == 0 else error.args[0]))
             if progress_callback is not None:
@@ -201,9 +761,12 @@ class DropletApi:
                     "droplet {0} turned off due to inactivity monitor error".format(
                         droplet.name))
 
-            droplet.destroy()
-            if DropletApi.__existing_droplets is not None and droplet.name in DropletApi.__existing_droplets:
-                DropletApi.__existing_droplets.pop(droplet.name)
+            if DropletApi.__preboot_scheduler is not None and droplet.tag_name is not None:
+                DropletApi.__preboot_scheduler.record(droplet.tag_name, PrebootScheduler.INACTIVE_SHUTDOWN)
+            await DropletApi.__destroy_droplet(do_client, droplet)
+            DropletApi.__untrack_droplet(droplet.name)
+            DropletApi.__forget_droplet_state(droplet.name)
+            DropletApi.__invalidate_status()
 
             return False
 
@@ -212,15 +775,16 @@ class DropletApi:
 
 if __name__ == '__main__':
     config = Config("streambot.config")
-    manager = digio.Manager(token=config.digital_ocean_api_key())
     loop = asyncio.get_event_loop()
+    do_client = DigitalOceanClient(config.digital_ocean_api_key(), loop=loop)
     created_droplet = loop.run_until_complete(
-        DropletApi.create_or_get_single_droplet_from_snapshot(manager,
+        DropletApi.create_or_get_single_droplet_from_snapshot(do_client,
                                                               config.default_tag_name(),
                                                               config.default_snapshot_name(),
                                                               config.default_firewall_name()))
     print(created_droplet)
     pending = asyncio.Task.all_tasks()
     loop.run_until_complete(asyncio.gather(*pending))
+    loop.run_until_complete(do_client.close())
     loop.close()
-    # DropletApi.destroy_tagged_droplets(manager, config.default_tag_name())
+    # loop.run_until_complete(DropletApi.destroy_tagged_droplets(do_client, config.default_tag_name()))
\ No newline at end of file
@@ -0,0 +1,44 @@
+class DropletRecord:
+    # the few droplet fields the bot reads, kept instead of the api payload for as long as a droplet is tracked
+    __slots__ = ("id", "name", "tag_name", "ip_address", "region", "status")
+
+    def __init__(self, id=None, name=None, tag_name=None, ip_address=None, region=None, status=None):
+        self.id = id
+        self.name = name
+        self.tag_name = tag_name
+        self.ip_address = ip_address
+        self.region = region
+        self.status = status
+
+    @staticmethod
+    def from_api(data, tag_name=None):
+        ip_address = None
+        for network in data.get("networks", {}).get("v4", []):
+            if network.get("type") == "public":
+                ip_address = network.get("ip_address")
+        region = data.get("region")
+        tags = data.get("tags") or []
+        if tag_name is None and len(tags) > 0:
+            tag_name = tags[0]
+        return DropletRecord(data["id"], data.get("name"), tag_name, ip_address,
+                             region.get("slug") if isinstance(region, dict) else region, data.get("status"))
+
+    def to_json(self):
+        return {"id": self.id, "name": self.name, "tag_name": self.tag_name, "ip_address": self.ip_address,
+                "region": self.region, "status": self.status}
+
+
+class ActionRecord:
+    __slots__ = ("id", "status", "type")
+
+    def __init__(self, id=None, status=None, type=None):
+        self.id = id
+        self.status = status
+        self.type = type
+
+    @staticmethod
+    def from_api(data):
+        return ActionRecord(data["id"], data.get("status"), data.get("type"))
+
+    def to_json(self):
+        return {"id": self.id, "status": self.status, "type": self.type}
@@ -30,4 +30,41 @@ class DropletBootFailedException(StreamBotException):
 
 class UnauthorizedUserException(StreamBotException):
     def __init__(self, *args, **kwargs):
-        StreamBotException.__init__(self, *args, **kwargs)
\ No newline at end of file
+        StreamBotException.__init__(self, *args, **kwargs)
+
+class DigitalOceanApiException(StreamBotException):
+    def __init__(self, *args, **kwargs):
+        # the http status and response body digitalocean answered with
+        self.status = kwargs.pop("status", None)
+        self.payload = kwargs.pop("payload", None)
+        StreamBotException.__init__(self, *args, **kwargs)
+
+
+class DigitalOceanNotFoundException(DigitalOceanApiException):
+    def __init__(self, *args, **kwargs):
+        DigitalOceanApiException.__init__(self, *args, **kwargs)
+
+
+class InactivityPollException(StreamBotException):
+    def __init__(self, *args, **kwargs):
+        StreamBotException.__init__(self, *args, **kwargs)
+
+
+class CommandQueueFullException(StreamBotException):
+    def __init__(self, *args, **kwargs):
+        StreamBotException.__init__(self, *args, **kwargs)
+
+
+class ConfigValidationException(StreamBotException):
+    def __init__(self, *args, **kwargs):
+        StreamBotException.__init__(self, *args, **kwargs)
+
+
+class CoordinatorUnavailableException(StreamBotException):
+    def __init__(self, *args, **kwargs):
+        StreamBotException.__init__(self, *args, **kwargs)
+
+
+class ApiBudgetExhaustedException(StreamBotException):
+    def __init__(self, *args, **kwargs):
+        StreamBotException.__init__(self, *args, **kwargs)
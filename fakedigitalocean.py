@@ -0,0 +1,378 @@
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+
+
+class FakeDigitalOceanServer:
+    # a local stand-in for the parts of the DigitalOcean v2 api the bot uses, plus the droplet's own
+    # /last_active_time endpoint, so the api and the monitor can be measured without an account
+    def __init__(self, host="127.0.0.1", port=0, latency_sec=0.0, latency_jitter_sec=0.0, page_size=25,
+                 failure_rate=0.0, boot_sec=1.0, power_on_sec=0.5, power_off_sec=0.5, destroy_sec=0.0,
+                 boot_failure_rate=0.0, poll_latency_sec=0.0, poll_failure_rate=0.0, idle_sec=0.0, rate_limit=None,
+                 rate_limit_window_sec=60, seed=None, loop=None):
+        self.host = host
+        self.port = port
+        self.latency_sec = latency_sec
+        self.latency_jitter_sec = latency_jitter_sec
+        self.page_size = page_size
+        self.failure_rate = failure_rate
+        self.boot_sec = boot_sec
+        self.power_on_sec = power_on_sec
+        # droplets keep reporting active while they shut down, like on digitalocean
+        self.power_off_sec = power_off_sec
+        # how long droplets deleted by tag keep showing up in listings
+        self.destroy_sec = destroy_sec
+        self.boot_failure_rate = boot_failure_rate
+        self.poll_latency_sec = poll_latency_sec
+        self.poll_failure_rate = poll_failure_rate
+        # how long ago every droplet reports its last activity, 0 keeps them all busy
+        self.idle_sec = idle_sec
+        # api requests allowed per window, None leaves the api unlimited and without rate limit headers
+        self.rate_limit = rate_limit
+        self.rate_limit_window_sec = rate_limit_window_sec
+        # regions that refuse creates for now, like a region out of capacity for the size
+        self.unavailable_regions = set()
+        self.requests = Counter()
+        self.__rate_limit_remaining = rate_limit
+        self.__rate_limit_reset_time = None
+        self.__random = random.Random(seed)
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__server = None
+        self.__ids = itertools.count(1000)
+        self.__droplets = {}
+        self.__actions = {}
+        self.__snapshots = []
+        self.__firewalls = {}
+        self.__ssh_keys = []
+        self.__tags = {}
+
+    @property
+    def api_base_url(self):
+        return "http://{0}:{1}/v2/".format(self.host, self.port)
+
+    @property
+    def droplet_address(self):
+        return "{0}:{1}".format(self.host, self.port)
+
+    def add_snapshot(self, name, regions=("nyc3",)):
+        snapshot = {"id": str(next(self.__ids)), "name": name, "regions": list(regions), "resource_type": "droplet",
+                    "min_disk_size": 20, "size_gigabytes": 2.5, "created_at": self.__timestamp()}
+        self.__snapshots.append(snapshot)
+        return snapshot
+
+    def remove_snapshot(self, name):
+        self.__snapshots = [s for s in self.__snapshots if s["name"] != name]
+
+    def add_firewall(self, name):
+        firewall = {"id": str(next(self.__ids)), "name": name, "status": "succeeded", "droplet_ids": [],
+                    "tags": [], "inbound_rules": [], "outbound_rules": [], "created_at": self.__timestamp()}
+        self.__firewalls[firewall["id"]] = firewall
+        return firewall
+
+    def add_ssh_key(self, name):
+        ssh_key = {"id": next(self.__ids), "name": name, "fingerprint": "00:00", "public_key": "ssh-rsa AAAA"}
+        self.__ssh_keys.append(ssh_key)
+        return ssh_key
+
+    def add_droplet(self, name, tag_name, region="nyc3", status="active"):
+        droplet = self.__new_droplet(name, region, None, "2gb", [tag_name] if tag_name is not None else [])
+        droplet["status"] = status
+        droplet["_ready_time"] = time.monotonic()
+        return droplet
+
+    def droplets(self, tag_name=None):
+        now = time.monotonic()
+        for droplet_id in [i for i, d in self.__droplets.items() if d.get("_destroy_time", now + 1) <= now]:
+            self.__droplets.pop(droplet_id)
+        return [self.__droplet_view(d) for d in self.__droplets.values()
+                if tag_name is None or tag_name in d["tags"]]
+
+    def request_count(self, method=None, route=None):
+        return sum(count for (m, r), count in self.requests.items()
+                   if (method is None or m == method) and (route is None or r == route))
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        logging.info("fake digitalocean api listening on {}".format(self.api_base_url))
+        return self
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            self.__server = None
+
+    @staticmethod
+    def __timestamp():
+        return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    async def __handle(self, reader, writer):
+        # keep-alive, one request at a time per connection like the pooled client expects
+        try:
+            while True:
+                request_line = await reader.readline()
+                if request_line in (b"", b"\r\n", b"\n"):
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = None
+                content_length = int(headers.get("content-length", 0))
+                if content_length > 0:
+                    body = json.loads((await reader.readexactly(content_length)).decode("utf-8"))
+
+                method, target = request_line.decode("latin-1").split(" ")[:2]
+                status, payload, extra_headers = await self.__dispatch(method, target, body)
+                data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write("HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n"
+                             "Connection: {3}\r\n{4}\r\n".format(status, "OK" if status < 400 else "Error", len(data),
+                                                                 "keep-alive" if keep_alive else "close",
+                                                                 "".join("{0}: {1}\r\n".format(name, value)
+                                                                         for name, value in extra_headers))
+                             .encode("latin-1"))
+                writer.write(data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def __delay(self, latency_sec):
+        delay_sec = latency_sec + self.__random.uniform(0, self.latency_jitter_sec)
+        if delay_sec > 0:
+            await asyncio.sleep(delay_sec)
+
+    async def __dispatch(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == "/last_active_time" or self.rate_limit is None:
+            status, payload = await self.__respond(method, url, body)
+            return status, payload, ()
+
+        now = time.time()
+        if self.__rate_limit_reset_time is None or now >= self.__rate_limit_reset_time:
+            self.__rate_limit_remaining = self.rate_limit
+            self.__rate_limit_reset_time = now + self.rate_limit_window_sec
+        if self.__rate_limit_remaining <= 0:
+            self.requests[(method, "rate_limited")] += 1
+            status, payload = 429, {"id": "too_many_requests", "message": "API Rate limit exceeded."}
+        else:
+            self.__rate_limit_remaining -= 1
+            status, payload = await self.__respond(method, url, body)
+        return status, payload, (("RateLimit-Limit", self.rate_limit),
+                                 ("RateLimit-Remaining", self.__rate_limit_remaining),
+                                 ("RateLimit-Reset", int(math.ceil(self.__rate_limit_reset_time))))
+
+    async def __respond(self, method, url, body):
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == "/last_active_time":
+            self.requests[(method, "last_active_time")] += 1
+            await self.__delay(self.poll_latency_sec)
+            if self.__random.random() < self.poll_failure_rate:
+                return 500, {"error": "simulated failure"}
+            return 200, {"last_active_time": str(time.time() - self.idle_sec)}
+
+        parts = [part for part in url.path.split("/") if part != ""]
+        if len(parts) == 0 or parts[0] != "v2":
+            return 404, {"id": "not_found", "message": "unknown path {}".format(url.path)}
+        parts = parts[1:]
+        route = "/".join("{id}" if part.isdigit() else part for part in parts)
+        if len(parts) == 2 and parts[0] == "tags":
+            route = "tags/{name}"
+        self.requests[(method, route)] += 1
+
+        await self.__delay(self.latency_sec)
+        if self.__random.random() < self.failure_rate:
+            return 500, {"id": "server_error", "message": "simulated failure"}
+        handler = self.__routes().get((method, route))
+        if handler is None:
+            return 404, {"id": "not_found", "message": "{0} {1} is not simulated".format(method, url.path)}
+        return handler(parts, params, body, url.path)
+
+    def __routes(self):
+        return {
+            ("GET", "droplets"): self.__list_droplets,
+            ("POST", "droplets"): self.__create_droplet,
+            ("DELETE", "droplets"): self.__destroy_tagged_droplets,
+            ("GET", "droplets/{id}"): self.__get_droplet,
+            ("DELETE", "droplets/{id}"): self.__destroy_droplet,
+            ("GET", "droplets/{id}/actions"): self.__list_droplet_actions,
+            ("POST", "droplets/{id}/actions"): self.__droplet_action,
+            ("GET", "actions/{id}"): self.__get_action,
+            ("GET", "snapshots"): self.__list_snapshots,
+            ("GET", "firewalls"): self.__list_firewalls,
+            ("POST", "firewalls/{id}/droplets"): self.__add_firewall_droplets,
+            ("POST", "firewalls/{id}/tags"): self.__add_firewall_tags,
+            ("GET", "account/keys"): self.__list_ssh_keys,
+            ("GET", "tags"): self.__list_tags,
+            ("GET", "tags/{name}"): self.__get_tag,
+            ("POST", "tags"): self.__create_tag,
+        }
+
+    def __page(self, key, items, params, path):
+        per_page = min(int(params.get("per_page", 20)), self.page_size)
+        page = int(params.get("page", 1))
+        start = (page - 1) * per_page
+        payload = {key: items[start:start + per_page], "links": {"pages": {}}, "meta": {"total": len(items)}}
+        if start + per_page < len(items):
+            next_params = dict(params, page=page + 1)
+            payload["links"]["pages"]["next"] = "http://{0}:{1}{2}?{3}".format(
+                self.host, self.port, path, "&".join("{0}={1}".format(k, v) for k, v in next_params.items()))
+        return 200, payload
+
+    def __new_droplet(self, name, region, image, size_slug, tags):
+        droplet_id = next(self.__ids)
+        droplet = {"id": droplet_id, "name": name, "memory": 2048, "vcpus": 2, "disk": 40, "locked": False,
+                   "status": "new", "created_at": self.__timestamp(), "features": [],
+                   "region": {"slug": region, "name": region}, "image": {"id": image}, "size_slug": size_slug,
+                   "networks": {"v4": [{"ip_address": self.droplet_address, "type": "public"}]},
+                   "tags": list(tags), "_ready_time": time.monotonic() + self.boot_sec}
+        self.__droplets[droplet_id] = droplet
+        for tag_name in tags:
+            self.__tags.setdefault(tag_name, {"name": tag_name, "resources": {}})
+        return droplet
+
+    def __new_action(self, droplet, action_type, complete_sec):
+        errored = action_type != "power_off" and self.__random.random() < self.boot_failure_rate
+        action = {"id": next(self.__ids), "status": "in-progress", "type": action_type,
+                  "started_at": self.__timestamp(), "completed_at": None, "resource_id": droplet["id"],
+                  "resource_type": "droplet", "region_slug": droplet["region"]["slug"],
+                  "_complete_time": time.monotonic() + complete_sec, "_errored": errored}
+        self.__actions[action["id"]] = action
+        return action
+
+    def __droplet_view(self, droplet):
+        if droplet["status"] == "new" and time.monotonic() >= droplet["_ready_time"]:
+            droplet["status"] = "active"
+        if droplet["status"] == "active" and time.monotonic() >= droplet.get("_off_time", float("inf")):
+            droplet["status"] = "off"
+        return {k: v for k, v in droplet.items() if not k.startswith("_")}
+
+    def __action_view(self, action):
+        if action["status"] == "in-progress" and time.monotonic() >= action["_complete_time"]:
+            action["status"] = "errored" if action["_errored"] else "completed"
+            action["completed_at"] = self.__timestamp()
+        return {k: v for k, v in action.items() if not k.startswith("_")}
+
+    def __not_found(self, what):
+        return 404, {"id": "not_found", "message": "{} not found".format(what)}
+
+    def __list_droplets(self, parts, params, body, path):
+        return self.__page("droplets", self.droplets(params.get("tag_name")), params, path)
+
+    def __create_droplet(self, parts, params, body, path):
+        if body.get("image") not in [s["id"] for s in self.__snapshots]:
+            return 422, {"id": "unprocessable_entity",
+                         "message": "You specified an invalid image for Droplet creation."}
+        ssh_key_ids = [k["id"] for k in self.__ssh_keys]
+        if any(ssh_key_id not in ssh_key_ids for ssh_key_id in body.get("ssh_keys", [])):
+            return 422, {"id": "unprocessable_entity", "message": "You specified an invalid ssh key id."}
+        if body["region"] in self.unavailable_regions:
+            return 422, {"id": "unprocessable_entity", "message": "Size is not available in this region."}
+        droplet = self.__new_droplet(body["name"], body["region"], body.get("image"), body.get("size"),
+                                     body.get("tags", []))
+        action = self.__new_action(droplet, "create", self.boot_sec)
+        return 202, {"droplet": self.__droplet_view(droplet),
+                     "links": {"actions": [{"id": action["id"], "rel": "create", "href": ""}]}}
+
+    def __get_droplet(self, parts, params, body, path):
+        droplet = self.__droplets.get(int(parts[1]))
+        if droplet is None:
+            return self.__not_found("droplet {}".format(parts[1]))
+        return 200, {"droplet": self.__droplet_view(droplet)}
+
+    def __destroy_droplet(self, parts, params, body, path):
+        if self.__droplets.pop(int(parts[1]), None) is None:
+            return self.__not_found("droplet {}".format(parts[1]))
+        return 204, None
+
+    def __destroy_tagged_droplets(self, parts, params, body, path):
+        if "tag_name" not in params:
+            return 422, {"id": "unprocessable_entity", "message": "tag_name is required"}
+        destroy_time = time.monotonic() + self.destroy_sec
+        for droplet in self.__droplets.values():
+            if params["tag_name"] in droplet["tags"]:
+                droplet.setdefault("_destroy_time", destroy_time)
+        self.droplets()
+        return 204, None
+
+    def __list_droplet_actions(self, parts, params, body, path):
+        actions = [self.__action_view(a) for a in self.__actions.values() if a["resource_id"] == int(parts[1])]
+        return self.__page("actions", actions, params, path)
+
+    def __droplet_action(self, parts, params, body, path):
+        droplet = self.__droplets.get(int(parts[1]))
+        if droplet is None:
+            return self.__not_found("droplet {}".format(parts[1]))
+        if body["type"] == "power_off":
+            droplet["_off_time"] = time.monotonic() + self.power_off_sec
+            action = self.__new_action(droplet, "power_off", self.power_off_sec)
+        elif body["type"] == "power_on":
+            if self.__droplet_view(droplet)["status"] != "off":
+                return 422, {"id": "unprocessable_entity", "message": "Droplet is already powered on."}
+            droplet.pop("_off_time", None)
+            droplet["status"] = "new"
+            droplet["_ready_time"] = time.monotonic() + self.power_on_sec
+            action = self.__new_action(droplet, "power_on", self.power_on_sec)
+        else:
+            return 422, {"id": "unprocessable_entity", "message": "{} is not simulated".format(body["type"])}
+        return 201, {"action": self.__action_view(action)}
+
+    def __get_action(self, parts, params, body, path):
+        action = self.__actions.get(int(parts[1]))
+        if action is None:
+            return self.__not_found("action {}".format(parts[1]))
+        return 200, {"action": self.__action_view(action)}
+
+    def __list_snapshots(self, parts, params, body, path):
+        return self.__page("snapshots", self.__snapshots, params, path)
+
+    def __list_firewalls(self, parts, params, body, path):
+        return self.__page("firewalls", list(self.__firewalls.values()), params, path)
+
+    def __add_firewall_droplets(self, parts, params, body, path):
+        firewall = self.__firewalls.get(parts[1])
+        if firewall is None:
+            return self.__not_found("firewall {}".format(parts[1]))
+        firewall["droplet_ids"].extend(body.get("droplet_ids", []))
+        return 204, None
+
+    def __add_firewall_tags(self, parts, params, body, path):
+        firewall = self.__firewalls.get(parts[1])
+        if firewall is None:
+            return self.__not_found("firewall {}".format(parts[1]))
+        for tag_name in body.get("tags", []):
+            if tag_name not in self.__tags:
+                return 422, {"id": "unprocessable_entity", "message": "tag {} does not exist".format(tag_name)}
+            if tag_name not in firewall["tags"]:
+                firewall["tags"].append(tag_name)
+        return 204, None
+
+    def __list_ssh_keys(self, parts, params, body, path):
+        return self.__page("ssh_keys", self.__ssh_keys, params, path)
+
+    def __list_tags(self, parts, params, body, path):
+        return self.__page("tags", list(self.__tags.values()), params, path)
+
+    def __get_tag(self, parts, params, body, path):
+        tag = self.__tags.get(parts[1])
+        if tag is None:
+            return self.__not_found("tag {}".format(parts[1]))
+        return 200, {"tag": tag}
+
+    def __create_tag(self, parts, params, body, path):
+        tag = self.__tags.setdefault(body["name"], {"name": body["name"], "resources": {}})
+        return 201, {"tag": tag}
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from metrics import metrics, current_task
+
+loop_lag_seconds = metrics.histogram("event_loop_lag_seconds", "How late the event loop heartbeat woke up")
+stalls_total = metrics.counter("event_loop_stalls_total", "Event loop stalls over the threshold by source",
+                               ("source",))
+stall_seconds = metrics.histogram("event_loop_stall_seconds", "Event loop stall duration by source", ("source",))
+
+ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+
+class Stall:
+    __slots__ = ("beat", "source", "stack")
+
+    def __init__(self, beat, source, stack):
+        self.beat = beat
+        self.source = source
+        self.stack = stack
+
+
+class LoopWatchdog:
+    def __init__(self, loop=None, stall_threshold_sec=0.25, interval_sec=0.05):
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__stall_threshold_sec = stall_threshold_sec
+        self.__interval_sec = interval_sec
+        self.__loop_thread_id = None
+        # heartbeat counter and time, written by the loop and read by the watchdog thread
+        self.__beat = 0
+        self.__beat_time = None
+        self.__stall = None
+        self.__heartbeat_task = None
+        self.__thread = None
+        self.__stopped = threading.Event()
+        # source -> [stall count, total stalled seconds]
+        self.__totals = {}
+
+    def totals(self):
+        return {source: tuple(total) for source, total in self.__totals.items()}
+
+    def start(self):
+        if self.__heartbeat_task is not None:
+            return
+        self.__stopped.clear()
+        self.__heartbeat_task = asyncio.ensure_future(self.__heartbeat(), loop=self.__loop)
+        self.__thread = threading.Thread(target=self.__watch, name="loop-watchdog", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__heartbeat_task is not None:
+            self.__heartbeat_task.cancel()
+            self.__heartbeat_task = None
+        self.__thread = None
+
+    async def __heartbeat(self):
+        self.__loop_thread_id = threading.get_ident()
+        self.__beat_time = time.monotonic()
+        while True:
+            expected_time = time.monotonic() + self.__interval_sec
+            await asyncio.sleep(self.__interval_sec)
+            now = time.monotonic()
+            lag_sec = max(0.0, now - expected_time)
+            loop_lag_seconds.observe(lag_sec)
+            stall = self.__stall
+            self.__stall = None
+            self.__beat += 1
+            self.__beat_time = now
+            if lag_sec >= self.__stall_threshold_sec:
+                self.__record(lag_sec, stall)
+
+    def __record(self, lag_sec, stall):
+        # stalls shorter than a watchdog tick can end before their stack is sampled
+        source = stall.source if stall is not None else "unknown"
+        stalls_total.inc(source=source)
+        stall_seconds.observe(lag_sec, source=source)
+        total = self.__totals.setdefault(source, [0, 0.0])
+        total[0] += 1
+        total[1] += lag_sec
+        logging.warning("event loop stalled for {0:.3f}s in {1}{2}".format(
+            lag_sec, source, "\n" + "".join(stall.stack) if stall is not None else ""))
+
+    def __watch(self):
+        while not self.__stopped.wait(self.__interval_sec):
+            beat_time = self.__beat_time
+            if beat_time is None or time.monotonic() - beat_time < self.__stall_threshold_sec:
+                continue
+            # one sample per stall, taken while the blocking callback is still on the loop thread's stack
+            beat = self.__beat
+            if self.__stall is not None and self.__stall.beat == beat:
+                continue
+            frame = sys._current_frames().get(self.__loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame)
+            self.__stall = Stall(beat, self.__attribute(frame), stack)
+
+    def __attribute(self, frame):
+        # the innermost DropletApi method on the stack, then the command being served, then the innermost
+        # frame outside asyncio itself
+        innermost = None
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename.endswith("dropletapi.py"):
+                return "DropletApi.{}".format(code.co_name.lstrip("_"))
+            if innermost is None and not code.co_filename.startswith(ASYNCIO_DIR) and \
+                    code.co_filename != __file__:
+                innermost = "{0}:{1}".format(os.path.basename(code.co_filename), code.co_name)
+            frame = frame.f_back
+
+        trace = metrics.trace_for(current_task(loop=self.__loop))
+        if trace is not None:
+            return "command {}".format(trace.command)
+        return innermost if innermost is not None else "unknown"
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+import traceback
+from collections import deque
+from ratelimiter import KeyedTokenBucketLimiter
+from metrics import metrics
+
+messages_total = metrics.counter("discord_outbox_messages_total", "Outbound discord messages by kind", ("kind",))
+
+MAX_MESSAGE_LENGTH = 2000
+
+
+class PendingSend:
+    __slots__ = ("text", "future")
+
+    def __init__(self, text, future):
+        self.text = text
+        self.future = future
+
+
+class ProgressMessage:
+    def __init__(self, outbox, channel, edit_window_sec):
+        self.channel = channel
+        self.message = None
+        self.sent_time = None
+        self.queued = False
+        self.__outbox = outbox
+        self.__edit_window_sec = edit_window_sec
+        self.__lines = []
+
+    def update(self, text):
+        # progress long after the message went out starts a new one, an edit that far up goes unseen
+        if self.sent_time is not None and time.monotonic() - self.sent_time > self.__edit_window_sec:
+            self.message = None
+            self.sent_time = None
+            self.__lines = []
+        if len(self.__lines) > 0 and self.__lines[-1] == text:
+            return
+        self.__lines.append(text)
+        if not self.queued:
+            self.queued = True
+            self.__outbox.enqueue(self.channel, self)
+        else:
+            messages_total.inc(kind="coalesced")
+
+    def content(self):
+        # the newest lines win when the whole history no longer fits
+        lines = []
+        length = 0
+        for line in reversed(self.__lines):
+            length += len(line) + 1
+            if length > MAX_MESSAGE_LENGTH and len(lines) > 0:
+                break
+            lines.append(line[:MAX_MESSAGE_LENGTH])
+        return "\n".join(reversed(lines))
+
+
+class MessageOutbox:
+    # discord allows roughly 5 messages per 5 seconds in a channel, edits included
+    def __init__(self, client, rate_per_sec=1.0, burst=5, coalesce_sec=0.25, edit_window_sec=300, loop=None):
+        self.__client = client
+        self.__limiter = KeyedTokenBucketLimiter(rate_per_sec, burst)
+        self.__coalesce_sec = coalesce_sec
+        self.__edit_window_sec = edit_window_sec
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        # channel id -> pending PendingSend / ProgressMessage in delivery order, drained by one task per channel
+        self.__queues = {}
+        self.__workers = {}
+
+    def send(self, channel, text):
+        future = self.__loop.create_future()
+        self.enqueue(channel, PendingSend(str(text), future))
+        # nobody has to wait for delivery, so failures are logged rather than left unretrieved
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def progress(self, channel):
+        return ProgressMessage(self, channel, self.__edit_window_sec)
+
+    def enqueue(self, channel, item):
+        queue = self.__queues.get(channel.id)
+        if queue is None:
+            queue = deque()
+            self.__queues[channel.id] = queue
+        queue.append((channel, item))
+        if channel.id not in self.__workers:
+            self.__workers[channel.id] = asyncio.ensure_future(self.__drain(channel.id), loop=self.__loop)
+
+    def pending(self, channel_id=None):
+        if channel_id is not None:
+            return len(self.__queues.get(channel_id, ()))
+        return sum(len(queue) for queue in self.__queues.values())
+
+    async def __wait_for_token(self, channel_id):
+        while not self.__limiter.try_acquire(channel_id):
+            bucket = self.__limiter.refill(channel_id, time.monotonic())
+            await asyncio.sleep(max(0.05, (1 - bucket.tokens) / self.__limiter.rate_per_sec))
+
+    async def __drain(self, channel_id):
+        queue = self.__queues[channel_id]
+        try:
+            while len(queue) > 0:
+                # give updates fired back to back a moment to pile up, then deliver them as one
+                await asyncio.sleep(self.__coalesce_sec)
+                await self.__wait_for_token(channel_id)
+                channel, item = queue.popleft()
+                if isinstance(item, ProgressMessage):
+                    await self.__deliver_progress(item)
+                else:
+                    await self.__deliver_sends(channel, item, queue)
+        finally:
+            if self.__queues.get(channel_id) is queue:
+                self.__queues.pop(channel_id)
+                self.__workers.pop(channel_id, None)
+
+    async def __deliver_sends(self, channel, first, queue):
+        # consecutive plain sends to a channel go out as one message when they fit
+        sends = [first]
+        length = len(first.text)
+        while len(queue) > 0 and isinstance(queue[0][1], PendingSend) and \
+                length + len(queue[0][1].text) + 1 <= MAX_MESSAGE_LENGTH:
+            send = queue.popleft()[1]
+            length += len(send.text) + 1
+            sends.append(send)
+        texts = []
+        for send in sends:
+            if send.text not in texts:
+                texts.append(send.text)
+        messages_total.inc(len(sends) - 1, kind="coalesced")
+
+        try:
+            if self.__client.is_closed:
+                raise ConnectionError("discord client is closed")
+            message = await self.__client.send_message(channel, "\n".join(texts))
+            messages_total.inc(kind="send")
+        except Exception as e:
+            self.__log_failure(channel, e)
+            for send in sends:
+                if not send.future.done():
+                    send.future.set_exception(e)
+            return
+        for send in sends:
+            if not send.future.done():
+                send.future.set_result(message)
+
+    async def __deliver_progress(self, progress):
+        progress.queued = False
+        try:
+            if self.__client.is_closed:
+                return
+            if progress.message is None:
+                progress.message = await self.__client.send_message(progress.channel, progress.content())
+                progress.sent_time = time.monotonic()
+                messages_total.inc(kind="send")
+            else:
+                progress.message = await self.__client.edit_message(progress.message, progress.content())
+                messages_total.inc(kind="edit")
+        except Exception as e:
+            self.__log_failure(progress.channel, e)
+
+    @staticmethod
+    def __log_failure(channel, e):
+        tb = traceback.format_exc()
+        logging.error("message to channel {0} failed due to {1} \n at {2}".format(
+            channel.id, e if len(e.args) == 0 else e.args[0], tb))
+
+    def close(self):
+        for worker in list(self.__workers.values()):
+            worker.cancel()
+        self.__workers.clear()
+        self.__queues.clear()
@@ -0,0 +1,234 @@
+import asyncio
+import bisect
+import functools
+import logging
+import time
+import weakref
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def current_task(loop=None):
+    get_current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+    try:
+        return get_current_task(loop=loop)
+    except RuntimeError:
+        return None
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.__values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.__values.get(tuple(labels.get(name, "") for name in self.label_names), 0)
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help_text), "# TYPE {} counter".format(self.name)]
+        for key, value in sorted(self.__values.items(), key=lambda item: [str(v) for v in item[0]]):
+            lines.append("{0}{1} {2}".format(self.name, format_labels(self.label_names, key), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per bucket counts (+inf last), sum, count]
+        self.__values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        series = self.__values.get(key)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.__values[key] = series
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, **labels):
+        series = self.__values.get(tuple(labels.get(name, "") for name in self.label_names))
+        return series[2] if series is not None else 0
+
+    def total(self, **labels):
+        series = self.__values.get(tuple(labels.get(name, "") for name in self.label_names))
+        return series[1] if series is not None else 0.0
+
+    def quantile(self, q, **labels):
+        # interpolated within the bucket like histogram_quantile, so only as precise as the buckets
+        series = self.__values.get(tuple(labels.get(name, "") for name in self.label_names))
+        if series is None or series[2] == 0:
+            return None
+        rank = q * series[2]
+        cumulative = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), series[0]):
+            if bucket_count > 0 and cumulative + bucket_count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = bound
+        return lower
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help_text), "# TYPE {} histogram".format(self.name)]
+        for key, (bucket_counts, total, count) in sorted(self.__values.items(),
+                                                         key=lambda item: [str(v) for v in item[0]]):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append("{0}_bucket{1} {2}".format(self.name, format_labels(self.label_names, key, ("le", le)),
+                                                        cumulative))
+            lines.append("{0}_sum{1} {2}".format(self.name, format_labels(self.label_names, key), total))
+            lines.append("{0}_count{1} {2}".format(self.name, format_labels(self.label_names, key), count))
+        return lines
+
+
+class CommandTrace:
+    __slots__ = ("command", "api_calls", "__weakref__")
+
+    def __init__(self, command):
+        self.command = command
+        self.api_calls = 0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__metrics = {}
+        # task -> CommandTrace of the command the task is working for
+        self.__task_traces = weakref.WeakKeyDictionary()
+
+    def counter(self, name, help_text, label_names=()):
+        if name not in self.__metrics:
+            self.__metrics[name] = Counter(name, help_text, label_names)
+        return self.__metrics[name]
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        if name not in self.__metrics:
+            self.__metrics[name] = Histogram(name, help_text, label_names, buckets)
+        return self.__metrics[name]
+
+    def get(self, name):
+        return self.__metrics.get(name)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.__metrics):
+            lines.extend(self.__metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+    def trace_command(self, command, task=None):
+        task = task if task is not None else current_task()
+        trace = CommandTrace(command)
+        if task is not None:
+            self.__task_traces[task] = trace
+        return trace
+
+    def share_trace(self, task, from_task=None):
+        # work handed to another task (a shared boot) is still counted against the command that started it
+        from_task = from_task if from_task is not None else current_task()
+        trace = self.__task_traces.get(from_task) if from_task is not None else None
+        if trace is not None:
+            self.__task_traces[task] = trace
+
+    def current_trace(self):
+        return self.trace_for(current_task())
+
+    def trace_for(self, task):
+        return self.__task_traces.get(task) if task is not None else None
+
+    def timer(self, histogram, **labels):
+        return Timer(histogram, labels)
+
+    def timed(self, histogram, **labels):
+        def decorator(coroutine_function):
+            @functools.wraps(coroutine_function)
+            async def timed_coroutine(*args, **kwargs):
+                with Timer(histogram, labels):
+                    return await coroutine_function(*args, **kwargs)
+            return timed_coroutine
+        return decorator
+
+
+class Timer:
+    __slots__ = ("histogram", "labels", "start_time", "elapsed_sec")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start_time = None
+        self.elapsed_sec = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.elapsed_sec = time.perf_counter() - self.start_time
+        self.histogram.observe(self.elapsed_sec, **self.labels)
+        return False
+
+
+class MetricsServer:
+    def __init__(self, registry, host="127.0.0.1", port=9108, loop=None):
+        self.__registry = registry
+        self.__host = host
+        self.__port = port
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__server = None
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handle, self.__host, self.__port)
+        logging.info("serving metrics on http://{0}:{1}/metrics".format(self.__host, self.__port))
+
+    async def __handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split(" ")
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.__registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write("HTTP/1.1 {0}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         "Content-Length: {1}\r\nConnection: close\r\n\r\n".format(status, len(body)).encode("latin-1"))
+            writer.write(body)
+            await writer.drain()
+        except Exception as e:
+            logging.warning("metrics request failed: {}".format(e if len(e.args) == 0 else e.args[0]))
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            self.__server = None
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+# discord voice server region -> digitalocean regions closest to it, nearest first
+DISCORD_REGION_HINTS = {
+    "us-east": ("nyc1", "nyc3", "tor1"),
+    "us-central": ("nyc3", "tor1", "sfo2"),
+    "us-south": ("nyc3", "sfo2"),
+    "us-west": ("sfo2", "sfo3", "sfo1"),
+    "brazil": ("nyc3", "nyc1"),
+    "eu-west": ("lon1", "ams3", "fra1"),
+    "eu-central": ("fra1", "ams3", "lon1"),
+    "london": ("lon1", "ams3"),
+    "amsterdam": ("ams3", "lon1", "fra1"),
+    "frankfurt": ("fra1", "ams3"),
+    "russia": ("fra1", "ams3"),
+    "india": ("blr1", "sgp1"),
+    "singapore": ("sgp1", "blr1"),
+    "hongkong": ("sgp1",),
+    "japan": ("sgp1", "sfo2"),
+    "sydney": ("sgp1",),
+    "southafrica": ("lon1", "fra1"),
+}
+
+
+def parse_region_rtt(raw):
+    # "nyc3:40, fra1:120" -> {"nyc3": 40.0, "fra1": 120.0}
+    region_rtt_ms = {}
+    for entry in (raw or "").split(","):
+        if entry.strip() == "":
+            continue
+        region, _, rtt_ms = entry.partition(":")
+        region_rtt_ms[region.strip()] = float(rtt_ms)
+    return region_rtt_ms
+
+
+def parse_regions(raw):
+    return tuple(region.strip() for region in (raw or "").split(",") if region.strip() != "")
+
+
+class TcpConnectProbe:
+    # round trip measured as the time to open a tcp connection to the region's speedtest host
+    def __init__(self, host_format="speedtest-{}.digitalocean.com", port=80, timeout_sec=3):
+        self.__host_format = host_format
+        self.__port = port
+        self.__timeout_sec = timeout_sec
+
+    async def measure(self, guild_key, region):
+        start_time = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.__host_format.format(region), self.__port), self.__timeout_sec)
+        rtt_ms = (time.perf_counter() - start_time) * 1000.0
+        writer.close()
+        return rtt_ms
+
+
+class RegionPlacement:
+    def __init__(self, probe=None, max_samples=20, sample_ttl_sec=3600, hint_bonus_ms=30, failure_cooldown_sec=900):
+        self.__probe = probe
+        self.__max_samples = max_samples
+        self.__sample_ttl_sec = sample_ttl_sec
+        self.__hint_bonus_ms = hint_bonus_ms
+        self.__failure_cooldown_sec = failure_cooldown_sec
+        # (guild key, region) -> deque of (time, rtt ms)
+        self.__samples = {}
+        # region -> time of its last failed create
+        self.__failures = {}
+        self.__measured_time = {}
+
+    def record_rtt(self, guild_key, region, rtt_ms, now=None):
+        key = (guild_key, region)
+        if key not in self.__samples:
+            self.__samples[key] = deque(maxlen=self.__max_samples)
+        self.__samples[key].append((now if now is not None else time.monotonic(), rtt_ms))
+
+    def record_failure(self, region, now=None):
+        self.__failures[region] = now if now is not None else time.monotonic()
+
+    def rtt(self, guild_key, region, configured_rtt_ms=None, now=None):
+        # configured round trips describe the guild's streamers, probes only measure from the bot's host,
+        # so they fill in regions the profile does not mention
+        configured = (configured_rtt_ms or {}).get(region)
+        if configured is not None:
+            return configured
+        now = now if now is not None else time.monotonic()
+        samples = sorted(rtt_ms for sample_time, rtt_ms in self.__samples.get((guild_key, region), ())
+                         if now - sample_time < self.__sample_ttl_sec)
+        if len(samples) > 0:
+            return samples[len(samples) // 2]
+        return None
+
+    async def measure(self, guild_key, regions):
+        # skipped while the last measurement for the guild is still fresh
+        if self.__probe is None:
+            return
+        now = time.monotonic()
+        if now - self.__measured_time.get(guild_key, -self.__sample_ttl_sec) < self.__sample_ttl_sec:
+            return
+        self.__measured_time[guild_key] = now
+
+        regions = list(regions)
+        results = await asyncio.gather(*[self.__probe.measure(guild_key, region) for region in regions],
+                                       return_exceptions=True)
+        for region, result in zip(regions, results):
+            if isinstance(result, Exception):
+                logging.warning("rtt probe for {0} failed: {1}".format(
+                    region, result if len(result.args) == 0 else result.args[0]))
+            else:
+                self.record_rtt(guild_key, region, result, now)
+
+    def rank(self, guild_key, regions, hints=(), configured_rtt_ms=None):
+        # regions with a configured rtt first, then probed ones, then the rest in the snapshot's order; lowest
+        # rtt first within each, hinted regions get a bonus and regions that just failed a create go last
+        now = time.monotonic()
+        hints = list(hints or ())
+
+        def score(indexed_region):
+            index, region = indexed_region
+            failed_time = self.__failures.get(region)
+            failed = failed_time is not None and now - failed_time < self.__failure_cooldown_sec
+            rtt_ms = self.rtt(guild_key, region, configured_rtt_ms, now)
+            source = 0 if region in (configured_rtt_ms or {}) else 1 if rtt_ms is not None else 2
+            hint_index = hints.index(region) if region in hints else len(hints)
+            if rtt_ms is not None and hint_index < len(hints):
+                rtt_ms -= self.__hint_bonus_ms
+            return failed, source, rtt_ms if rtt_ms is not None else 0.0, hint_index, index
+
+        return [region for index, region in sorted(enumerate(regions), key=score)]
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+import traceback
+from collections import deque
+from metrics import metrics
+
+preboots_total = metrics.counter("preboots_total", "Droplets booted ahead of a learned stream start", ("result",))
+
+WEEK_SEC = 7 * 24 * 3600
+
+
+class StartWindow:
+    __slots__ = ("tag_name", "week_offset_sec", "weeks")
+
+    def __init__(self, tag_name, week_offset_sec, weeks):
+        self.tag_name = tag_name
+        self.week_offset_sec = week_offset_sec
+        self.weeks = weeks
+
+    def next_start_time(self, now):
+        start_time = now - now % WEEK_SEC + self.week_offset_sec
+        return start_time if start_time > now else start_time + WEEK_SEC
+
+
+class Preboot:
+    __slots__ = ("start_time", "expire_time", "task")
+
+    def __init__(self, start_time, expire_time, task=None):
+        self.start_time = start_time
+        self.expire_time = expire_time
+        self.task = task
+
+
+class PrebootScheduler:
+    TURN_ON = "turn_on"
+    TURN_OFF = "turn_off"
+    INACTIVE_SHUTDOWN = "inactive_shutdown"
+
+    # preboot(tag name) and teardown(tag name) are coroutines, the scheduler only decides when
+    def __init__(self, preboot, teardown, lead_time_sec=600, claim_grace_sec=1800, history_weeks=4, min_weeks=2,
+                 window_sec=1800, check_interval_sec=60, loop=None):
+        self.__preboot = preboot
+        self.__teardown = teardown
+        self.__lead_time_sec = lead_time_sec
+        self.__claim_grace_sec = claim_grace_sec
+        self.__history_weeks = history_weeks
+        self.__min_weeks = min_weeks
+        self.__window_sec = window_sec
+        self.__check_interval_sec = check_interval_sec
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        # tag -> (event, time) oldest first
+        self.__events = {}
+        # tag -> Preboot nobody has claimed yet
+        self.__prebooted = {}
+        # tag -> start time of the last window a droplet was booted for
+        self.__last_window_start = {}
+        self.__live = set()
+        self.__check_task = None
+        self.__state_store = None
+
+    def persist_to(self, state_store):
+        self.__state_store = state_store
+        since_time = time.time() - self.__history_weeks * WEEK_SEC
+        for tag_name, event, event_time in state_store.load_stream_events(since_time):
+            self.__remember(tag_name, event, event_time)
+
+    def record(self, tag_name, event, event_time=None):
+        event_time = event_time if event_time is not None else time.time()
+        self.__remember(tag_name, event, event_time)
+        if self.__state_store is not None:
+            self.__state_store.save_stream_event(tag_name, event, event_time)
+
+        # preboots are unmonitored, so only a command can end one
+        if event == PrebootScheduler.INACTIVE_SHUTDOWN:
+            return
+        preboot = self.__prebooted.pop(tag_name, None)
+        if preboot is not None and event == PrebootScheduler.TURN_ON:
+            preboots_total.inc(result="claimed")
+            logging.info("prebooted droplet for {} claimed".format(tag_name))
+
+    def __remember(self, tag_name, event, event_time):
+        events = self.__events.get(tag_name)
+        if events is None:
+            events = deque()
+            self.__events[tag_name] = events
+        events.append((event, event_time))
+        while len(events) > 0 and events[0][1] < event_time - self.__history_weeks * WEEK_SEC:
+            events.popleft()
+        if event == PrebootScheduler.TURN_ON:
+            self.__live.add(tag_name)
+        else:
+            self.__live.discard(tag_name)
+
+    def windows(self, tag_name, now=None):
+        # starts grouped by time of week, a group that shows up in enough different weeks is a window
+        # and opens at its earliest start
+        now = now if now is not None else time.time()
+        since_time = now - self.__history_weeks * WEEK_SEC
+        starts = sorted((event_time % WEEK_SEC, int(event_time // WEEK_SEC))
+                        for event, event_time in self.__events.get(tag_name, ())
+                        if event == PrebootScheduler.TURN_ON and event_time >= since_time)
+        windows = []
+        group = []
+        for offset_sec, week in starts + [(None, None)]:
+            if offset_sec is not None and len(group) > 0 and offset_sec - group[0][0] <= self.__window_sec:
+                group.append((offset_sec, week))
+                continue
+            weeks = len(set(w for o, w in group))
+            if weeks >= self.__min_weeks:
+                windows.append(StartWindow(tag_name, group[0][0], weeks))
+            group = [(offset_sec, week)]
+        return windows
+
+    def pending(self, tag_name):
+        return tag_name in self.__prebooted
+
+    async def check(self, now=None):
+        now = now if now is not None else time.time()
+        for tag_name, preboot in list(self.__prebooted.items()):
+            if now >= preboot.expire_time and preboot.task is not None and preboot.task.done():
+                self.__prebooted.pop(tag_name)
+                preboots_total.inc(result="unclaimed")
+                logging.info("prebooted droplet for {} went unclaimed, tearing it down".format(tag_name))
+                await self.__teardown(tag_name)
+
+        for tag_name in list(self.__events):
+            if tag_name in self.__live or tag_name in self.__prebooted:
+                continue
+            for window in self.windows(tag_name, now):
+                start_time = window.next_start_time(now)
+                if start_time - now > self.__lead_time_sec or \
+                        self.__last_window_start.get(tag_name) == start_time:
+                    continue
+                self.__last_window_start[tag_name] = start_time
+                preboot = Preboot(start_time, start_time + self.__claim_grace_sec)
+                self.__prebooted[tag_name] = preboot
+                preboot.task = asyncio.ensure_future(self.__run_preboot(tag_name, preboot), loop=self.__loop)
+                break
+
+    async def __run_preboot(self, tag_name, preboot):
+        logging.info("prebooting droplet for {0}, stream usually starts in {1:.0f}s".format(
+            tag_name, preboot.start_time - time.time()))
+        try:
+            await self.__preboot(tag_name)
+            preboots_total.inc(result="started")
+        except Exception as e:
+            preboots_total.inc(result="failed")
+            if self.__prebooted.get(tag_name) is preboot:
+                self.__prebooted.pop(tag_name)
+            tb = traceback.format_exc()
+            logging.error("preboot for {0} failed due to {1} \n at {2}".format(
+                tag_name, e if len(e.args) == 0 else e.args[0], tb))
+
+    async def __check_forever(self):
+        while True:
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                tb = traceback.format_exc()
+                logging.error("preboot check failed due to {0} \n at {1}".format(
+                    e if len(e.args) == 0 else e.args[0], tb))
+            await asyncio.sleep(self.__check_interval_sec)
+
+    def start(self):
+        if self.__check_task is None:
+            self.__check_task = asyncio.ensure_future(self.__check_forever(), loop=self.__loop)
+
+    def stop(self):
+        if self.__check_task is not None:
+            self.__check_task.cancel()
+            self.__check_task = None
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_time")
+
+    def __init__(self, tokens, updated_time):
+        self.tokens = tokens
+        self.updated_time = updated_time
+
+
+class KeyedTokenBucketLimiter:
+    def __init__(self, rate_per_sec, burst):
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        # least recently used buckets first, so idle ones can be evicted from the front
+        self.__buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self.__buckets)
+
+    def refill(self, key, now):
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self.__buckets[key] = bucket
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_time) * self.rate_per_sec)
+            bucket.updated_time = now
+            self.__buckets.move_to_end(key)
+        return bucket
+
+    def try_acquire(self, key, cost=1, now=None):
+        bucket = self.refill(key, now if now is not None else time.monotonic())
+        if bucket.tokens < cost:
+            return False
+        bucket.tokens -= cost
+        return True
+
+    def evict_idle(self, idle_sec, now=None):
+        # a bucket idle long enough to have refilled completely is the same as no bucket at all
+        now = now if now is not None else time.monotonic()
+        if self.rate_per_sec > 0:
+            idle_sec = max(idle_sec, self.burst / self.rate_per_sec)
+        evicted = 0
+        while len(self.__buckets) > 0:
+            key, bucket = next(iter(self.__buckets.items()))
+            if now - bucket.updated_time < idle_sec:
+                break
+            self.__buckets.popitem(last=False)
+            evicted += 1
+        return evicted
+
+
+class CommandRateLimiter:
+    USER = "user"
+    CHANNEL = "channel"
+
+    def __init__(self, limits, idle_eviction_sec=600, loop=None):
+        # limits: command class -> scope -> (rate per second, burst)
+        self.__limiters = {}
+        for command_class, scopes in limits.items():
+            for scope, (rate_per_sec, burst) in scopes.items():
+                self.__limiters[(command_class, scope)] = KeyedTokenBucketLimiter(rate_per_sec, burst)
+        self.__idle_eviction_sec = idle_eviction_sec
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__eviction_task = None
+
+    def reconfigure(self, limits):
+        for command_class, scopes in limits.items():
+            for scope, (rate_per_sec, burst) in scopes.items():
+                limiter = self.__limiters.get((command_class, scope))
+                if limiter is None:
+                    self.__limiters[(command_class, scope)] = KeyedTokenBucketLimiter(rate_per_sec, burst)
+                else:
+                    limiter.rate_per_sec = rate_per_sec
+                    limiter.burst = burst
+
+    def allow(self, command_class, user_id, channel_id):
+        now = time.monotonic()
+        buckets = []
+        for scope, key in ((CommandRateLimiter.USER, user_id), (CommandRateLimiter.CHANNEL, channel_id)):
+            limiter = self.__limiters.get((command_class, scope))
+            if limiter is not None:
+                buckets.append(limiter.refill(key, now))
+        # only spend tokens when every bucket can pay, a rejected request costs nothing
+        if any(bucket.tokens < 1 for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return True
+
+    def evict_idle(self):
+        now = time.monotonic()
+        return sum(limiter.evict_idle(self.__idle_eviction_sec, now) for limiter in self.__limiters.values())
+
+    async def __evict_forever(self):
+        while True:
+            await asyncio.sleep(self.__idle_eviction_sec)
+            evicted = self.evict_idle()
+            if evicted > 0:
+                logging.info("evicted {} idle rate limit bucket(s)".format(evicted))
+
+    def start_eviction(self):
+        if self.__eviction_task is None:
+            self.__eviction_task = asyncio.ensure_future(self.__evict_forever(), loop=self.__loop)
+
+    def stop_eviction(self):
+        if self.__eviction_task is not None:
+            self.__eviction_task.cancel()
+            self.__eviction_task = None
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+import traceback
+
+
+class ResourceCache:
+    def __init__(self, resource_name, fetch_all, ttl_sec=300, miss_refresh_sec=30, key=None, loop=None):
+        self.__resource_name = resource_name
+        self.__fetch_all = fetch_all
+        self.__ttl_sec = ttl_sec
+        self.__miss_refresh_sec = miss_refresh_sec
+        self.__key = key if key is not None else (lambda r: r.name)
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__resources = None
+        self.__index = {}
+        self.__loaded_time = None
+        self.__pending_refresh = None
+
+    def __is_fresh(self):
+        return self.__loaded_time is not None and time.perf_counter() - self.__loaded_time < self.__ttl_sec
+
+    def invalidate(self):
+        self.__loaded_time = None
+
+    async def refresh(self):
+        # concurrent callers share the listing that is already in flight
+        if self.__pending_refresh is None:
+            self.__pending_refresh = asyncio.ensure_future(self.__refresh(), loop=self.__loop)
+        pending_refresh = self.__pending_refresh
+        try:
+            return await asyncio.shield(pending_refresh)
+        finally:
+            if self.__pending_refresh is pending_refresh and pending_refresh.done():
+                self.__pending_refresh = None
+
+    async def __refresh(self):
+        resources = await self.__fetch_all()
+        index = {}
+        for resource in resources:
+            index.setdefault(self.__key(resource), resource)
+        self.__resources = resources
+        self.__index = index
+        self.__loaded_time = time.perf_counter()
+        logging.info("cached {0} {1}".format(len(resources), self.__resource_name))
+        return resources
+
+    async def get_all(self):
+        if not self.__is_fresh():
+            await self.refresh()
+        return self.__resources
+
+    async def get(self, name):
+        if not self.__is_fresh():
+            await self.refresh()
+
+        resource = self.__index.get(name)
+        if resource is None and time.perf_counter() - self.__loaded_time > self.__miss_refresh_sec:
+            # the resource may have been created since the last listing
+            await self.refresh()
+            resource = self.__index.get(name)
+        return resource
+
+    async def refresh_forever(self, refresh_interval_sec):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                tb = traceback.format_exc()
+                logging.error("background refresh of {0} failed due to {1} \n at {2}".format(
+                    self.__resource_name, e if len(e.args) == 0 else e.args[0], tb))
+            await asyncio.sleep(refresh_interval_sec)
+
+
+class DropletResourceCache:
+    def __init__(self, do_client, ttl_sec=300, refresh_interval_sec=None, loop=None):
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__refresh_interval_sec = refresh_interval_sec
+        self.__refresh_tasks = None
+        self.snapshots = ResourceCache("snapshots", do_client.get_all_snapshots, ttl_sec=ttl_sec, loop=self.__loop)
+        self.firewalls = ResourceCache("firewalls", do_client.get_all_firewalls, ttl_sec=ttl_sec, loop=self.__loop)
+        self.ssh_keys = ResourceCache("ssh keys", do_client.get_all_sshkeys, ttl_sec=ttl_sec, loop=self.__loop)
+
+    def invalidate(self):
+        self.snapshots.invalidate()
+        self.firewalls.invalidate()
+        self.ssh_keys.invalidate()
+
+    def start_background_refresh(self):
+        if self.__refresh_interval_sec is None or self.__refresh_tasks is not None:
+            return
+        self.__refresh_tasks = [asyncio.ensure_future(cache.refresh_forever(self.__refresh_interval_sec),
+                                                      loop=self.__loop)
+                                for cache in (self.snapshots, self.firewalls, self.ssh_keys)]
+
+    def stop_background_refresh(self):
+        if self.__refresh_tasks is None:
+            return
+        for task in self.__refresh_tasks:
+            task.cancel()
+        self.__refresh_tasks = None
@@ -0,0 +1,38 @@
+import asyncio
+import logging
+import traceback
+
+
+class SharedBoot:
+    def __init__(self, name, loop=None):
+        self.name = name
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__progress_callbacks = []
+        self.__last_progress_text = None
+        self.__future = None
+
+    def start(self, boot_coroutine):
+        self.__future = asyncio.ensure_future(boot_coroutine, loop=self.__loop)
+        self.__future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return self.__future
+
+    def done(self):
+        return self.__future is not None and self.__future.done()
+
+    async def attach(self, progress_callback=None):
+        if progress_callback is not None:
+            self.__progress_callbacks.append(progress_callback)
+            if self.__last_progress_text is not None:
+                await progress_callback(self.__last_progress_text)
+        # shielded so one requester giving up does not cancel the boot for everyone else
+        return await asyncio.shield(self.__future)
+
+    async def progress_callback(self, text):
+        self.__last_progress_text = text
+        for callback in list(self.__progress_callbacks):
+            try:
+                await callback(text)
+            except Exception as e:
+                tb = traceback.format_exc()
+                logging.error("progress update for {0} failed due to {1} \n at {2}".format(
+                    self.name, e if len(e.args) == 0 else e.args[0], tb))
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+import traceback
+from collections import OrderedDict
+from exception import DigitalOceanNotFoundException
+
+
+class StandbyPool:
+    def __init__(self, do_client, max_idle_sec=3600, pool_size=1, loop=None):
+        self.__do_client = do_client
+        self.__max_idle_sec = max_idle_sec
+        self.__pool_size = pool_size
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        # tag -> droplet id -> (droplet name, time parked), oldest first; each tag keeps its own pool_size
+        self.__parked = {}
+        # droplet id -> tag it is parked under
+        self.__parked_tags = {}
+        self.__reap_task = None
+        self.__state_store = None
+
+    def persist_to(self, state_store):
+        self.__state_store = state_store
+
+    def adopt(self, droplet_id, droplet_name, parked_time, tag_name=None):
+        self.__parked.setdefault(tag_name, OrderedDict())[droplet_id] = (droplet_name, parked_time)
+        self.__parked_tags[droplet_id] = tag_name
+
+    def contains(self, droplet_id):
+        return droplet_id in self.__parked_tags
+
+    def claim(self, droplet_id):
+        if droplet_id not in self.__parked_tags:
+            return False
+        tag_name = self.__parked_tags.pop(droplet_id)
+        tag_parked = self.__parked[tag_name]
+        tag_parked.pop(droplet_id)
+        if len(tag_parked) == 0:
+            self.__parked.pop(tag_name)
+        return True
+
+    async def park(self, droplet):
+        if droplet.id in self.__parked_tags:
+            return
+        if getattr(droplet, "status", None) != "off":
+            await self.__do_client.power_off_droplet(droplet.id)
+        tag_name = getattr(droplet, "tag_name", None)
+        self.adopt(droplet.id, droplet.name, time.time(), tag_name)
+        logging.info("droplet {} powered off into warm standby".format(droplet.name))
+
+        tag_parked = self.__parked[tag_name]
+        while len(tag_parked) > self.__pool_size:
+            droplet_id, (droplet_name, parked_time) = next(iter(tag_parked.items()))
+            self.claim(droplet_id)
+            await self.__destroy(droplet_id, droplet_name, "standby pool for {} is full".format(tag_name))
+
+    async def __destroy(self, droplet_id, droplet_name, reason):
+        logging.info("destroying standby droplet {0}, {1}".format(droplet_name, reason))
+        try:
+            await self.__do_client.destroy_droplet(droplet_id)
+        except DigitalOceanNotFoundException:
+            logging.info("standby droplet {} was already gone".format(droplet_name))
+        if self.__state_store is not None:
+            self.__state_store.remove_droplet(droplet_name)
+
+    async def reap(self):
+        now = time.time()
+        expired = [(droplet_id, droplet_name) for tag_parked in self.__parked.values()
+                   for droplet_id, (droplet_name, parked_time) in tag_parked.items()
+                   if now - parked_time > self.__max_idle_sec]
+        for droplet_id, droplet_name in expired:
+            self.claim(droplet_id)
+            await self.__destroy(droplet_id, droplet_name, "idle longer than {}s".format(self.__max_idle_sec))
+        return expired
+
+    async def __reap_forever(self, reap_interval_sec):
+        while True:
+            try:
+                await self.reap()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                tb = traceback.format_exc()
+                logging.error("standby reaping failed due to {0} \n at {1}".format(
+                    e if len(e.args) == 0 else e.args[0], tb))
+            await asyncio.sleep(reap_interval_sec)
+
+    def start_reaping(self, reap_interval_sec=None):
+        if self.__reap_task is not None:
+            return
+        if reap_interval_sec is None:
+            reap_interval_sec = min(60.0, self.__max_idle_sec / 4.0)
+        self.__reap_task = asyncio.ensure_future(self.__reap_forever(reap_interval_sec), loop=self.__loop)
+
+    def stop_reaping(self):
+        if self.__reap_task is not None:
+            self.__reap_task.cancel()
+            self.__reap_task = None
@@ -0,0 +1,135 @@
+import sqlite3
+import time
+from dropletrecord import DropletRecord
+
+
+class StoredDroplet:
+    __slots__ = ("name", "tag_name", "state", "id", "ip_address", "region", "updated_time", "status")
+
+    def __init__(self, name, tag_name, state, id=None, ip_address=None, region=None, updated_time=None):
+        self.name = name
+        self.tag_name = tag_name
+        self.state = state
+        self.id = id
+        self.ip_address = ip_address
+        self.region = region
+        self.updated_time = updated_time
+        self.status = "off" if state == StateStore.STANDBY else None
+
+    def record(self):
+        return DropletRecord(self.id, self.name, self.tag_name, self.ip_address, self.region, self.status)
+
+
+class StateStore:
+    BOOTING = "booting"
+    ACTIVE = "active"
+    STANDBY = "standby"
+
+    def __init__(self, file_path):
+        self.__connection = sqlite3.connect(file_path, isolation_level=None)
+        # small local writes on the event loop, keep them cheap
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.executescript("""
+            CREATE TABLE IF NOT EXISTS droplets (
+                name TEXT PRIMARY KEY,
+                tag_name TEXT NOT NULL,
+                state TEXT NOT NULL,
+                droplet_id INTEGER,
+                ip_address TEXT,
+                region TEXT,
+                updated_time REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS monitors (
+                droplet_id INTEGER PRIMARY KEY,
+                next_poll_time REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS boot_times (
+                snapshot_name TEXT NOT NULL,
+                region_name TEXT NOT NULL,
+                boot_kind TEXT NOT NULL,
+                boot_sec REAL NOT NULL,
+                recorded_time REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS stream_events (
+                tag_name TEXT NOT NULL,
+                event TEXT NOT NULL,
+                event_time REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS stream_events_time ON stream_events (event_time);
+        """)
+
+    def close(self):
+        self.__connection.close()
+
+    def save_droplet(self, name, tag_name, state, droplet_id=None, ip_address=None, region=None):
+        now = time.time()
+        cursor = self.__connection.execute(
+            "UPDATE droplets SET tag_name = ?, state = ?, droplet_id = COALESCE(?, droplet_id), "
+            "ip_address = COALESCE(?, ip_address), region = COALESCE(?, region), updated_time = ? WHERE name = ?",
+            (tag_name, state, droplet_id, ip_address, region, now, name))
+        if cursor.rowcount == 0:
+            self.__connection.execute(
+                "INSERT INTO droplets (name, tag_name, state, droplet_id, ip_address, region, updated_time) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, tag_name, state, droplet_id, ip_address, region, now))
+
+    def set_droplet_state(self, name, state):
+        self.__connection.execute("UPDATE droplets SET state = ?, updated_time = ? WHERE name = ?",
+                                  (state, time.time(), name))
+
+    def remove_droplet(self, name):
+        row = self.__connection.execute("SELECT droplet_id FROM droplets WHERE name = ?", (name,)).fetchone()
+        self.__connection.execute("DELETE FROM droplets WHERE name = ?", (name,))
+        if row is not None and row[0] is not None:
+            self.remove_monitor(row[0])
+
+    def remove_tag_droplets(self, tag_name):
+        self.__connection.execute(
+            "DELETE FROM monitors WHERE droplet_id IN (SELECT droplet_id FROM droplets WHERE tag_name = ?)",
+            (tag_name,))
+        self.__connection.execute("DELETE FROM droplets WHERE tag_name = ?", (tag_name,))
+
+    def load_droplets(self, state=None):
+        query = "SELECT name, tag_name, state, droplet_id, ip_address, region, updated_time FROM droplets"
+        rows = self.__connection.execute(query + " WHERE state = ?", (state,)) if state is not None else \
+            self.__connection.execute(query)
+        return [StoredDroplet(*row) for row in rows]
+
+    def save_monitor_deadline(self, droplet_id, next_poll_time):
+        self.__connection.execute("INSERT OR REPLACE INTO monitors (droplet_id, next_poll_time) VALUES (?, ?)",
+                                  (droplet_id, next_poll_time))
+
+    def remove_monitor(self, droplet_id):
+        self.__connection.execute("DELETE FROM monitors WHERE droplet_id = ?", (droplet_id,))
+
+    def load_monitor_deadlines(self):
+        return dict(self.__connection.execute("SELECT droplet_id, next_poll_time FROM monitors"))
+
+    def save_boot_time(self, snapshot_name, region_name, boot_kind, boot_sec):
+        self.__connection.execute(
+            "INSERT INTO boot_times (snapshot_name, region_name, boot_kind, boot_sec, recorded_time) "
+            "VALUES (?, ?, ?, ?, ?)", (snapshot_name, region_name, boot_kind, boot_sec, time.time()))
+
+    def load_boot_times(self, max_per_key=20):
+        rows = self.__connection.execute(
+            "SELECT snapshot_name, region_name, boot_kind, boot_sec FROM boot_times ORDER BY recorded_time DESC")
+        counts = {}
+        boot_times = []
+        for snapshot_name, region_name, boot_kind, boot_sec in rows:
+            key = (snapshot_name, region_name, boot_kind)
+            counts[key] = counts.get(key, 0) + 1
+            if counts[key] <= max_per_key:
+                boot_times.append((snapshot_name, region_name, boot_kind, boot_sec))
+        boot_times.reverse()
+        return boot_times
+
+    def save_stream_event(self, tag_name, event, event_time=None):
+        self.__connection.execute("INSERT INTO stream_events (tag_name, event, event_time) VALUES (?, ?, ?)",
+                                  (tag_name, event, event_time if event_time is not None else time.time()))
+
+    def load_stream_events(self, since_time=0):
+        # older history no longer says anything about when streams start, so it is dropped on load
+        self.__connection.execute("DELETE FROM stream_events WHERE event_time < ?", (since_time,))
+        return list(self.__connection.execute(
+            "SELECT tag_name, event, event_time FROM stream_events ORDER BY event_time"))
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import time
+import traceback
+
+
+class StatusSnapshot:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.created_time = time.perf_counter()
+
+    def age_sec(self):
+        return time.perf_counter() - self.created_time
+
+    def value(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class StatusCache:
+    def __init__(self, fetch_status, fresh_sec=10, max_stale_sec=120, cached_exceptions=(), fallback_exceptions=(),
+                 loop=None):
+        self.__fetch_status = fetch_status
+        self.__fresh_sec = fresh_sec
+        self.__max_stale_sec = max_stale_sec
+        self.__cached_exceptions = cached_exceptions
+        # failures that keep serving the last snapshot however old it is, rather than failing the caller
+        self.__fallback_exceptions = fallback_exceptions
+        self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__snapshots = {}
+        self.__pending_refreshes = {}
+        self.__generation = 0
+        self.__key_generations = {}
+
+    def invalidate(self, key=None):
+        # refreshes already in flight were started before the change and must not be stored
+        if key is None:
+            self.__generation += 1
+            self.__snapshots.clear()
+            self.__pending_refreshes.clear()
+        else:
+            self.__key_generations[key] = self.__key_generations.get(key, 0) + 1
+            self.__snapshots.pop(key, None)
+            self.__pending_refreshes.pop(key, None)
+
+    async def get(self, key):
+        snapshot = self.__snapshots.get(key)
+        if snapshot is not None:
+            age_sec = snapshot.age_sec()
+            if age_sec < self.__fresh_sec:
+                return snapshot.value()
+            if age_sec < self.__max_stale_sec:
+                # serve the stale snapshot now and revalidate behind it
+                self.__refresh(key)
+                return snapshot.value()
+
+        snapshot = await asyncio.shield(self.__refresh(key))
+        return snapshot.value()
+
+    def __refresh(self, key):
+        pending_refresh = self.__pending_refreshes.get(key)
+        if pending_refresh is None:
+            pending_refresh = asyncio.ensure_future(self.__revalidate(key, self.__key_generation(key)), loop=self.__loop)
+            pending_refresh.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.__pending_refreshes[key] = pending_refresh
+        return pending_refresh
+
+    def __key_generation(self, key):
+        return self.__generation, self.__key_generations.get(key, 0)
+
+    async def __revalidate(self, key, generation):
+        try:
+            try:
+                snapshot = StatusSnapshot(result=await self.__fetch_status(key))
+            except self.__cached_exceptions as e:
+                snapshot = StatusSnapshot(error=e)
+            except self.__fallback_exceptions as e:
+                snapshot = self.__snapshots.get(key)
+                if snapshot is None:
+                    raise
+                logging.warning("serving {0} status from {1:.0f}s ago: {2}".format(
+                    key, snapshot.age_sec(), e if len(e.args) == 0 else e.args[0]))
+                return snapshot
+            if generation == self.__key_generation(key):
+                self.__snapshots[key] = snapshot
+            return snapshot
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.error("status revalidation for {0} failed due to {1} \n at {2}".format(
+                key, e if len(e.args) == 0 else e.args[0], tb))
+            raise
+        finally:
+            if generation == self.__key_generation(key):
+                self.__pending_refreshes.pop(key, None)
@@ -1,27 +1,69 @@
 import discord
 import asyncio
 import dropletapi
+import os
 import sys
 import logging
 import time
 import traceback
 from config import Config
-import digitalocean as digio
+from digitaloceanclient import DigitalOceanClient
 from dropletapi import DropletApi
 from exception import LockedDropletException, MissingFirewallException, MissingSnapshotException, \
     MissingDropletException, UnauthorizedUserException, DropletBootFailedException, StreamBotException
 from dropletactivitymonitor import DropletActivityMonitor
-
-request_counter = 0
-request_spam_threshold = 5
-request_spam_reset_sec = 5.0
-request_spam_reset_base_time = time.perf_counter()
-timer_rollover_detection = -1000000000  # maxint / 2 ~
-client = discord.Client()
+from ratelimiter import CommandRateLimiter
+from commandrouter import CommandRouter
+from authcache import AuthorizationCache
+from metrics import metrics, MetricsServer, COUNT_BUCKETS
+from loopwatchdog import LoopWatchdog
+from messageoutbox import MessageOutbox
+from placement import DISCORD_REGION_HINTS
+from coordinator import CoordinatorClient, LocalDropletService, configure_droplet_api, \
+    start_droplet_api_background, api_budget
+from supervisor import Supervisor
+
+# set by the supervisor for each shard process, a bot without them runs every guild in one process
+shard_id = int(os.environ["STREAMBOT_SHARD_ID"]) if "STREAMBOT_SHARD_ID" in os.environ else None
+shard_count = int(os.environ.get("STREAMBOT_SHARD_COUNT", "1"))
+
+client = discord.Client(shard_id=shard_id, shard_count=shard_count) if shard_id is not None else discord.Client()
+outbox = MessageOutbox(client, loop=client.loop)
 config = Config("streambot.config")
+command_router = CommandRouter()
+authorization_cache = AuthorizationCache()
+command_rate_limiter = CommandRateLimiter(config.command_rate_limits(), config.rate_limit_idle_eviction_sec(),
+                                          loop=client.loop)
+do_client = DigitalOceanClient(config.digital_ocean_api_key(), api_budget=api_budget(config), loop=client.loop)
 server_activity_monitor = \
     DropletActivityMonitor(config.droplet_inactivity_delta(), config.droplet_inactivity_poll_sec(), loop=client.loop)
 
+if shard_id is not None:
+    droplet_service = CoordinatorClient(config.coordinator_host(), config.coordinator_port(),
+                                        notice_callback=lambda channel_id, text: post_notice(channel_id, text),
+                                        loop=client.loop)
+else:
+    droplet_service = LocalDropletService(do_client, server_activity_monitor)
+metrics_server = None
+loop_watchdog = LoopWatchdog(loop=client.loop, stall_threshold_sec=config.stall_threshold_sec())
+
+commands_total = metrics.counter("streambot_commands_total", "Commands received", ("command",))
+command_seconds = metrics.histogram("streambot_command_seconds", "Command latency, rate limiting included",
+                                    ("command",))
+command_api_calls = metrics.histogram("streambot_command_digitalocean_calls",
+                                      "DigitalOcean API calls made on behalf of one command", ("command",),
+                                      buckets=COUNT_BUCKETS)
+
+
+def apply_config_change(old_snapshot, new_snapshot):
+    server_activity_monitor.reconfigure(new_snapshot.droplet_inactivity_delta, new_snapshot.droplet_inactivity_poll_sec)
+    command_rate_limiter.reconfigure(new_snapshot.command_rate_limits)
+    # authorized roles and permissions may have changed with the profiles
+    authorization_cache.invalidate()
+
+
+config.subscribe(apply_config_change)
+
 
 @client.event
 async def on_ready():
@@ -29,166 +71,257 @@ async def on_ready():
     print(client.user.name)
     print(client.user.id)
     print('------')
+    if shard_id is None:
+        start_droplet_api_background()
+    command_rate_limiter.start_eviction()
+    config.start_watching(loop=client.loop)
+    await start_metrics_server()
+
+
+async def start_metrics_server():
+    global metrics_server
+    if metrics_server is not None or config.metrics_port() is None:
+        return
+    # the coordinator serves the configured port, shards the ones after it
+    port = config.metrics_port() + (shard_id + 1 if shard_id is not None else 0)
+    metrics_server = MetricsServer(metrics, config.metrics_host(), port, loop=client.loop)
+    try:
+        await metrics_server.start()
+    except OSError as e:
+        metrics_server = None
+        logging.error("metrics endpoint could not start: {}".format(e if len(e.args) == 0 else e.args[0]))
 
 
 @client.event
 async def on_message(message):
-    if message.content.startswith('!turn on stream'):
-        await call_authorized(turn_on_stream(message), message)
-    elif message.content.startswith('!turn off stream'):
-        await call_authorized(turn_off_stream(message), message)
-    elif message.content.startswith('!stream status'):
-        await call_unauthorized(stream_status(message), message)
-    elif message.content.startswith('!stream help'):
-        await call_unauthorized(stream_help(message), message)
+    command = command_router.route(message.content)
+    if command is None:
+        return
+
+    commands_total.inc(command=command.text)
+    # every api call made while serving this message is counted against the command
+    trace = metrics.trace_command(command.text)
+    with metrics.timer(command_seconds, command=command.text):
+        if command.authorized:
+            await call_authorized(command.run(message), message, command.command_class)
+        else:
+            await call_unauthorized(command.run(message), message, command.command_class)
+    command_api_calls.observe(trace.api_calls, command=command.text)
+
+
+async def request_rate_limited(coroutine, message, command_class):
+    channel_id = message.channel.id if message.channel is not None else None
+    if not command_rate_limiter.allow(command_class, message.author.id, channel_id):
+        coroutine.close()
+        outbox.send(message.channel, 'Hold your horses, I''m doing stuff, but not for you... ば.. ばか!!')
+        return True
+    return False
 
 
-def request_received():
-    global request_counter
-    request_counter += 1
+@client.event
+async def on_member_update(before, after):
+    authorization_cache.invalidate_member(after.server.id, after.id)
 
 
-async def request_counter_overflow(message):
-    check_request_counter_reset()
-    if request_counter > request_spam_threshold:
-        await client.send_message(message.channel, 'Hold your horses, I''m doing stuff, but not for you... ば.. ばか!!')
-        return True
-    return False
+@client.event
+async def on_member_remove(member):
+    authorization_cache.invalidate_member(member.server.id, member.id)
+
 
+@client.event
+async def on_server_role_update(before, after):
+    authorization_cache.invalidate_server(after.server.id)
 
-def check_request_counter_reset():
-    global request_spam_reset_base_time
-    global request_counter
-    delta_time = time.perf_counter() - request_spam_reset_base_time
 
-    if delta_time > request_spam_reset_sec or delta_time < timer_rollover_detection:
-        request_counter = 0
-        request_spam_reset_base_time = time.perf_counter()
+@client.event
+async def on_server_role_delete(role):
+    authorization_cache.invalidate_server(role.server.id)
+
+
+@client.event
+async def on_server_update(before, after):
+    authorization_cache.invalidate_server(after.id)
+
+
+@client.event
+async def on_channel_update(before, after):
+    # permission overwrites changed
+    if getattr(after, "server", None) is not None:
+        authorization_cache.invalidate_server(after.server.id)
 
 
 def check_user_role_authorized(message):
-    # require they have the manage server permission
+    # require the profile's permission in the channel (manage server by default) or its role; permissions_in
+    # covers the server owner, administrators and channel overwrites, decided once per member and channel
     author = message.author
-    if isinstance(author, discord.User):
-        user = message.author
-        permissions = user.permissions_in(message.channel)
-        if permissions.manage_server is True:
-            return True
-
-    elif isinstance(author, discord.Member):
-        member = message.author
-        for role in member.roles:
-            if role.permissions.manage_server is True:
+    profile = message_stream_profile(message)
+    if isinstance(author, discord.Member):
+        authorized = authorization_cache.get(author.server.id, author.id, message.channel.id)
+        if authorized is None:
+            authorized = check_permissions_authorized(author, message.channel, profile)
+            authorization_cache.put(author.server.id, author.id, authorized, message.channel.id)
+        return authorized
+
+    return check_permissions_authorized(author, message.channel, profile)
+
+
+def check_permissions_authorized(author, channel, profile):
+    permissions = author.permissions_in(channel)
+    if getattr(permissions, profile.authorized_permission, False) is True:
+        return True
+
+    if profile.authorized_role is not None:
+        for role in getattr(author, "roles", ()):
+            if profile.authorized_role in (role.name, role.id):
                 return True
 
     return False
 
 
-async def call_authorized(coroutine, message):
-    request_received()
-    if not await request_counter_overflow(message):
-        try:
-            if not check_user_role_authorized(message):
-                raise UnauthorizedUserException(
+async def call_authorized(coroutine, message, command_class):
+    # authorization comes first so users who may not run the command cannot spend the channel's tokens
+    if not check_user_role_authorized(message):
+        coroutine.close()
+        outbox.send(message.channel,
                     "I'm sorry {}, I'm afraid I can't allow you to do that.".format(message.author.name))
+        return
 
+    if not await request_rate_limited(coroutine, message, command_class):
+        try:
             await coroutine
         except StreamBotException as e:
-            await client.send_message(message.channel, e if len(e.args) == 0 else e.args[0])
+            outbox.send(message.channel, e if len(e.args) == 0 else e.args[0])
         except Exception as e:
-            await client.send_message(message.channel,
-                                      "Unexcepted error: {}".format(e if len(e.args) == 0 else e.args[0]))
+            outbox.send(message.channel,
+                        "Unexcepted error: {}".format(e if len(e.args) == 0 else e.args[0]))
 
 
-async def call_unauthorized(coroutine, message):
-    request_received()
-    if not await request_counter_overflow(message):
+async def call_unauthorized(coroutine, message, command_class):
+    if not await request_rate_limited(coroutine, message, command_class):
         try:
             await coroutine
         except StreamBotException as e:
-            await client.send_message(message.channel, e if len(e.args) == 0 else e.args[0])
+            outbox.send(message.channel, e if len(e.args) == 0 else e.args[0])
         except Exception as e:
-            await client.send_message(message.channel,
-                                      "Unexcepted error: {}".format(e if len(e.args) == 0 else e.args[0]))
+            outbox.send(message.channel,
+                        "Unexcepted error: {}".format(e if len(e.args) == 0 else e.args[0]))
 
 
 def message_progress_callback(message):
+    # one message per command, edited as the boot progresses
+    progress = outbox.progress(message.channel)
+
     async def text_progress_callback(text):
-        if not client.is_closed:
-            await client.send_message(message.channel, text)
+        progress.update(text)
 
     return text_progress_callback
 
 
+def message_notice_callback(message):
+    # follow ups that arrive after the command has answered go out as their own message
+    async def text_notice_callback(text):
+        outbox.send(message.channel, text)
+
+    return text_notice_callback
+
+
+async def post_notice(channel_id, text):
+    # progress the coordinator could not deliver to the shard that asked, posted by whichever shard sees the channel
+    channel = client.get_channel(channel_id) if channel_id is not None else None
+    if channel is not None:
+        outbox.send(channel, text)
+
+
+def message_stream_profile(message):
+    server_id = message.server.id if message.server is not None else None
+    return config.stream_profile(server_id)
+
+
+def message_region_hints(message, profile):
+    # the profile's own preference first, then the regions near the server's voice region
+    hints = list(profile.preferred_regions)
+    if message.server is not None:
+        for region in DISCORD_REGION_HINTS.get(str(message.server.region), ()):
+            if region not in hints:
+                hints.append(region)
+    return hints
+
+
 async def turn_on_stream(message):
-    manager = digio.Manager(token=config.digital_ocean_api_key())
+    profile = message_stream_profile(message)
     callback = message_progress_callback(message)
-    droplet = await DropletApi.create_or_get_single_droplet_from_snapshot(manager,
-                                                                          config.default_tag_name(),
-                                                                          config.default_snapshot_name(),
-                                                                          config.default_firewall_name(),
-                                                                          callback, server_activity_monitor)
-
-    default_stream_key = config.default_stream_key()
-    use_stream_key_line = default_stream_key is not "{stream key}"
+    droplet = await droplet_service.turn_on(profile.tag_name,
+                                            profile.snapshot_name,
+                                            profile.firewall_name,
+                                            callback,
+                                            message_region_hints(message, profile),
+                                            profile.region_rtt_ms,
+                                            message.channel.id)
+
     stream_key_line = ""
-    if use_stream_key_line:
-        stream_key_line = "stream key for publishing is '{}'\n".format(default_stream_key)
+    if profile.uses_stream_key():
+        stream_key_line = "stream key for publishing is '{}'\n".format(profile.stream_key)
 
-    await client.send_message(message.channel,
-                              "droplet {0} turned on, exists at ip {1}, \n" \
-                              "don't forget to turn it off when you're finished (!turn off stream) \n" \
-                              "stream publish url is rtmp://{1}:1935/publish?publish_key={{publish key}}\n" \
-                              "{4}" \
-                              "stream play url is rtmp://{1}:1935/live/{3}?play_key={2}"
-                              .format(droplet.name, droplet.ip_address, config.stream_play_key(),
-                                      default_stream_key, stream_key_line))
+    outbox.send(message.channel,
+                "droplet {0} turned on, exists at ip {1}, \n" \
+                "don't forget to turn it off when you're finished (!turn off stream) \n" \
+                "stream publish url is rtmp://{1}:1935/publish?publish_key={{publish key}}\n" \
+                "{4}" \
+                "stream play url is rtmp://{1}:1935/live/{3}?play_key={2}"
+                .format(droplet.name, droplet.ip_address, profile.play_key,
+                        profile.stream_key, stream_key_line))
 
 
 async def turn_off_stream(message):
-    manager = digio.Manager(token=config.digital_ocean_api_key())
-    droplets = DropletApi.destroy_tagged_droplets(manager, config.default_tag_name())
+    profile = message_stream_profile(message)
+    droplets = await droplet_service.turn_off(profile.tag_name, message_notice_callback(message), message.channel.id)
     if len(droplets) is 0:
-        await client.send_message(message.channel,
-                                  "no droplets to turn off")
+        outbox.send(message.channel,
+                    "no droplets to turn off")
     else:
         droplet_names = ",".join([d.name for d in droplets])
-        await client.send_message(message.channel,
-                                  "droplet(s) {} turned off"
-                                  .format(droplet_names))
+        outbox.send(message.channel,
+                    "droplet(s) {} turned off"
+                    .format(droplet_names))
 
 
 async def stream_status(message):
     try:
-        manager = digio.Manager(token=config.digital_ocean_api_key())
-        droplet, statuses = DropletApi.check_single_droplet_status(manager, config.default_tag_name())
+        profile = message_stream_profile(message)
+        droplet, statuses = await droplet_service.status(profile.tag_name)
         status_names = ",".join([s.status for s in statuses])
 
-        default_stream_key = config.default_stream_key()
-        use_stream_key_line = default_stream_key is not "{stream key}"
         stream_key_line = ""
-        if use_stream_key_line:
-            stream_key_line = "stream key for publishing is '{}'\n".format(default_stream_key)
-
-        await client.send_message(message.channel,
-                                  "droplet {0} exists at ip {1}, \n" \
-                                  "stream publish url is rtmp://{1}:1935/publish?publish_key={{publish key}}\n" \
-                                  "{5}" \
-                                  "stream play url is rtmp://{1}:1935/live/{4}?play_key={3}\n" \
-                                  "droplet's last status(es) are {2}"
-                                  .format(droplet.name, droplet.ip_address, status_names,
-                                          config.stream_play_key(), default_stream_key, stream_key_line))
+        if profile.uses_stream_key():
+            stream_key_line = "stream key for publishing is '{}'\n".format(profile.stream_key)
+
+        outbox.send(message.channel,
+                    "droplet {0} exists at ip {1}, \n" \
+                    "stream publish url is rtmp://{1}:1935/publish?publish_key={{publish key}}\n" \
+                    "{5}" \
+                    "stream play url is rtmp://{1}:1935/live/{4}?play_key={3}\n" \
+                    "droplet's last status(es) are {2}"
+                    .format(droplet.name, droplet.ip_address, status_names,
+                            profile.play_key, profile.stream_key, stream_key_line))
     except MissingDropletException:
-        await client.send_message(message.channel, "Stream is currently off, turn it on first! (!turn on stream)")
+        outbox.send(message.channel, "Stream is currently off, turn it on first! (!turn on stream)")
         pass
 
 
 async def stream_help(message):
-    await client.send_message(message.channel,
-                              "possible commands are: \n" \
-                              "!turn on stream \n" \
-                              "!turn off stream \n" \
-                              "!stream status")
+    outbox.send(message.channel,
+                "possible commands are: \n" \
+                "!turn on stream \n" \
+                "!turn off stream \n" \
+                "!stream status")
+
+command_router.add_command('!turn on stream', turn_on_stream, "control", authorized=True,
+                           max_concurrency=4, max_queued=8)
+command_router.add_command('!turn off stream', turn_off_stream, "teardown", authorized=True,
+                           max_concurrency=4, max_queued=8)
+command_router.add_command('!stream status', stream_status, "query", max_concurrency=8, max_queued=16)
+command_router.add_command('!stream help', stream_help, "query", max_concurrency=8, max_queued=16)
+
 
 def start_loop(*args, **kwargs):
     try:
@@ -204,7 +337,15 @@ def start_loop(*args, **kwargs):
         client.loop.close()
 
 def finish_pending_tasks(cancel=True):
+    loop_watchdog.stop()
+    outbox.close()
+    if metrics_server is not None:
+        metrics_server.close()
     client.loop.run_until_complete(client.logout())
+    if shard_id is not None:
+        client.loop.run_until_complete(droplet_service.close())
+    client.loop.run_until_complete(do_client.close())
+    client.loop.run_until_complete(server_activity_monitor.close())
     pending = asyncio.Task.all_tasks(loop=client.loop)
     gathered = asyncio.gather(*pending, loop=client.loop)
     try:
@@ -220,13 +361,9 @@ def finish_pending_tasks(cancel=True):
 
 
 
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO)
-
-    logging.info("Starting streambot")
-    client.loop.set_debug(True)
+def run_single_process():
     #logging.getLogger('backoff').addHandler(logging.StreamHandler(stream=sys.stdout))
-    DropletApi.track_single_droplets()
+    configure_droplet_api(config, do_client, server_activity_monitor, client.loop)
     while True:
         try:
             #client.run(config.discord_api_key())
@@ -237,3 +374,21 @@ if __name__ == '__main__':
         except Exception as e:
             tb = traceback.format_exc()
             logging.error("Main loop exception: {0} \n at {1}".format(e if len(e.args) == 0 else e.args[0], tb))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    # debug mode is too slow to leave on, the watchdog reports what blocks the loop instead
+    if shard_id is not None:
+        logging.info("Starting streambot shard {0} of {1}".format(shard_id, shard_count))
+        loop_watchdog.start()
+        # a failed shard exits and the supervisor starts it again on a fresh loop
+        start_loop(config.discord_api_key())
+    elif config.shard_count() > 1:
+        logging.info("Starting streambot with {} shards".format(config.shard_count()))
+        Supervisor(config.shard_count()).run()
+    else:
+        logging.info("Starting streambot")
+        loop_watchdog.start()
+        run_single_process()
@@ -0,0 +1,35 @@
+from placement import parse_region_rtt, parse_regions
+
+
+class StreamProfile:
+    def __init__(self, name, tag_name, snapshot_name, firewall_name=None, stream_key="{stream key}",
+                 play_key="{play key}", authorized_role=None, authorized_permission="manage_server",
+                 preferred_regions=(), region_rtt_ms=None):
+        self.name = name
+        self.tag_name = tag_name
+        self.snapshot_name = snapshot_name
+        self.firewall_name = firewall_name
+        self.stream_key = stream_key
+        self.play_key = play_key
+        self.authorized_role = authorized_role
+        self.authorized_permission = authorized_permission
+        self.preferred_regions = tuple(preferred_regions)
+        self.region_rtt_ms = region_rtt_ms if region_rtt_ms is not None else {}
+
+    def uses_stream_key(self):
+        return self.stream_key != "{stream key}"
+
+    @staticmethod
+    def from_section(name, section, default_profile):
+        # a guild section that leaves the tag out still gets a droplet of its own
+        tag_name = section.get("TagName") or "{}-{}".format(default_profile.tag_name, name)
+        return StreamProfile(name,
+                             tag_name,
+                             section.get("SnapshotName") or default_profile.snapshot_name,
+                             section.get("FirewallName") or default_profile.firewall_name,
+                             section.get("StreamKey") or default_profile.stream_key,
+                             section.get("PlayKey") or default_profile.play_key,
+                             section.get("AuthorizedRole") or default_profile.authorized_role,
+                             section.get("AuthorizedPermission") or default_profile.authorized_permission,
+                             parse_regions(section.get("PreferredRegions")) or default_profile.preferred_regions,
+                             parse_region_rtt(section.get("RegionRttMs")) or default_profile.region_rtt_ms)
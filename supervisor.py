@@ -0,0 +1,78 @@
+import logging
+import os
+import subprocess
+import sys
+import time
+
+
+class SupervisedProcess:
+    def __init__(self, name, args, env=None, min_restart_delay_sec=1, max_restart_delay_sec=60):
+        self.name = name
+        self.args = args
+        self.env = env
+        self.process = None
+        self.restarts = 0
+        self.__min_restart_delay_sec = min_restart_delay_sec
+        self.__max_restart_delay_sec = max_restart_delay_sec
+        self.__started_time = None
+        self.__restart_time = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.args, env=self.env)
+        self.__started_time = time.monotonic()
+        self.__restart_time = None
+        logging.info("started {0} as pid {1}".format(self.name, self.process.pid))
+
+    def check(self):
+        if self.process is None:
+            return
+        if self.__restart_time is None:
+            exit_code = self.process.poll()
+            if exit_code is None:
+                return
+            # a process that ran for a while restarts right away, one that keeps dying backs off
+            if time.monotonic() - self.__started_time > self.__max_restart_delay_sec:
+                self.restarts = 0
+            delay_sec = min(self.__max_restart_delay_sec, self.__min_restart_delay_sec * (2 ** self.restarts))
+            self.restarts += 1
+            self.__restart_time = time.monotonic() + delay_sec
+            logging.error("{0} exited with {1}, restarting in {2}s".format(self.name, exit_code, delay_sec))
+        elif time.monotonic() >= self.__restart_time:
+            self.start()
+
+    def stop(self, timeout_sec=10):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout_sec)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class Supervisor:
+    # one droplet coordinator that owns every droplet, and one bot process per discord gateway shard
+    def __init__(self, shard_count, base_dir=None, check_interval_sec=1):
+        base_dir = base_dir if base_dir is not None else os.path.dirname(os.path.abspath(__file__))
+        self.__check_interval_sec = check_interval_sec
+        self.__processes = [SupervisedProcess("coordinator", [sys.executable, os.path.join(base_dir, "coordinator.py")])]
+        for shard_id in range(shard_count):
+            env = dict(os.environ, STREAMBOT_SHARD_ID=str(shard_id), STREAMBOT_SHARD_COUNT=str(shard_count))
+            self.__processes.append(SupervisedProcess("shard {}".format(shard_id),
+                                                      [sys.executable, os.path.join(base_dir, "streambot.py")],
+                                                      env=env))
+
+    def run(self):
+        try:
+            for process in self.__processes:
+                process.start()
+            while True:
+                time.sleep(self.__check_interval_sec)
+                for process in self.__processes:
+                    process.check()
+        except KeyboardInterrupt:
+            logging.info("Ending streambot")
+        finally:
+            # shards first so nothing is asking the coordinator while it goes down
+            for process in reversed(self.__processes):
+                process.stop()
@@ -0,0 +1,24 @@
+import asyncio
+import os
+import sys
+import pytest
+
+# the bot's modules live at the repository root, not in a package; tests that reach aiohttp need python 3.5
+# or 3.6 with requirements.txt installed, elsewhere they skip
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    # background work a test started, like teardown confirmations, is cancelled rather than waited for
+    all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+    pending = [task for task in all_tasks(loop=loop) if not task.done()]
+    for task in pending:
+        task.cancel()
+    if len(pending) > 0:
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
@@ -0,0 +1,65 @@
+import asyncio
+import pytest
+from apibudget import ApiBudget, ApiPriority
+from exception import ApiBudgetExhaustedException
+
+
+def quota(limit, remaining, reset_time):
+    return {"RateLimit-Limit": str(limit), "RateLimit-Remaining": str(remaining), "RateLimit-Reset": str(reset_time)}
+
+
+def test_reserves_hold_back_less_important_calls():
+    budget = ApiBudget(boot_reserve=0.05, status_reserve=0.2)
+    assert budget.allows(ApiPriority.STATUS, now=0)
+
+    budget.update(200, quota(100, 10, 60), now=0)
+    assert not budget.allows(ApiPriority.STATUS, now=0)
+    assert budget.allows(ApiPriority.BOOT, now=0)
+    assert budget.allows(ApiPriority.TEARDOWN, now=0)
+
+    budget.update(200, quota(100, 3, 60), now=0)
+    assert not budget.allows(ApiPriority.BOOT, now=0)
+    assert budget.allows(ApiPriority.TEARDOWN, now=0)
+    # the quota is whole again once digitalocean resets it
+    assert budget.allows(ApiPriority.STATUS, now=60)
+
+
+def test_rate_limited_response_empties_the_budget():
+    budget = ApiBudget(default_retry_sec=30)
+    budget.update(429, {}, now=100)
+    assert budget.remaining == 0
+    assert budget.reset_time == 130
+    assert not budget.allows(ApiPriority.TEARDOWN, now=100)
+
+    budget.update(429, {"Retry-After": "5"}, now=100)
+    assert budget.reset_time == 105
+
+
+def test_status_calls_are_refused_instead_of_deferred(loop):
+    budget = ApiBudget(status_max_defer_sec=0)
+    budget.update(200, quota(100, 10, 10 ** 10), now=0)
+    with pytest.raises(ApiBudgetExhaustedException):
+        loop.run_until_complete(budget.acquire(ApiPriority.STATUS))
+    loop.run_until_complete(budget.acquire(ApiPriority.BOOT))
+    assert budget.remaining == 9
+
+
+def test_priority_follows_the_task_and_the_work_it_hands_off(loop):
+    seen = []
+
+    async def handed_off():
+        seen.append(ApiPriority.of())
+
+    @ApiPriority.prioritized(ApiPriority.TEARDOWN)
+    async def teardown():
+        seen.append(ApiPriority.of())
+        task = asyncio.ensure_future(handed_off(), loop=loop)
+        ApiPriority.share(task)
+        await task
+
+    async def turn_off():
+        await teardown()
+        seen.append(ApiPriority.of())
+
+    loop.run_until_complete(turn_off())
+    assert seen == [ApiPriority.TEARDOWN, ApiPriority.TEARDOWN, ApiPriority.BOOT]
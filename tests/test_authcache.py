@@ -0,0 +1,56 @@
+import time
+from authcache import AuthorizationCache
+
+
+def test_decisions_are_kept_per_channel():
+    cache = AuthorizationCache()
+    cache.put("server", "member", True, channel_id="stream channel")
+    cache.put("server", "member", False, channel_id="locked channel")
+    assert cache.get("server", "member", "stream channel") is True
+    assert cache.get("server", "member", "locked channel") is False
+    assert cache.get("server", "member", "unseen channel") is None
+    assert cache.get("server", "member") is None
+
+
+def test_invalidate_member_and_server():
+    cache = AuthorizationCache()
+    cache.put("server", "member", True, channel_id="a")
+    cache.put("server", "member", True, channel_id="b")
+    cache.put("server", "other member", True, channel_id="a")
+    cache.put("other server", "member", True, channel_id="a")
+
+    cache.invalidate_member("server", "member")
+    assert cache.get("server", "member", "a") is None
+    assert cache.get("server", "member", "b") is None
+    assert cache.get("server", "other member", "a") is True
+
+    cache.invalidate_server("server")
+    assert cache.get("server", "other member", "a") is None
+    assert cache.get("other server", "member", "a") is True
+    assert len(cache) == 1
+
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_least_recently_used_decision_is_evicted():
+    cache = AuthorizationCache(max_entries=2)
+    cache.put("server", "a", True)
+    cache.put("server", "b", True)
+    cache.get("server", "a")
+    cache.put("server", "c", True)
+    assert cache.get("server", "a") is True
+    assert cache.get("server", "b") is None
+    assert len(cache) == 2
+
+
+def test_decisions_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = AuthorizationCache(ttl_sec=60)
+    cache.put("server", "member", True)
+    now[0] += 59
+    assert cache.get("server", "member") is True
+    now[0] += 2
+    assert cache.get("server", "member") is None
+    assert len(cache) == 0
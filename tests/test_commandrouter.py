@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from commandrouter import CommandRouter
+from exception import CommandQueueFullException
+
+
+class GatedHandler:
+    # holds every call until the test opens the gate
+    def __init__(self, loop):
+        self.gate = loop.create_future()
+        self.handled = []
+
+    async def __call__(self, message):
+        self.handled.append(message)
+        await self.gate
+        return message
+
+
+async def noop(message):
+    return message
+
+
+def test_longest_matching_command_wins():
+    router = CommandRouter()
+    stream = router.add_command("!stream", noop, "status")
+    status = router.add_command("!stream status", noop, "status")
+
+    assert router.route("!stream status please") is status
+    assert router.route("!stream") is stream
+    assert router.route("!streams") is None
+    assert router.route("stream status") is None
+    assert sorted(c.text for c in router.commands()) == ["!stream", "!stream status"]
+
+
+def test_requests_past_the_queue_are_refused(loop):
+    handler = GatedHandler(loop)
+    command = CommandRouter().add_command("!turn on stream", handler, "boot", max_concurrency=1, max_queued=1)
+    running = asyncio.ensure_future(command.run("first"), loop=loop)
+    queued = asyncio.ensure_future(command.run("second"), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0))
+    assert (command.running, command.queued) == (1, 1)
+
+    with pytest.raises(CommandQueueFullException):
+        loop.run_until_complete(command.run("third"))
+
+    handler.gate.set_result(None)
+    assert loop.run_until_complete(asyncio.gather(running, queued)) == ["first", "second"]
+    assert handler.handled == ["first", "second"]
+    assert (command.running, command.queued) == (0, 0)
+
+
+def test_without_a_queue_only_the_running_slots_are_taken(loop):
+    handler = GatedHandler(loop)
+    command = CommandRouter().add_command("!stream status", handler, "status", max_concurrency=2)
+    running = [asyncio.ensure_future(command.run(message), loop=loop) for message in ("first", "second")]
+    loop.run_until_complete(asyncio.sleep(0))
+
+    with pytest.raises(CommandQueueFullException):
+        loop.run_until_complete(command.run("third"))
+    handler.gate.set_result(None)
+    loop.run_until_complete(asyncio.gather(*running))
+
+    # slots free up again once the handlers finish
+    assert loop.run_until_complete(command.run("fourth")) == "fourth"
@@ -0,0 +1,71 @@
+import os
+import pytest
+from config import Config
+from exception import ConfigValidationException
+
+VALID_CONFIG = """
+[Droplet]
+DefaultTagName=guild
+DefaultSnapshotName=stream-snapshot
+
+[ApiKey]
+DigitalOceanApiKey=do-key
+DiscordApiKey=discord-key
+"""
+
+
+def write_config(path, text, mtime_ns):
+    path.write_text(text)
+    # the signature is mtime and size, an explicit mtime keeps quick successive writes apart
+    os.utime(str(path), ns=(mtime_ns, mtime_ns))
+
+
+def test_missing_required_options_are_rejected(tmp_path):
+    path = tmp_path / "streambot.config"
+    write_config(path, VALID_CONFIG.replace("DefaultSnapshotName=stream-snapshot", "DefaultSnapshotName="), 10 ** 18)
+    with pytest.raises(ConfigValidationException) as e:
+        Config(str(path))
+    assert "DefaultSnapshotName" in str(e.value)
+
+    # without a file there is nothing to require
+    assert Config().default_tag_name() is None
+
+
+def test_changed_file_is_reloaded_and_subscribers_told(tmp_path):
+    path = tmp_path / "streambot.config"
+    write_config(path, VALID_CONFIG, 10 ** 18)
+    config = Config(str(path))
+    changes = []
+
+    def failing_subscriber(old, new):
+        raise ValueError("subscriber broke")
+
+    config.subscribe(failing_subscriber)
+    config.subscribe(lambda old, new: changes.append((old.default_tag_name, new.default_tag_name)))
+    assert not config.refresh()
+
+    write_config(path, VALID_CONFIG.replace("guild", "other-guild"), 2 * 10 ** 18)
+    assert config.refresh()
+    assert config.default_tag_name() == "other-guild"
+    assert changes == [("guild", "other-guild")]
+    assert not config.refresh()
+
+
+def test_invalid_or_missing_file_keeps_the_current_snapshot(tmp_path):
+    path = tmp_path / "streambot.config"
+    write_config(path, VALID_CONFIG, 10 ** 18)
+    config = Config(str(path))
+    changes = []
+    config.subscribe(lambda old, new: changes.append(new))
+
+    # caught halfway through a save
+    write_config(path, "[Droplet]\n", 2 * 10 ** 18)
+    assert not config.refresh()
+    path.unlink()
+    assert not config.refresh()
+    assert config.default_tag_name() == "guild"
+    assert changes == []
+
+    write_config(path, VALID_CONFIG.replace("guild", "other-guild"), 3 * 10 ** 18)
+    assert config.refresh()
+    assert config.default_tag_name() == "other-guild"
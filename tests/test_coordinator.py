@@ -0,0 +1,118 @@
+import asyncio
+import socket
+import pytest
+
+try:
+    import aiohttp
+    import async_timeout
+except (ImportError, SyntaxError) as e:
+    # aiohttp 1.x uses async as a name, it only imports on python 3.5 and 3.6 (see requirements.txt)
+    pytest.skip("coordinator needs aiohttp 1.x on python 3.5 or 3.6: {}".format(e), allow_module_level=True)
+from coordinator import CoordinatorClient, CoordinatorServer
+from dropletrecord import DropletRecord, ActionRecord
+from exception import CoordinatorUnavailableException, MissingDropletException, StreamBotException
+
+
+class ScriptedService:
+    # answers like LocalDropletService and keeps the progress callbacks for progress sent after the reply
+    def __init__(self):
+        self.progress_callbacks = []
+
+    async def turn_on(self, tag_name, snapshot_name, firewall_name, progress_callback=None, region_hints=None,
+                      region_rtt_ms=None, channel_id=None):
+        await progress_callback("booting {}".format(tag_name))
+        return DropletRecord(1, "{}-{}".format(snapshot_name, tag_name), tag_name, "10.0.0.1", "nyc3", "active")
+
+    async def turn_off(self, tag_name, progress_callback=None, channel_id=None):
+        self.progress_callbacks.append(progress_callback)
+        return [DropletRecord(1, "stream-{}".format(tag_name), tag_name)]
+
+    async def status(self, tag_name):
+        if tag_name == "missing":
+            raise MissingDropletException("no droplet tagged {}".format(tag_name))
+        if tag_name == "broken":
+            raise KeyError("unexpected")
+        return DropletRecord(1, "stream", tag_name, status="active"), [ActionRecord(2, "completed", "create")]
+
+
+class Notices:
+    def __init__(self):
+        self.received = []
+
+    async def __call__(self, channel_id, text):
+        self.received.append((channel_id, text))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def coordinator(loop):
+    service = ScriptedService()
+    port = free_port()
+    server = CoordinatorServer(service, port=port, loop=loop)
+    loop.run_until_complete(server.start())
+    yield service, port
+    server.close()
+
+
+def test_requests_round_trip_with_their_progress(loop, coordinator):
+    service, port = coordinator
+    shard = CoordinatorClient(port=port, loop=loop)
+    progress = []
+
+    async def progress_callback(text):
+        progress.append(text)
+
+    droplet = loop.run_until_complete(shard.turn_on("guild", "stream", None, progress_callback, channel_id=42))
+    assert (droplet.name, droplet.ip_address) == ("stream-guild", "10.0.0.1")
+    assert progress == ["booting guild"]
+
+    droplet, statuses = loop.run_until_complete(shard.status("guild"))
+    assert droplet.status == "active"
+    assert [(s.id, s.status) for s in statuses] == [(2, "completed")]
+    loop.run_until_complete(shard.close())
+
+
+def test_errors_are_raised_as_the_same_bot_exception(loop, coordinator):
+    service, port = coordinator
+    shard = CoordinatorClient(port=port, loop=loop)
+    with pytest.raises(MissingDropletException):
+        loop.run_until_complete(shard.status("missing"))
+    # anything that is not a bot exception comes back as the base one
+    with pytest.raises(StreamBotException) as e:
+        loop.run_until_complete(shard.status("broken"))
+    assert type(e.value) is StreamBotException
+    loop.run_until_complete(shard.close())
+
+
+def test_late_progress_reaches_the_channel_as_a_notice(loop, coordinator):
+    service, port = coordinator
+    asking_notices, other_notices = Notices(), Notices()
+    asking = CoordinatorClient(port=port, notice_callback=asking_notices, loop=loop)
+    other = CoordinatorClient(port=port, notice_callback=other_notices, loop=loop)
+    loop.run_until_complete(other.status("guild"))
+
+    loop.run_until_complete(asking.turn_off("guild", channel_id=42))
+    # the asking shard still listens but no longer waits on the request
+    loop.run_until_complete(service.progress_callbacks[0]("teardown confirmed"))
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert asking_notices.received == [(42, "teardown confirmed")]
+
+    # once it is gone, every other shard gets the notice and the one seeing the channel posts it
+    loop.run_until_complete(asking.close())
+    loop.run_until_complete(asyncio.sleep(0.05))
+    loop.run_until_complete(service.progress_callbacks[0]("droplet still running"))
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert other_notices.received == [(42, "droplet still running")]
+    loop.run_until_complete(other.close())
+
+
+def test_unreachable_coordinator_is_reported(loop):
+    shard = CoordinatorClient(port=free_port(), loop=loop)
+    with pytest.raises(CoordinatorUnavailableException):
+        loop.run_until_complete(shard.status("guild"))
+    loop.run_until_complete(shard.close())
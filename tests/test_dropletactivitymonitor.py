@@ -0,0 +1,122 @@
+import asyncio
+import time
+from datetime import timedelta
+import pytest
+
+try:
+    import aiohttp
+    import async_timeout
+except (ImportError, SyntaxError) as e:
+    # aiohttp 1.x uses async as a name, it only imports on python 3.5 and 3.6 (see requirements.txt)
+    pytest.skip("dropletactivitymonitor needs aiohttp 1.x on python 3.5 or 3.6: {}".format(e), allow_module_level=True)
+from dropletactivitymonitor import DropletActivityMonitor
+from dropletrecord import DropletRecord
+from exception import InactivityPollException
+
+
+class ScriptedMonitor(DropletActivityMonitor):
+    # answers polls from a table instead of asking the droplet
+    def __init__(self, idle_sec=None, **kwargs):
+        DropletActivityMonitor.__init__(self, **kwargs)
+        self.idle_sec = idle_sec if idle_sec is not None else {}
+        self.polled = []
+
+    async def get_last_active_time(self, ip):
+        self.polled.append(ip)
+        idle_sec = self.idle_sec.get(ip, 0)
+        if isinstance(idle_sec, Exception):
+            raise idle_sec
+        return time.time() - idle_sec
+
+
+class Callbacks:
+    def __init__(self):
+        self.inactive = []
+        self.errors = []
+
+    async def on_inactive(self, last_active_utc, droplet):
+        self.inactive.append(droplet.id)
+        return False
+
+    async def on_error(self, error, droplet):
+        self.errors.append((droplet.id, error))
+        return False
+
+
+def droplet(droplet_id):
+    return DropletRecord(droplet_id, "droplet-{}".format(droplet_id), "guild", "ip-{}".format(droplet_id))
+
+
+def test_polls_run_in_deadline_order(loop):
+    monitor = ScriptedMonitor(inactive_time_delta=timedelta(seconds=3600), loop=loop)
+    callbacks = Callbacks()
+    for droplet_id, delay_sec in ((1, 0.06), (2, 0.02), (3, 0.04)):
+        monitor.start_monitoring(droplet(droplet_id), callbacks.on_inactive, callbacks.on_error, delay_sec)
+    loop.run_until_complete(asyncio.sleep(0.2))
+
+    assert monitor.polled == ["ip-2", "ip-3", "ip-1"]
+    # active droplets are not polled again before they could possibly go inactive
+    assert sorted(monitor.monitored_droplet_ids()) == [1, 2, 3]
+    loop.run_until_complete(monitor.close())
+
+
+def test_inactive_droplet_finishes_monitoring(loop):
+    monitor = ScriptedMonitor(idle_sec={"ip-1": 600}, inactive_time_delta=timedelta(seconds=300), loop=loop)
+    callbacks = Callbacks()
+    finished = monitor.start_monitoring(droplet(1), callbacks.on_inactive, callbacks.on_error, 0)
+
+    assert loop.run_until_complete(asyncio.wait_for(finished, 1)) is True
+    assert callbacks.inactive == [1]
+    assert not monitor.is_monitoring(1)
+    loop.run_until_complete(monitor.close())
+
+
+def test_stopped_droplet_is_never_polled(loop):
+    monitor = ScriptedMonitor(loop=loop)
+    callbacks = Callbacks()
+    finished = monitor.start_monitoring(droplet(1), callbacks.on_inactive, callbacks.on_error, 0.05)
+    assert monitor.stop_monitoring(droplet(1))
+    assert not monitor.stop_monitoring(droplet(1))
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    assert finished.result() is False
+    assert monitor.polled == []
+    loop.run_until_complete(monitor.close())
+
+
+def test_restarting_replaces_the_previous_entry(loop):
+    monitor = ScriptedMonitor(inactive_time_delta=timedelta(seconds=3600), loop=loop)
+    callbacks = Callbacks()
+    first = monitor.start_monitoring(droplet(1), callbacks.on_inactive, callbacks.on_error, 0.02)
+    monitor.start_monitoring(droplet(1), callbacks.on_inactive, callbacks.on_error, 0.02)
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    assert first.result() is False
+    assert monitor.polled == ["ip-1"]
+    assert monitor.monitored_droplet_ids() == [1]
+    loop.run_until_complete(monitor.close())
+
+
+def test_repeated_poll_failures_end_with_the_error_callback(loop):
+    monitor = ScriptedMonitor(idle_sec={"ip-1": InactivityPollException("ip-1 returned status 500")},
+                              poll_delay_sec=0.01, max_poll_failures=3, loop=loop)
+    callbacks = Callbacks()
+    finished = monitor.start_monitoring(droplet(1), callbacks.on_inactive, callbacks.on_error, 0)
+
+    assert loop.run_until_complete(asyncio.wait_for(finished, 1)) is False
+    assert len(monitor.polled) == 3
+    assert [droplet_id for droplet_id, error in callbacks.errors] == [1]
+    loop.run_until_complete(monitor.close())
+
+
+def test_shorter_poll_delay_pulls_in_waiting_polls(loop):
+    monitor = ScriptedMonitor(inactive_time_delta=timedelta(seconds=3600), loop=loop)
+    callbacks = Callbacks()
+    monitor.start_monitoring(droplet(1), callbacks.on_inactive, callbacks.on_error, 3600)
+    loop.run_until_complete(asyncio.sleep(0.02))
+    assert monitor.polled == []
+
+    monitor.reconfigure(poll_delay_sec=0.02)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert monitor.polled == ["ip-1"]
+    loop.run_until_complete(monitor.close())
@@ -0,0 +1,377 @@
+import asyncio
+import time
+from datetime import datetime
+import pytest
+
+try:
+    import aiohttp
+    import async_timeout
+except (ImportError, SyntaxError) as e:
+    # aiohttp 1.x uses async as a name, it only imports on python 3.5 and 3.6 (see requirements.txt)
+    pytest.skip("dropletapi needs aiohttp 1.x on python 3.5 or 3.6: {}".format(e), allow_module_level=True)
+from digitaloceanclient import DigitalOceanClient
+from dropletactivitymonitor import DropletActivityMonitor
+from dropletapi import DropletApi
+from bootpoller import BootTimeModel
+from exception import DigitalOceanApiException, DropletBootFailedException, MissingDropletException, \
+    MissingFirewallException, MissingSnapshotException
+from fakedigitalocean import FakeDigitalOceanServer
+from placement import RegionPlacement
+from prebootscheduler import PrebootScheduler
+from statestore import StateStore
+
+SNAPSHOT_NAME = "stream-snapshot"
+TAG_NAME = "guild"
+DROPLET_NAME = "{}-{}".format(SNAPSHOT_NAME, TAG_NAME)
+
+
+class RecordingProbe:
+    def __init__(self):
+        self.measured = []
+
+    async def measure(self, guild_key, region):
+        self.measured.append(region)
+        return 50.0
+
+
+class RefusingClient(DigitalOceanClient):
+    # digitalocean turning down the delete by tag, everything else goes through
+    async def destroy_droplets_by_tag(self, tag_name):
+        raise DigitalOceanApiException("DELETE droplets failed with status 500")
+
+
+def reset_droplet_api():
+    # DropletApi keeps its registry on the class, every test starts from an untouched one
+    for name, value in (("pending_boots", {}), ("tag_locks", {}), ("existing_droplets", None),
+                        ("resource_cache", None), ("status_cache", None), ("boot_time_model", BootTimeModel()),
+                        ("standby_pool", None), ("state_store", None), ("placement", None),
+                        ("preboot_scheduler", None), ("tearing_down", {})):
+        setattr(DropletApi, "_DropletApi__" + name, value)
+
+
+@pytest.fixture
+def server(loop):
+    server = FakeDigitalOceanServer(boot_sec=0.1, power_on_sec=0.1, loop=loop)
+    loop.run_until_complete(server.start())
+    server.add_snapshot(SNAPSHOT_NAME)
+    server.add_ssh_key("stream-key")
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def state_store(tmp_path):
+    state_store = StateStore(str(tmp_path / "state.db"))
+    yield state_store
+    state_store.close()
+
+
+@pytest.fixture
+def droplet_api(loop, state_store):
+    reset_droplet_api()
+    DropletApi.track_single_droplets()
+    DropletApi.persist_state(state_store)
+    yield DropletApi
+    reset_droplet_api()
+
+
+def client(loop, server, client_class=DigitalOceanClient):
+    return client_class("test-token", api_base_url=server.api_base_url, loop=loop)
+
+
+def monitor(loop):
+    # parks every monitor far in the future, the polls themselves are covered by the monitor's tests
+    return DropletActivityMonitor(initial_monitor_delay_sec=3600, loop=loop)
+
+
+def close(loop, *closeables):
+    for closeable in closeables:
+        loop.run_until_complete(closeable.close())
+
+
+def test_turn_on_returns_the_running_droplet_and_monitors_it(loop, server, droplet_api):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+    existing = server.add_droplet(DROPLET_NAME, TAG_NAME)
+
+    droplet = loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+        do_client, TAG_NAME, SNAPSHOT_NAME, inactivity_monitor=inactivity_monitor))
+    assert droplet.id == existing["id"]
+    assert inactivity_monitor.is_monitoring(droplet.id)
+    assert server.request_count("POST", "droplets") == 0
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_concurrent_turn_ons_share_one_boot(loop, server, droplet_api, state_store):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+
+    droplets = loop.run_until_complete(asyncio.gather(*[
+        droplet_api.create_or_get_single_droplet_from_snapshot(do_client, TAG_NAME, SNAPSHOT_NAME,
+                                                               inactivity_monitor=inactivity_monitor)
+        for attempt in range(3)]))
+    assert len(set(d.id for d in droplets)) == 1
+    assert server.request_count("POST", "droplets") == 1
+    assert inactivity_monitor.monitored_droplet_ids() == [droplets[0].id]
+    assert droplet_api.tracked_droplets(TAG_NAME) == [DROPLET_NAME]
+    stored, = state_store.load_droplets()
+    assert (stored.state, stored.id) == (StateStore.ACTIVE, droplets[0].id)
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_missing_snapshot_drops_the_cached_listing(loop, server, droplet_api):
+    do_client = client(loop, server)
+    droplet_api.cache_resources(do_client, loop=loop)
+    with pytest.raises(MissingSnapshotException):
+        loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+            do_client, TAG_NAME, "late-snapshot"))
+
+    # created right after, found without waiting out the cache
+    snapshot = server.add_snapshot("late-snapshot")
+    assert loop.run_until_complete(droplet_api.get_droplet_snapshot(do_client, "late-snapshot")).id == \
+        snapshot["id"]
+    close(loop, do_client)
+
+
+def test_missing_firewall_drops_the_cached_listing(loop, server, droplet_api):
+    do_client = client(loop, server)
+    droplet_api.cache_resources(do_client, loop=loop)
+    with pytest.raises(MissingFirewallException):
+        loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+            do_client, TAG_NAME, SNAPSHOT_NAME, "late-firewall"))
+
+    firewall = server.add_firewall("late-firewall")
+    assert loop.run_until_complete(droplet_api.get_droplet_firewall(do_client, "late-firewall")).id == \
+        firewall["id"]
+    close(loop, do_client)
+
+
+def test_rejected_image_drops_the_cached_snapshot(loop, server, droplet_api):
+    do_client = client(loop, server)
+    droplet_api.cache_resources(do_client, loop=loop)
+    loop.run_until_complete(droplet_api.get_droplet_snapshot(do_client, SNAPSHOT_NAME))
+    # the snapshot is rebuilt under the same name, the cached id no longer exists
+    server.remove_snapshot(SNAPSHOT_NAME)
+    snapshot = server.add_snapshot(SNAPSHOT_NAME)
+
+    with pytest.raises(DigitalOceanApiException):
+        loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+            do_client, TAG_NAME, SNAPSHOT_NAME))
+    assert loop.run_until_complete(droplet_api.get_droplet_snapshot(do_client, SNAPSHOT_NAME)).id == \
+        snapshot["id"]
+    assert droplet_api.tracked_droplets(TAG_NAME) == []
+    close(loop, do_client)
+
+
+def test_turn_on_right_after_parking_waits_for_the_shutdown(loop, server, droplet_api, state_store):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+    droplet_api.keep_warm_standby(do_client, loop=loop)
+    existing = server.add_droplet(DROPLET_NAME, TAG_NAME)
+    state_store.save_droplet(DROPLET_NAME, TAG_NAME, StateStore.ACTIVE, droplet_id=existing["id"],
+                             ip_address=server.droplet_address)
+    droplet_api.rehydrate(do_client, inactivity_monitor, loop)
+
+    loop.run_until_complete(droplet_api.destroy_tagged_droplets(do_client, TAG_NAME, inactivity_monitor))
+    # still reported active while it shuts down, but it is no longer a running stream
+    assert [d["status"] for d in server.droplets(TAG_NAME)] == ["active"]
+    with pytest.raises(MissingDropletException):
+        loop.run_until_complete(droplet_api.check_single_droplet_status(do_client, TAG_NAME))
+
+    droplet = loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+        do_client, TAG_NAME, SNAPSHOT_NAME, inactivity_monitor=inactivity_monitor))
+    assert (droplet.id, droplet.status) == (existing["id"], "active")
+    assert server.request_count("POST", "droplets") == 0
+    assert server.request_count("POST", "droplets/{id}/actions") == 2
+    assert not droplet_api.standby_pool().contains(droplet.id)
+    assert inactivity_monitor.is_monitoring(droplet.id)
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_turn_off_during_a_boot_is_not_held_up_by_it(loop, server, droplet_api, state_store):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+    turn_on = asyncio.ensure_future(droplet_api.create_or_get_single_droplet_from_snapshot(
+        do_client, TAG_NAME, SNAPSHOT_NAME, inactivity_monitor=inactivity_monitor), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0.5))
+    assert server.request_count("POST", "droplets") == 1
+
+    # the boot poller stays quiet for seconds, the teardown does not wait for it
+    start_time = time.perf_counter()
+    destroyed = loop.run_until_complete(droplet_api.destroy_tagged_droplets(do_client, TAG_NAME, inactivity_monitor))
+    assert time.perf_counter() - start_time < 1
+    assert [d.name for d in destroyed] == [DROPLET_NAME]
+
+    with pytest.raises(DropletBootFailedException):
+        loop.run_until_complete(turn_on)
+    assert inactivity_monitor.monitored_droplet_ids() == []
+    assert droplet_api.tracked_droplets(TAG_NAME) == []
+    assert state_store.load_droplets() == []
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_rehydrate_restores_tracking_monitors_and_standbys(loop, server, droplet_api, state_store):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+    droplet_api.keep_warm_standby(do_client, loop=loop)
+    active = server.add_droplet(DROPLET_NAME, TAG_NAME)
+    booting = server.add_droplet("{}-booting".format(SNAPSHOT_NAME), "booting")
+    state_store.save_droplet(DROPLET_NAME, TAG_NAME, StateStore.ACTIVE, droplet_id=active["id"],
+                             ip_address=server.droplet_address)
+    state_store.save_droplet("{}-booting".format(SNAPSHOT_NAME), "booting", StateStore.BOOTING,
+                             droplet_id=booting["id"])
+    state_store.save_droplet("{}-parked".format(SNAPSHOT_NAME), "parked", StateStore.STANDBY, droplet_id=99)
+
+    assert droplet_api.rehydrate(do_client, inactivity_monitor, loop) == 3
+    assert droplet_api.tracked_droplets(TAG_NAME) == [DROPLET_NAME]
+    assert inactivity_monitor.is_monitoring(active["id"])
+    assert droplet_api.standby_pool().contains(99)
+
+    # the interrupted boot is picked up again once the droplet answers as active
+    loop.run_until_complete(asyncio.sleep(0.5))
+    assert inactivity_monitor.is_monitoring(booting["id"])
+    assert sorted(stored.id for stored in state_store.load_droplets(StateStore.ACTIVE)) == \
+        sorted((active["id"], booting["id"]))
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_rehydrate_forgets_boots_interrupted_before_the_create_answered(loop, server, droplet_api, state_store):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+    state_store.save_droplet(DROPLET_NAME, TAG_NAME, StateStore.BOOTING)
+
+    droplet_api.rehydrate(do_client, inactivity_monitor, loop)
+    assert droplet_api.tracked_droplets(TAG_NAME) == []
+    assert state_store.load_droplets() == []
+
+    # nothing was created, so the next turn on creates instead of waiting on the name
+    droplet = loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+        do_client, TAG_NAME, SNAPSHOT_NAME, inactivity_monitor=inactivity_monitor))
+    assert server.request_count("POST", "droplets") == 1
+    assert [d["id"] for d in server.droplets(TAG_NAME)] == [droplet.id]
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_turn_on_of_a_running_stream_skips_the_create_only_stages(loop, server, droplet_api):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+    probe = RecordingProbe()
+    droplet_api.place_droplets(RegionPlacement(probe=probe))
+    server.add_firewall("stream-firewall")
+    existing = server.add_droplet(DROPLET_NAME, TAG_NAME)
+
+    droplet = loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+        do_client, TAG_NAME, SNAPSHOT_NAME, "stream-firewall", inactivity_monitor=inactivity_monitor))
+    assert droplet.id == existing["id"]
+    assert probe.measured == []
+    assert server.request_count("POST", "firewalls/{id}/tags") == 0
+
+    # once nothing runs, the create probes the regions and brings the firewall along
+    loop.run_until_complete(do_client.destroy_droplet(existing["id"]))
+    loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+        do_client, TAG_NAME, SNAPSHOT_NAME, "stream-firewall", inactivity_monitor=inactivity_monitor))
+    assert len(probe.measured) > 0
+    assert server.request_count("POST", "firewalls/{id}/tags") == 1
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_unavailable_region_falls_through_to_the_next(loop, server, droplet_api):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+    placement = droplet_api.place_droplets(RegionPlacement())
+    server.add_snapshot("regional-snapshot", regions=("nyc3", "tor1"))
+    server.unavailable_regions.add("nyc3")
+
+    loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+        do_client, TAG_NAME, "regional-snapshot", inactivity_monitor=inactivity_monitor))
+    assert [d["region"]["slug"] for d in server.droplets(TAG_NAME)] == ["tor1"]
+    assert server.request_count("POST", "droplets") == 2
+    assert placement.rank(TAG_NAME, ["nyc3", "tor1"]) == ["tor1", "nyc3"]
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_rejected_create_is_not_retried_in_other_regions(loop, server, droplet_api):
+    do_client = client(loop, server)
+    placement = droplet_api.place_droplets(RegionPlacement())
+    droplet_api.cache_resources(do_client, loop=loop)
+    server.add_snapshot("regional-snapshot", regions=("nyc3", "tor1"))
+    loop.run_until_complete(droplet_api.get_droplet_snapshot(do_client, "regional-snapshot"))
+    # the cached image is gone, every region would refuse it alike
+    server.remove_snapshot("regional-snapshot")
+    server.add_snapshot("regional-snapshot", regions=("nyc3", "tor1"))
+
+    with pytest.raises(DigitalOceanApiException) as e:
+        loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+            do_client, TAG_NAME, "regional-snapshot"))
+    assert e.value.status == 422
+    assert server.request_count("POST", "droplets") == 1
+    assert placement.rank(TAG_NAME, ["nyc3", "tor1"]) == ["nyc3", "tor1"]
+    close(loop, do_client)
+
+
+def test_teardown_deletes_by_tag_and_stops_monitoring(loop, server, droplet_api, state_store):
+    do_client, inactivity_monitor = client(loop, server), monitor(loop)
+    existing = server.add_droplet(DROPLET_NAME, TAG_NAME)
+    state_store.save_droplet(DROPLET_NAME, TAG_NAME, StateStore.ACTIVE, droplet_id=existing["id"],
+                             ip_address=server.droplet_address)
+    droplet_api.rehydrate(do_client, inactivity_monitor, loop)
+    assert inactivity_monitor.is_monitoring(existing["id"])
+
+    droplets = loop.run_until_complete(droplet_api.destroy_tagged_droplets(do_client, TAG_NAME,
+                                                                           inactivity_monitor))
+    assert [d.id for d in droplets] == [existing["id"]]
+    assert server.request_count("DELETE", "droplets") == 1
+    assert server.droplets(TAG_NAME) == []
+    assert not inactivity_monitor.is_monitoring(existing["id"])
+    assert droplet_api.tracked_droplets(TAG_NAME) == []
+    assert state_store.load_droplets() == []
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_refused_teardown_keeps_droplets_monitored_and_tracked(loop, server, droplet_api, state_store):
+    do_client, inactivity_monitor = client(loop, server, RefusingClient), monitor(loop)
+    existing = server.add_droplet(DROPLET_NAME, TAG_NAME)
+    state_store.save_droplet(DROPLET_NAME, TAG_NAME, StateStore.ACTIVE, droplet_id=existing["id"],
+                             ip_address=server.droplet_address)
+    droplet_api.rehydrate(do_client, inactivity_monitor, loop)
+
+    with pytest.raises(DigitalOceanApiException):
+        loop.run_until_complete(droplet_api.destroy_tagged_droplets(do_client, TAG_NAME, inactivity_monitor))
+    assert inactivity_monitor.is_monitoring(existing["id"])
+    assert droplet_api.tracked_droplets(TAG_NAME) == [DROPLET_NAME]
+    assert [stored.id for stored in state_store.load_droplets()] == [existing["id"]]
+
+    # a later turn on still finds the droplet instead of waiting out a teardown that never happened
+    droplet = loop.run_until_complete(droplet_api.create_or_get_single_droplet_from_snapshot(
+        do_client, TAG_NAME, SNAPSHOT_NAME, inactivity_monitor=inactivity_monitor))
+    assert droplet.id == existing["id"]
+    close(loop, do_client, inactivity_monitor)
+
+
+def test_monitor_error_on_a_droplet_already_deleted(loop, server, droplet_api, state_store):
+    do_client = client(loop, server)
+    droplet_api.schedule_preboots(PrebootScheduler(None, None, loop=loop))
+    existing = server.add_droplet(DROPLET_NAME, TAG_NAME)
+    state_store.save_droplet(DROPLET_NAME, TAG_NAME, StateStore.ACTIVE, droplet_id=existing["id"])
+    droplet_api.rehydrate(do_client)
+    droplet = loop.run_until_complete(do_client.get_droplet(existing["id"]))
+    loop.run_until_complete(do_client.destroy_droplet(existing["id"]))
+
+    callback = droplet_api.destroy_droplet_callback_errored(do_client)
+    assert loop.run_until_complete(callback(Exception("poll failed"), droplet)) is False
+    assert droplet_api.tracked_droplets(TAG_NAME) == []
+    assert state_store.load_droplets() == []
+    # a stream that ended because its droplet stopped answering is history for the preboots all the same
+    assert [(tag_name, event) for tag_name, event, event_time in state_store.load_stream_events()] == \
+        [(TAG_NAME, PrebootScheduler.INACTIVE_SHUTDOWN)]
+    close(loop, do_client)
+
+
+def test_inactive_droplet_is_destroyed(loop, server, droplet_api, state_store):
+    do_client = client(loop, server)
+    droplet_api.schedule_preboots(PrebootScheduler(None, None, loop=loop))
+    existing = server.add_droplet(DROPLET_NAME, TAG_NAME)
+    state_store.save_droplet(DROPLET_NAME, TAG_NAME, StateStore.ACTIVE, droplet_id=existing["id"])
+    droplet_api.rehydrate(do_client)
+    droplet = loop.run_until_complete(do_client.get_droplet(existing["id"]))
+
+    callback = droplet_api.destroy_droplet_callback(do_client)
+    assert loop.run_until_complete(callback(datetime.utcnow(), droplet)) is False
+    assert server.droplets(TAG_NAME) == []
+    assert droplet_api.tracked_droplets(TAG_NAME) == []
+    assert state_store.load_droplets() == []
+    assert [(tag_name, event) for tag_name, event, event_time in state_store.load_stream_events()] == \
+        [(TAG_NAME, PrebootScheduler.INACTIVE_SHUTDOWN)]
+    close(loop, do_client)
@@ -0,0 +1,32 @@
+import asyncio
+import time
+from loopwatchdog import LoopWatchdog
+
+
+def block_the_loop(sec):
+    time.sleep(sec)
+
+
+async def stall(sec):
+    await asyncio.sleep(0.1)
+    block_the_loop(sec)
+    await asyncio.sleep(0.1)
+
+
+def test_stall_is_attributed_to_the_blocking_function(loop):
+    watchdog = LoopWatchdog(loop=loop, stall_threshold_sec=0.1, interval_sec=0.01)
+    watchdog.start()
+    loop.run_until_complete(stall(0.3))
+    watchdog.stop()
+
+    count, stalled_sec = watchdog.totals()["test_loopwatchdog.py:block_the_loop"]
+    assert count == 1
+    assert stalled_sec >= 0.2
+
+
+def test_an_idle_loop_records_nothing(loop):
+    watchdog = LoopWatchdog(loop=loop, stall_threshold_sec=0.5, interval_sec=0.01)
+    watchdog.start()
+    loop.run_until_complete(asyncio.sleep(0.2))
+    watchdog.stop()
+    assert watchdog.totals() == {}
@@ -0,0 +1,91 @@
+import asyncio
+import pytest
+from messageoutbox import MessageOutbox
+
+
+class Channel:
+    def __init__(self, id):
+        self.id = id
+
+
+class Message:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+
+class RecordingClient:
+    # stands in for the discord client, remembering every send and edit
+    def __init__(self):
+        self.is_closed = False
+        self.calls = []
+        self.fail = False
+
+    async def send_message(self, channel, content):
+        if self.fail:
+            raise ConnectionError("discord is unreachable")
+        self.calls.append(("send", channel.id, content))
+        return Message(channel, content)
+
+    async def edit_message(self, message, content):
+        self.calls.append(("edit", message.channel.id, content))
+        return Message(message.channel, content)
+
+
+def outbox(loop, client, **kwargs):
+    return MessageOutbox(client, rate_per_sec=100, burst=100, coalesce_sec=0.01, loop=loop, **kwargs)
+
+
+def test_back_to_back_sends_go_out_as_one_message(loop):
+    client = RecordingClient()
+    messages = outbox(loop, client)
+    channel = Channel(1)
+    futures = [messages.send(channel, text) for text in ("turning on", "turning on", "ready")]
+    sent = loop.run_until_complete(asyncio.gather(*futures))
+
+    assert client.calls == [("send", 1, "turning on\nready")]
+    assert all(message is sent[0] for message in sent)
+    assert messages.pending() == 0
+    messages.close()
+
+
+def test_progress_updates_coalesce_into_edits_of_one_message(loop):
+    client = RecordingClient()
+    messages = outbox(loop, client)
+    progress = messages.progress(Channel(1))
+    progress.update("preparing")
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    for text in ("booting", "booting", "almost there"):
+        progress.update(text)
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    assert client.calls == [("send", 1, "preparing"), ("edit", 1, "preparing\nbooting\nalmost there")]
+    messages.close()
+
+
+def test_progress_long_after_the_message_starts_a_new_one(loop):
+    client = RecordingClient()
+    messages = outbox(loop, client, edit_window_sec=0.05)
+    progress = messages.progress(Channel(1))
+    progress.update("booting")
+    loop.run_until_complete(asyncio.sleep(0.1))
+    progress.update("ready")
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    assert client.calls == [("send", 1, "booting"), ("send", 1, "ready")]
+    messages.close()
+
+
+def test_failed_send_reaches_every_coalesced_sender(loop):
+    client = RecordingClient()
+    client.fail = True
+    messages = outbox(loop, client)
+    channel = Channel(1)
+    futures = [messages.send(channel, text) for text in ("first", "second")]
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result()
+    messages.close()
@@ -0,0 +1,61 @@
+import asyncio
+from metrics import MetricsRegistry, current_task
+
+
+def test_counter_renders_one_sorted_line_per_label_set():
+    registry = MetricsRegistry()
+    commands = registry.counter("streambot_commands_total", "Commands handled", ("command",))
+    commands.inc(command="!stream status")
+    commands.inc(2, command='!turn "on"')
+    commands.inc(command="!stream status")
+
+    assert commands.value(command="!stream status") == 2
+    assert registry.render() == "\n".join([
+        "# HELP streambot_commands_total Commands handled",
+        "# TYPE streambot_commands_total counter",
+        'streambot_commands_total{command="!stream status"} 2',
+        'streambot_commands_total{command="!turn \\"on\\""} 2']) + "\n"
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    boots = registry.histogram("dropletapi_boot_seconds", "Boot latency", ("kind",), buckets=(1, 10))
+    for value in (0.5, 5, 5, 50):
+        boots.observe(value, kind="create")
+
+    assert registry.render().splitlines()[2:] == [
+        'dropletapi_boot_seconds_bucket{kind="create",le="1.0"} 1',
+        'dropletapi_boot_seconds_bucket{kind="create",le="10.0"} 3',
+        'dropletapi_boot_seconds_bucket{kind="create",le="+Inf"} 4',
+        'dropletapi_boot_seconds_sum{kind="create"} 60.5',
+        'dropletapi_boot_seconds_count{kind="create"} 4']
+    assert (boots.count(kind="create"), boots.total(kind="create")) == (4, 60.5)
+    assert boots.quantile(0.5, kind="create") == 5.5
+    assert boots.quantile(0.5, kind="power_on") is None
+
+
+def test_metrics_render_in_name_order_and_are_registered_once():
+    registry = MetricsRegistry()
+    second = registry.counter("b_total", "second")
+    registry.counter("a_total", "first").inc()
+    assert registry.counter("b_total", "registered again") is second
+    assert [line for line in registry.render().splitlines() if line.startswith("# HELP")] == \
+        ["# HELP a_total first", "# HELP b_total second"]
+
+
+def test_shared_work_is_traced_to_the_command_that_started_it(loop):
+    registry = MetricsRegistry()
+
+    async def boot():
+        registry.current_trace().api_calls += 1
+
+    async def command():
+        trace = registry.trace_command("!turn on stream")
+        shared = asyncio.ensure_future(boot())
+        registry.share_trace(shared)
+        await shared
+        return trace, registry.trace_for(current_task())
+
+    trace, current = loop.run_until_complete(command())
+    assert current is trace
+    assert (trace.command, trace.api_calls) == ("!turn on stream", 1)
@@ -0,0 +1,65 @@
+from placement import RegionPlacement, parse_region_rtt, parse_regions
+
+
+class ScriptedProbe:
+    def __init__(self, rtt_ms):
+        self.rtt_ms = rtt_ms
+        self.measured = []
+
+    async def measure(self, guild_key, region):
+        self.measured.append(region)
+        rtt_ms = self.rtt_ms[region]
+        if isinstance(rtt_ms, Exception):
+            raise rtt_ms
+        return rtt_ms
+
+
+def test_parse_region_settings():
+    assert parse_region_rtt("nyc3:40, fra1:120") == {"nyc3": 40.0, "fra1": 120.0}
+    assert parse_region_rtt(None) == {}
+    assert parse_regions(" nyc3, ,fra1") == ("nyc3", "fra1")
+
+
+def test_rtt_is_the_median_of_fresh_samples():
+    placement = RegionPlacement(sample_ttl_sec=3600)
+    for rtt_ms in (50, 10, 30):
+        placement.record_rtt("guild", "nyc3", rtt_ms, now=100)
+    assert placement.rtt("guild", "nyc3", now=200) == 30
+    assert placement.rtt("guild", "nyc3", now=4000) is None
+    assert placement.rtt("other guild", "nyc3", now=200) is None
+
+
+def test_configured_rtt_outranks_probes():
+    placement = RegionPlacement()
+    placement.record_rtt("guild", "nyc3", 5)
+    assert placement.rtt("guild", "nyc3", {"nyc3": 90}) == 90
+    # a slow configured region still goes ahead of a fast probed one
+    assert placement.rank("guild", ["nyc3", "fra1"], configured_rtt_ms={"fra1": 80}) == ["fra1", "nyc3"]
+
+
+def test_rank_orders_probed_by_rtt_and_keeps_unknown_in_snapshot_order():
+    placement = RegionPlacement()
+    placement.record_rtt("guild", "fra1", 120)
+    placement.record_rtt("guild", "lon1", 60)
+    assert placement.rank("guild", ["sgp1", "fra1", "blr1", "lon1"]) == ["lon1", "fra1", "sgp1", "blr1"]
+
+
+def test_rank_applies_the_hint_bonus_and_puts_failed_regions_last():
+    placement = RegionPlacement(hint_bonus_ms=30)
+    placement.record_rtt("guild", "nyc3", 40)
+    placement.record_rtt("guild", "tor1", 60)
+    assert placement.rank("guild", ["nyc3", "tor1"], hints=("tor1",)) == ["tor1", "nyc3"]
+
+    placement.record_failure("tor1")
+    assert placement.rank("guild", ["nyc3", "tor1"], hints=("tor1",)) == ["nyc3", "tor1"]
+
+
+def test_measure_records_probes_and_skips_while_fresh(loop):
+    probe = ScriptedProbe({"nyc3": 40.0, "fra1": OSError("unreachable")})
+    placement = RegionPlacement(probe=probe)
+    loop.run_until_complete(placement.measure("guild", ["nyc3", "fra1"]))
+    assert placement.rtt("guild", "nyc3") == 40.0
+    assert placement.rtt("guild", "fra1") is None
+
+    loop.run_until_complete(placement.measure("guild", ["nyc3", "fra1"]))
+    assert sorted(probe.measured) == ["fra1", "nyc3"]
@@ -0,0 +1,128 @@
+import asyncio
+from prebootscheduler import PrebootScheduler, WEEK_SEC
+
+# streams start mondays at 20:00 utc, the 1970 epoch fell on a thursday
+START_OFFSET_SEC = 4 * 24 * 3600 + 20 * 3600
+THIS_WEEK = 100 * WEEK_SEC
+
+
+class RecordingScheduler:
+    def __init__(self, loop, preboot_error=None, **kwargs):
+        self.prebooted = []
+        self.torn_down = []
+        self.preboot_error = preboot_error
+        self.scheduler = PrebootScheduler(self.preboot, self.teardown, loop=loop, **kwargs)
+
+    async def preboot(self, tag_name):
+        self.prebooted.append(tag_name)
+        if self.preboot_error is not None:
+            raise self.preboot_error
+
+    async def teardown(self, tag_name):
+        self.torn_down.append(tag_name)
+
+
+def stream(scheduler, tag_name, start_time, length_sec=3600):
+    scheduler.record(tag_name, PrebootScheduler.TURN_ON, start_time)
+    scheduler.record(tag_name, PrebootScheduler.TURN_OFF, start_time + length_sec)
+
+
+def check(loop, scheduler, now):
+    loop.run_until_complete(scheduler.check(now))
+    # lets the preboot task the check started run
+    loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_windows_need_starts_in_enough_weeks(loop):
+    scheduler = PrebootScheduler(None, None, min_weeks=2, loop=loop)
+    stream(scheduler, "guild", THIS_WEEK - WEEK_SEC + START_OFFSET_SEC)
+    assert scheduler.windows("guild", THIS_WEEK) == []
+
+    stream(scheduler, "guild", THIS_WEEK - 2 * WEEK_SEC + START_OFFSET_SEC + 600)
+    windows = scheduler.windows("guild", THIS_WEEK)
+    assert len(windows) == 1
+    assert windows[0].week_offset_sec == START_OFFSET_SEC
+    assert windows[0].weeks == 2
+
+
+def test_windows_ignore_starts_outside_the_window_or_history(loop):
+    scheduler = PrebootScheduler(None, None, min_weeks=2, history_weeks=4, window_sec=1800, loop=loop)
+    stream(scheduler, "guild", THIS_WEEK - WEEK_SEC + START_OFFSET_SEC)
+    stream(scheduler, "guild", THIS_WEEK - 2 * WEEK_SEC + START_OFFSET_SEC + 7200)
+    assert scheduler.windows("guild", THIS_WEEK) == []
+
+    scheduler = PrebootScheduler(None, None, min_weeks=2, history_weeks=4, loop=loop)
+    stream(scheduler, "guild", THIS_WEEK - 6 * WEEK_SEC + START_OFFSET_SEC)
+    stream(scheduler, "guild", THIS_WEEK - WEEK_SEC + START_OFFSET_SEC)
+    assert scheduler.windows("guild", THIS_WEEK) == []
+
+
+def test_preboots_within_lead_time_and_claims_on_turn_on(loop):
+    recording = RecordingScheduler(loop, lead_time_sec=600)
+    scheduler = recording.scheduler
+    stream(scheduler, "guild", THIS_WEEK - WEEK_SEC + START_OFFSET_SEC)
+    stream(scheduler, "guild", THIS_WEEK - 2 * WEEK_SEC + START_OFFSET_SEC)
+
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC - 1200)
+    assert recording.prebooted == []
+
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC - 300)
+    assert recording.prebooted == ["guild"]
+    assert scheduler.pending("guild")
+
+    # the same window is never prebooted twice
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC - 200)
+    assert recording.prebooted == ["guild"]
+
+    scheduler.record("guild", PrebootScheduler.TURN_ON, THIS_WEEK + START_OFFSET_SEC)
+    assert not scheduler.pending("guild")
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC + 7200)
+    assert recording.torn_down == []
+
+
+def test_unclaimed_preboot_is_torn_down_after_the_grace(loop):
+    recording = RecordingScheduler(loop, lead_time_sec=600, claim_grace_sec=1800)
+    scheduler = recording.scheduler
+    stream(scheduler, "guild", THIS_WEEK - WEEK_SEC + START_OFFSET_SEC)
+    stream(scheduler, "guild", THIS_WEEK - 2 * WEEK_SEC + START_OFFSET_SEC)
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC - 300)
+
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC + 1000)
+    assert recording.torn_down == []
+
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC + 1801)
+    assert recording.torn_down == ["guild"]
+    assert not scheduler.pending("guild")
+
+
+def test_inactive_shutdown_does_not_end_a_preboot(loop):
+    recording = RecordingScheduler(loop)
+    scheduler = recording.scheduler
+    stream(scheduler, "guild", THIS_WEEK - WEEK_SEC + START_OFFSET_SEC)
+    stream(scheduler, "guild", THIS_WEEK - 2 * WEEK_SEC + START_OFFSET_SEC)
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC - 300)
+
+    scheduler.record("guild", PrebootScheduler.INACTIVE_SHUTDOWN, THIS_WEEK + START_OFFSET_SEC - 200)
+    assert scheduler.pending("guild")
+
+
+def test_failed_preboot_is_forgotten(loop):
+    recording = RecordingScheduler(loop, preboot_error=Exception("snapshot is missing"))
+    scheduler = recording.scheduler
+    stream(scheduler, "guild", THIS_WEEK - WEEK_SEC + START_OFFSET_SEC)
+    stream(scheduler, "guild", THIS_WEEK - 2 * WEEK_SEC + START_OFFSET_SEC)
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC - 300)
+
+    assert recording.prebooted == ["guild"]
+    assert not scheduler.pending("guild")
+
+
+def test_live_streams_are_not_prebooted(loop):
+    recording = RecordingScheduler(loop)
+    scheduler = recording.scheduler
+    stream(scheduler, "guild", THIS_WEEK - WEEK_SEC + START_OFFSET_SEC)
+    stream(scheduler, "guild", THIS_WEEK - 2 * WEEK_SEC + START_OFFSET_SEC)
+    scheduler.record("guild", PrebootScheduler.TURN_ON, THIS_WEEK + START_OFFSET_SEC - 900)
+
+    check(loop, scheduler, THIS_WEEK + START_OFFSET_SEC - 300)
+    assert recording.prebooted == []
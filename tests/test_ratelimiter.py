@@ -0,0 +1,62 @@
+from config import ConfigSnapshot
+from ratelimiter import CommandRateLimiter, KeyedTokenBucketLimiter
+
+
+def test_bucket_refills_at_its_rate():
+    limiter = KeyedTokenBucketLimiter(rate_per_sec=1.0, burst=2)
+    assert limiter.try_acquire("user", now=0)
+    assert limiter.try_acquire("user", now=0)
+    assert not limiter.try_acquire("user", now=0.5)
+    assert limiter.try_acquire("user", now=1.5)
+    assert limiter.try_acquire("other user", now=1.5)
+
+
+def test_idle_buckets_are_evicted_once_refilled():
+    limiter = KeyedTokenBucketLimiter(rate_per_sec=1.0, burst=10)
+    limiter.try_acquire("idle", now=0)
+    limiter.try_acquire("busy", now=8)
+    # asked for 5s idle, but a bucket is only dropped once it could have refilled, here 10s
+    assert limiter.evict_idle(5, now=9) == 0
+    assert limiter.evict_idle(5, now=10) == 1
+    assert len(limiter) == 1
+
+
+def test_allow_stops_at_the_burst(loop):
+    limiter = CommandRateLimiter({"control": {CommandRateLimiter.USER: (0.0, 2)}}, loop=loop)
+    assert limiter.allow("control", "user", "channel")
+    assert limiter.allow("control", "user", "channel")
+    assert not limiter.allow("control", "user", "channel")
+    assert limiter.allow("control", "other user", "channel")
+    # command classes without limits are never held back
+    assert limiter.allow("query", "user", "channel")
+
+
+def test_rejected_requests_cost_nothing(loop):
+    limiter = CommandRateLimiter({"control": {CommandRateLimiter.USER: (0.0, 2),
+                                              CommandRateLimiter.CHANNEL: (0.0, 1)}}, loop=loop)
+    assert limiter.allow("control", "user", "busy channel")
+    assert not limiter.allow("control", "user", "busy channel")
+    # the refused request above did not take the user's second token
+    assert limiter.allow("control", "user", "quiet channel")
+    assert not limiter.allow("control", "user", "another channel")
+
+
+def test_teardown_has_its_own_buckets(loop):
+    limits = {command_class: {scope: (per_min / 60.0, burst) for scope, (per_min, burst) in scopes.items()}
+              for command_class, scopes in ConfigSnapshot.DEFAULT_COMMAND_RATE_LIMITS.items()}
+    limiter = CommandRateLimiter(limits, loop=loop)
+    while limiter.allow("control", "user", "channel"):
+        pass
+    assert limiter.allow("teardown", "user", "channel")
+
+
+def test_reconfigure_changes_existing_buckets(loop):
+    limiter = CommandRateLimiter({"control": {CommandRateLimiter.USER: (0.0, 3)}}, loop=loop)
+    assert limiter.allow("control", "user", "channel")
+    # a lower burst caps the tokens a bucket already holds
+    limiter.reconfigure({"control": {CommandRateLimiter.USER: (0.0, 1)},
+                         "query": {CommandRateLimiter.USER: (0.0, 1)}})
+    assert limiter.allow("control", "user", "channel")
+    assert not limiter.allow("control", "user", "channel")
+    assert limiter.allow("query", "user", "channel")
+    assert not limiter.allow("query", "user", "channel")
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from resourcecache import ResourceCache, DropletResourceCache
+
+
+class Resource:
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+
+
+class ScriptedListing:
+    def __init__(self, *listings):
+        self.listings = list(listings)
+        self.calls = 0
+        self.gate = None
+
+    async def __call__(self):
+        self.calls += 1
+        if self.gate is not None:
+            await self.gate
+        return self.listings[min(self.calls, len(self.listings)) - 1]
+
+
+class Clock:
+    def __init__(self, monkeypatch, now=1000.0):
+        self.now = now
+        monkeypatch.setattr(time, "perf_counter", lambda: self.now)
+
+
+def test_listing_is_reused_until_the_ttl(loop, monkeypatch):
+    clock = Clock(monkeypatch)
+    listing = ScriptedListing([Resource("snapshot", 1)], [Resource("snapshot", 2)])
+    cache = ResourceCache("snapshots", listing, ttl_sec=300, loop=loop)
+    assert loop.run_until_complete(cache.get("snapshot")).id == 1
+    clock.now += 299
+    assert loop.run_until_complete(cache.get("snapshot")).id == 1
+    assert listing.calls == 1
+
+    clock.now += 2
+    assert loop.run_until_complete(cache.get("snapshot")).id == 2
+    assert [r.id for r in loop.run_until_complete(cache.get_all())] == [2]
+
+
+def test_concurrent_lookups_share_one_listing(loop):
+    listing = ScriptedListing([Resource("a", 1), Resource("b", 2)])
+    listing.gate = loop.create_future()
+    cache = ResourceCache("snapshots", listing, loop=loop)
+    lookups = asyncio.gather(cache.get("a"), cache.get("b"), cache.get_all())
+    loop.run_until_complete(asyncio.sleep(0))
+    listing.gate.set_result(None)
+
+    a, b, everything = loop.run_until_complete(lookups)
+    assert (a.id, b.id, len(everything)) == (1, 2, 2)
+    assert listing.calls == 1
+
+
+def test_missing_names_relist_only_after_the_miss_interval(loop, monkeypatch):
+    clock = Clock(monkeypatch)
+    listing = ScriptedListing([], [Resource("new snapshot", 1)])
+    cache = ResourceCache("snapshots", listing, ttl_sec=300, miss_refresh_sec=30, loop=loop)
+    assert loop.run_until_complete(cache.get("new snapshot")) is None
+    clock.now += 10
+    assert loop.run_until_complete(cache.get("new snapshot")) is None
+    assert listing.calls == 1
+
+    clock.now += 21
+    assert loop.run_until_complete(cache.get("new snapshot")).id == 1
+    assert listing.calls == 2
+
+
+def test_invalidate_forces_a_new_listing(loop):
+    listing = ScriptedListing([Resource("snapshot", 1)], [Resource("snapshot", 2)])
+    cache = ResourceCache("snapshots", listing, ttl_sec=300, loop=loop)
+    loop.run_until_complete(cache.get("snapshot"))
+    cache.invalidate()
+    assert loop.run_until_complete(cache.get("snapshot")).id == 2
+
+
+class ListingClient:
+    def __init__(self):
+        self.get_all_snapshots = ScriptedListing([Resource("snapshot", 1)])
+        self.get_all_firewalls = ScriptedListing([Resource("firewall", 2)])
+        self.get_all_sshkeys = ScriptedListing([Resource("key", 3)])
+
+
+def test_background_refresh_keeps_every_listing_warm(loop):
+    do_client = ListingClient()
+    cache = DropletResourceCache(do_client, refresh_interval_sec=0.02, loop=loop)
+    cache.start_background_refresh()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    cache.stop_background_refresh()
+    loop.run_until_complete(asyncio.sleep(0))
+
+    listings = (do_client.get_all_snapshots, do_client.get_all_firewalls, do_client.get_all_sshkeys)
+    assert all(listing.calls >= 2 for listing in listings)
+    calls = [listing.calls for listing in listings]
+    loop.run_until_complete(cache.firewalls.get("firewall"))
+    assert [listing.calls for listing in listings] == calls
+
+    cache.invalidate()
+    loop.run_until_complete(cache.snapshots.get("snapshot"))
+    loop.run_until_complete(cache.ssh_keys.get_all())
+    assert [listing.calls for listing in listings] == [calls[0] + 1, calls[1], calls[2] + 1]
@@ -0,0 +1,72 @@
+import time
+from dropletrecord import DropletRecord
+from exception import DigitalOceanNotFoundException
+from standbypool import StandbyPool
+from statestore import StateStore
+
+
+class RecordingClient:
+    def __init__(self, missing_ids=()):
+        self.powered_off = []
+        self.destroyed = []
+        self.missing_ids = set(missing_ids)
+
+    async def power_off_droplet(self, droplet_id):
+        self.powered_off.append(droplet_id)
+
+    async def destroy_droplet(self, droplet_id):
+        if droplet_id in self.missing_ids:
+            raise DigitalOceanNotFoundException("DELETE droplets/{} was not found".format(droplet_id))
+        self.destroyed.append(droplet_id)
+
+
+def droplet(droplet_id, tag_name, status="active"):
+    return DropletRecord(droplet_id, "snapshot-{}".format(tag_name), tag_name, "10.0.0.1", "nyc3", status)
+
+
+def test_park_powers_off_and_claim_takes_it_back(loop):
+    do_client = RecordingClient()
+    pool = StandbyPool(do_client, loop=loop)
+    loop.run_until_complete(pool.park(droplet(1, "guild")))
+    loop.run_until_complete(pool.park(droplet(2, "other guild", status="off")))
+    assert do_client.powered_off == [1]
+    assert pool.contains(1) and pool.contains(2)
+
+    assert pool.claim(1)
+    assert not pool.contains(1)
+    assert not pool.claim(1)
+
+
+def test_each_tag_keeps_its_own_pool(loop):
+    do_client = RecordingClient()
+    pool = StandbyPool(do_client, pool_size=1, loop=loop)
+    loop.run_until_complete(pool.park(droplet(1, "guild a")))
+    loop.run_until_complete(pool.park(droplet(2, "guild b")))
+    assert pool.contains(1) and pool.contains(2)
+    assert do_client.destroyed == []
+
+    # a second droplet for the same tag pushes out its oldest
+    loop.run_until_complete(pool.park(droplet(3, "guild a")))
+    assert do_client.destroyed == [1]
+    assert not pool.contains(1)
+    assert pool.contains(2) and pool.contains(3)
+
+
+def test_reap_destroys_droplets_idle_too_long(loop, tmp_path):
+    do_client = RecordingClient(missing_ids=(2,))
+    state_store = StateStore(str(tmp_path / "state.db"))
+    state_store.save_droplet("snapshot-guild a", "guild a", StateStore.STANDBY, droplet_id=1)
+    pool = StandbyPool(do_client, max_idle_sec=3600, loop=loop)
+    pool.persist_to(state_store)
+    pool.adopt(1, "snapshot-guild a", time.time() - 7200, "guild a")
+    pool.adopt(2, "snapshot-guild b", time.time() - 7200, "guild b")
+    pool.adopt(3, "snapshot-guild c", time.time(), "guild c")
+
+    expired = loop.run_until_complete(pool.reap())
+    assert sorted(droplet_id for droplet_id, droplet_name in expired) == [1, 2]
+    # droplet 2 was already deleted outside the bot, that still empties its slot
+    assert do_client.destroyed == [1]
+    assert not pool.contains(1) and not pool.contains(2)
+    assert pool.contains(3)
+    assert state_store.load_droplets() == []
+    state_store.close()
@@ -0,0 +1,46 @@
+import time
+from statestore import StateStore
+
+
+def test_droplet_rows_keep_known_fields(tmp_path):
+    state_store = StateStore(str(tmp_path / "state.db"))
+    state_store.save_droplet("snapshot-guild", "guild", StateStore.BOOTING)
+    state_store.save_droplet("snapshot-guild", "guild", StateStore.BOOTING, droplet_id=7, region="nyc3")
+    state_store.save_droplet("snapshot-guild", "guild", StateStore.ACTIVE, ip_address="10.0.0.1")
+
+    stored, = state_store.load_droplets()
+    assert (stored.state, stored.id, stored.ip_address, stored.region) == (StateStore.ACTIVE, 7, "10.0.0.1", "nyc3")
+    record = stored.record()
+    assert (record.id, record.tag_name, record.region, record.status) == (7, "guild", "nyc3", None)
+
+    state_store.set_droplet_state("snapshot-guild", StateStore.STANDBY)
+    assert state_store.load_droplets(StateStore.STANDBY)[0].record().status == "off"
+    state_store.close()
+
+
+def test_removing_a_droplet_drops_its_monitor(tmp_path):
+    state_store = StateStore(str(tmp_path / "state.db"))
+    state_store.save_droplet("snapshot-guild", "guild", StateStore.ACTIVE, droplet_id=7)
+    state_store.save_droplet("snapshot-other", "other", StateStore.ACTIVE, droplet_id=8)
+    state_store.save_monitor_deadline(7, 100.0)
+    state_store.save_monitor_deadline(8, 200.0)
+
+    state_store.remove_droplet("snapshot-guild")
+    assert state_store.load_monitor_deadlines() == {8: 200.0}
+    state_store.remove_tag_droplets("other")
+    assert state_store.load_monitor_deadlines() == {}
+    assert state_store.load_droplets() == []
+    state_store.close()
+
+
+def test_stream_events_older_than_the_history_are_dropped(tmp_path):
+    state_store = StateStore(str(tmp_path / "state.db"))
+    now = time.time()
+    state_store.save_stream_event("guild", "turn_on", now - 100)
+    state_store.save_stream_event("guild", "turn_on", now - 10000)
+    state_store.save_stream_event("guild", "turn_off", now - 50)
+
+    assert state_store.load_stream_events(now - 1000) == [("guild", "turn_on", now - 100),
+                                                           ("guild", "turn_off", now - 50)]
+    assert len(state_store.load_stream_events()) == 2
+    state_store.close()
@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+from exception import ApiBudgetExhaustedException, MissingDropletException
+from statuscache import StatusCache
+
+
+class ScriptedFetch:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.fetched = []
+        self.gate = None
+
+    async def __call__(self, key):
+        self.fetched.append(key)
+        if self.gate is not None:
+            await self.gate
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_fresh_snapshots_are_served_without_fetching(loop):
+    fetch = ScriptedFetch("up")
+    cache = StatusCache(fetch, fresh_sec=60, loop=loop)
+    assert loop.run_until_complete(cache.get("guild")) == "up"
+    assert loop.run_until_complete(cache.get("guild")) == "up"
+    assert fetch.fetched == ["guild"]
+
+
+def test_concurrent_gets_share_one_fetch(loop):
+    fetch = ScriptedFetch("up")
+    cache = StatusCache(fetch, fresh_sec=60, loop=loop)
+    results = loop.run_until_complete(asyncio.gather(cache.get("guild"), cache.get("guild")))
+    assert results == ["up", "up"]
+    assert fetch.fetched == ["guild"]
+
+
+def test_cached_exceptions_are_raised_from_the_snapshot(loop):
+    fetch = ScriptedFetch(MissingDropletException("no droplets"))
+    cache = StatusCache(fetch, fresh_sec=60, cached_exceptions=(MissingDropletException,), loop=loop)
+    for attempt in range(2):
+        with pytest.raises(MissingDropletException):
+            loop.run_until_complete(cache.get("guild"))
+    assert fetch.fetched == ["guild"]
+
+
+def test_refresh_started_before_an_invalidate_is_not_stored(loop):
+    fetch = ScriptedFetch("booting", "up")
+    cache = StatusCache(fetch, fresh_sec=60, loop=loop)
+    fetch.gate = loop.create_future()
+    pending_get = asyncio.ensure_future(cache.get("guild"), loop=loop)
+    loop.run_until_complete(asyncio.sleep(0))
+
+    cache.invalidate("guild")
+    fetch.gate.set_result(None)
+    assert loop.run_until_complete(pending_get) == "booting"
+    assert loop.run_until_complete(cache.get("guild")) == "up"
+
+
+def test_invalidating_everything_bumps_every_key(loop):
+    fetch = ScriptedFetch("a", "b", "a again", "b again")
+    cache = StatusCache(fetch, fresh_sec=60, loop=loop)
+    loop.run_until_complete(cache.get("guild a"))
+    loop.run_until_complete(cache.get("guild b"))
+    cache.invalidate()
+    assert loop.run_until_complete(cache.get("guild a")) == "a again"
+    assert loop.run_until_complete(cache.get("guild b")) == "b again"
+
+
+def test_fallback_exceptions_serve_the_last_snapshot(loop):
+    fetch = ScriptedFetch("up", ApiBudgetExhaustedException("budget is low"))
+    cache = StatusCache(fetch, fresh_sec=0, max_stale_sec=0,
+                        fallback_exceptions=(ApiBudgetExhaustedException,), loop=loop)
+    assert loop.run_until_complete(cache.get("guild")) == "up"
+    assert loop.run_until_complete(cache.get("guild")) == "up"
+    assert fetch.fetched == ["guild", "guild"]
+
+
+def test_fallback_exceptions_without_a_snapshot_fail(loop):
+    fetch = ScriptedFetch(ApiBudgetExhaustedException("budget is low"))
+    cache = StatusCache(fetch, fallback_exceptions=(ApiBudgetExhaustedException,), loop=loop)
+    with pytest.raises(ApiBudgetExhaustedException):
+        loop.run_until_complete(cache.get("guild"))